@@ -0,0 +1,155 @@
+"""
+Admission control for kernel requests.
+
+When every computer is full, a request for a kernel waits in a bounded
+FIFO queue until a kernel ends and makes room, or until its deadline
+passes. The rate at which kernels end gives the expected wait of a new
+request (its position in the queue divided by the rate); when that is
+longer than ``shed_wait`` seconds and other requests are already
+waiting, or the queue is full, the request is rejected right away, so
+that clients back off (with a ``Retry-After`` header) instead of piling
+up.
+"""
+import math
+import time
+from collections import deque
+
+
+class AdmissionQueue(object):
+    """
+    Book-keeping for kernel requests waiting for room on the trusted side.
+
+    The queue does not start kernels or keep time itself; the kernel
+    manager offers requests to it (:meth:`offer`), takes them out when
+    there is room (:meth:`pop`) and expires them at their deadline
+    (:meth:`expire`).
+
+    :arg int max_size: most requests that may wait at a time
+    :arg float max_wait: seconds a request may wait before it fails
+    :arg float shed_wait: requests whose expected wait is longer than
+        this many seconds are rejected right away, unless the queue is
+        empty
+    :arg float half_life: seconds after which an observation of the rate
+        at which kernels end counts half as much
+    """
+    def __init__(self, max_size=100, max_wait=30.0, shed_wait=10.0, half_life=60.0):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.shed_wait = shed_wait
+        self.tau = half_life / math.log(2)
+        self._queue = deque() # [start, fail, time enqueued]; start is None once the entry is done
+        self._waiting = 0 # entries in _queue that are not done
+        self._rate = 0.0 # decayed rate at which kernels end, per second
+        self._rate_time = time.time()
+        self.stats = {"admitted": 0, "expired": 0,
+                      "rejected_full": 0, "rejected_wait": 0,
+                      "max_depth": 0,
+                      "wait": 0.0, "longest_wait": 0.0} # seconds admitted requests waited
+
+    def __len__(self):
+        return self._waiting
+
+    def record_release(self):
+        """ Record that a kernel ended and made room for another. """
+        self._rate = self.release_rate() + 1.0 / self.tau
+        self._rate_time = time.time()
+
+    def release_rate(self):
+        """
+        :returns: exponentially decayed rate at which kernels end
+        :rtype: float
+        """
+        return self._rate * math.exp((self._rate_time - time.time()) / self.tau)
+
+    def expected_wait(self, position=None):
+        """
+        :arg int position: number of requests ahead in the queue; by
+            default, a request joining the queue now
+        :returns: seconds the request is expected to wait, or None if no
+            kernel has ended recently
+        :rtype: float
+        """
+        if position is None:
+            position = self._waiting
+        rate = self.release_rate()
+        if rate < 1e-6:
+            return None
+        return (position + 1) / rate
+
+    def retry_after(self):
+        """
+        :returns: whole seconds after which a rejected client should try
+            again
+        :rtype: int
+        """
+        wait = self.expected_wait()
+        if wait is None:
+            wait = self.shed_wait
+        return max(1, int(math.ceil(min(wait, self.max_wait))))
+
+    def offer(self, start, fail):
+        """
+        Queue a request, unless the queue is full or the expected wait is
+        too long.
+
+        :arg callable start: called by :meth:`pop` when there is room
+        :arg callable fail: called by :meth:`expire` at the deadline
+        :returns: a handle for :meth:`expire`, or None if the request was
+            rejected
+        """
+        if self._waiting >= self.max_size:
+            self.stats["rejected_full"] += 1
+            return None
+        wait = self.expected_wait()
+        if self._waiting and wait is not None and wait > self.shed_wait:
+            self.stats["rejected_wait"] += 1
+            return None
+        entry = [start, fail, time.time()]
+        self._queue.append(entry)
+        self._waiting += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self._waiting)
+        return entry
+
+    def pop(self):
+        """
+        Take the oldest waiting request out of the queue.
+
+        :returns: its ``start`` callable, or None if no request is waiting
+        """
+        while self._queue:
+            entry = self._queue.popleft()
+            start = entry[0]
+            if start is None:
+                continue
+            entry[0] = None
+            self._waiting -= 1
+            wait = time.time() - entry[2]
+            stats = self.stats
+            stats["admitted"] += 1
+            stats["wait"] = 0.9 * stats["wait"] + 0.1 * wait
+            stats["longest_wait"] = max(stats["longest_wait"], wait)
+            return start
+        return None
+
+    def expire(self, entry):
+        """
+        Fail a request that is still waiting at its deadline.
+
+        :arg entry: the handle returned by :meth:`offer`
+        """
+        if entry[0] is None:
+            return
+        entry[0] = None
+        self._waiting -= 1
+        self.stats["expired"] += 1
+        entry[1]()
+
+    def status(self):
+        """
+        :returns: the queue depth, the release rate, the expected wait of
+            a new request and the counters in :attr:`stats`
+        :rtype: dict
+        """
+        return dict(self.stats, depth=self._waiting,
+                    release_rate=self.release_rate(),
+                    expected_wait=self.expected_wait())
@@ -0,0 +1,95 @@
+"""
+Checkpoints of the web server's computers and kernels.
+
+With ``registry_checkpoint`` set, the kernel manager writes the computers
+it has brought up (their configuration and the endpoints of their
+receivers) and the records of their kernels (connection information with
+HMAC keys, deadlines and clients) to a file whenever they change, and once
+more when the web server is stopped with SIGTERM. A web server started
+afterwards adopts the receivers that still answer and the kernels they
+still run instead of starting new ones, so a restart costs neither the
+users' kernels nor a cold prefork of every computer.
+
+The file holds the kernels' HMAC keys, so only its owner may read it. It
+is replaced atomically: a crash while it is written leaves the previous
+checkpoint in place.
+"""
+import json
+import os
+import tempfile
+import time
+
+from log import logger
+
+#: Version of the file format; checkpoints of other versions are ignored
+VERSION = 1
+
+
+def _str(value):
+    """ Turn the unicode strings from :func:`json.load` back into UTF-8
+    byte strings, which ZMQ and the sessions expect. """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_str(k), _str(v)) for k, v in value.iteritems())
+    return value
+
+
+def save(path, computers, kernels):
+    """
+    Write a checkpoint, replacing the previous one.
+
+    :arg str path: file to write
+    :arg list computers: a dictionary for every computer, see
+        :meth:`trusted_kernel_manager.TrustedMultiKernelManager.checkpoint`
+    :arg list kernels: kernel records from
+        :meth:`kernel_registry.KernelRegistry.dump`
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    # mkstemp creates the file readable and writable by its owner only
+    fd, tmp_path = tempfile.mkstemp(prefix=".checkpoint-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"version": VERSION, "time": time.time(),
+                       "computers": computers, "kernels": kernels}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def load(path):
+    """
+    Read a checkpoint.
+
+    :arg str path: file written by :func:`save`
+    :returns: the time of the checkpoint and its computers and kernels,
+        or None if there is no checkpoint or it cannot be used
+    :rtype: dict
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            data = _str(json.load(f))
+    except (IOError, ValueError) as e:
+        logger.error("Could not read checkpoint %s: %s", path, e)
+        return None
+    if data.get("version") != VERSION:
+        logger.warning("Ignoring checkpoint %s of version %s", path, data.get("version"))
+        return None
+    return data
+
+
+def same_config(a, b):
+    """
+    Whether two computer configurations are the same once written to a
+    checkpoint (which turns tuples into lists, for instance).
+
+    :rtype: bool
+    """
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
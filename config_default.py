@@ -27,9 +27,62 @@ permalink_server = {
 }
 
 max_kernel_timeout = 60*10 # 10 minutes, for interacts
+# Seconds to wait for an untrusted computer to answer a control message
+# (starting, killing or interrupting a kernel) before giving up on it
+control_msg_timeout = 20
+# Number of other computers to try if starting a kernel fails or times out
+kernel_start_retries = 1
+# How a computer is chosen for a new kernel: "least_loaded",
+# "power_of_two" (the better of two random computers) or "weighted"
+# (random, in proportion to free kernel slots times the computer's weight)
+placement_policy = "least_loaded"
+# Computers report their load with every reply; one that has not replied for
+# this many seconds is asked for a load report
+computer_stats_interval = 10
+# When every computer is full, up to admission_queue_size kernel requests wait
+# for a kernel to end, each for at most admission_max_wait seconds.  Requests
+# that would wait longer than admission_shed_wait seconds (judging by the rate
+# at which kernels end) are turned away at once with a Retry-After header.
+admission_queue_size = 100
+admission_max_wait = 30
+admission_shed_wait = 10
+# Limits on kernel requests per client IP address ("ip"), per origin of the
+# embedding page ("referer") and per API key ("key"): a rate in requests per
+# second with bursts of up to "burst" requests, and the number of kernels
+# running at a time.  A kind or limit that is left out is not enforced, and
+# None enforces no limits, e.g.
+# rate_limits = {"ip": {"rate": 0.5, "burst": 20, "kernels": 10},
+#                "referer": {"rate": 5, "burst": 200, "kernels": 300},
+#                "key": {"rate": 5, "burst": 100, "kernels": 100}}
+rate_limits = None
+# Known API keys, sent in an X-API-Key header or api_key argument, with limits
+# that override those of rate_limits["key"], e.g.
+# api_keys = {"7f3c...": {"kernels": 500}}
+api_keys = {}
+# Most kernels a page may ask for in one request (with the count argument
+# of /kernel); each counts against the rate limits like a separate request
+kernel_batch_max = 20
+# Secret for the admin API at /admin/computers, which adds, drains and removes
+# computers at runtime, and for the server state at /stats; it is passed as
+# "Authorization: Bearer <admin_token>".  Both are disabled while this is None.
+admin_token = None
+# File the web server saves its computers and kernels to (including the
+# kernels' keys), so that after a restart it adopts the running receivers and
+# kernels instead of starting new ones.  Stopping the web server with SIGTERM
+# (as a newly started web server does) leaves the kernels running for it.
+# None starts afresh every time.
+registry_checkpoint = None
+# Reserve a preforked kernel for every page that is rendered, so that its first
+# evaluation does not wait for one: the page gets a signed token for the kernel,
+# which goes back to the pool unless it is claimed within "duration" seconds.
+# At most "max_leases" kernels are reserved at a time, and "per_ip" for one
+# client IP address.  None reserves no kernels, e.g.
+# kernel_leases = {"duration": 5, "max_leases": 10, "per_ip": 1}
+kernel_leases = None
 pid_file = 'sagecell.pid'
 permalink_pid_file = 'sagecell_permalink_server.pid'
-tmp_dir = "/tmp/sagecell"
+# Kernels run in directories under tmp_dir, which should be on a tmpfs mount
+tmp_dir = "/dev/shm/sagecell" if os.path.isdir("/dev/shm") else "/tmp/sagecell"
 
 computers = []
 _default_config = {"host": "localhost",
@@ -47,10 +100,44 @@ _default_config = {"host": "localhost",
                   "resource_limits": {"RLIMIT_CPU": 30, # CPU time in seconds
                                       "RLIMIT_AS": 2048*(2**20), #Maximum address space in bytes; this sets 1024 MB
                                      },
+# Limits on the bytes and number of files a kernel may keep in its working
+# directory; a kernel exceeding them is killed.  No single file may be larger
+# than the byte limit (unless RLIMIT_FSIZE is set above).
+                  "workspace_quota": {"bytes": 100*(2**20), "files": 1000},
                   "max_kernels": 10,
+# Relative share of kernels for the "weighted" placement policy
+                  "weight": 1,
+# No new kernels are placed on a computer whose 1-minute load average per CPU
+# is above max_load or whose free memory (in bytes) is below min_free_memory
+                  "max_load": 1.5,
+                  "min_free_memory": 256*(2**20),
                   "preforked_kernels": 3,
+# The number of preforked kernels follows the rate of kernel requests and the
+# time it takes to start a kernel, between these bounds.  Preforked kernels
+# that have not been used for preforked_max_age seconds are replaced.
+                  "preforked_min": 1,
+                  "preforked_max": 6,
+                  "preforked_max_age": 60*60,
+# Import Sage and the SageCell modules once in the receiver and fork kernels
+# from it, instead of importing them in every kernel after it is forked
+                  "zygote": False,
+# Send the iopub messages of all kernels on the computer over one connection
+# to the web server, instead of one connection per kernel
+                  "forward_iopub": False,
+# Run requests to /service in forked children of this many warm service
+# kernels, which are set up once, instead of starting a kernel per request;
+# 0 gives every request a kernel of its own
+                  "service_kernels": 0,
+# The computer is this machine: start its receiver as a subprocess instead of
+# over ssh, and talk to it and its kernels over Unix domain sockets (ipc).
+# Only set this for a computer whose host is this machine.
+                  "local": False,
 # These set paramaters for a heartbeat channel checking whether a given kernel is alive.
 # Setting first_beat lower than 1.0 may cause javascript errors.
+# The computer reports kernels that exit, so pinging kernels over the network
+# (heartbeat) can be turned off; kernel deadlines are checked every
+# beat_interval either way.
+                  "heartbeat": True,
                   "beat_interval": 0.5,
                   "first_beat": 1.0}
 
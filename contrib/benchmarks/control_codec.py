@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Compare the control message codec with pickle.
+
+Encodes and decodes typical control messages between the web server and
+a receiver (requests to start, kill and interrupt kernels and to purge
+them, a kernel start reply with its connection information and load
+snapshot, and a kernel exit event) with ``control_codec``, ``pickle``
+(which the messages used to be encoded with) and ``cPickle``, and reports
+the time per message and the bytes on the wire.
+
+Run it from the root of the SageCell checkout::
+
+    python contrib/benchmarks/control_codec.py -n 20000
+"""
+import argparse
+import cPickle
+import os
+import pickle
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+import control_codec
+
+LOAD = {"time": 1381234567.123, "loadavg": 0.42, "cpus": 8,
+        "free_memory": 6123456512, "kernels": 12, "dying": 0,
+        "workspaces": {"fstype": "tmpfs", "workspaces": 12, "bytes": 1048576,
+                       "files": 40, "deleting": 0, "created": 120, "deleted": 108},
+        "fork_latency": {"p50": 0.012, "p90": 0.02, "p99": 0.05},
+        "rss": 251658240,
+        "memory": {"time": 1381234560.5,
+                   "parent": {"rss": 251658240, "pss": 120586240, "uss": 90177536, "shared": 161480704},
+                   "kernels": {"rss": 3019898880, "pss": 805306368, "uss": 503316480,
+                               "shared": 2516582400, "count": 12}}}
+
+MESSAGES = [
+    ("start_kernel", {"type": "start_kernel",
+                      "content": {"resource_limits": {0: 30, 9: 1073741824},
+                                  "workspace_quota": 104857600}}),
+    ("start_kernel reply", {"type": "success", "load": LOAD,
+                            "content": {"kernel_id": "4b9d7e3c-2a6f-4e8d-9c1b-0f5a6d7e8c9b",
+                                        "connection": {"ip": "10.0.3.15", "key": "6f1e0c2b-9d7a-4c3e-8b5f-1a2d3c4e5f60",
+                                                       "shell_port": 49153, "iopub_port": 49154,
+                                                       "stdin_port": 49155, "hb_port": 49156}}}),
+    ("kill_kernel", {"type": "kill_kernel",
+                     "content": {"kernel_id": "4b9d7e3c-2a6f-4e8d-9c1b-0f5a6d7e8c9b"}}),
+    ("interrupt_kernel", {"type": "interrupt_kernel",
+                          "content": {"kernel_id": "4b9d7e3c-2a6f-4e8d-9c1b-0f5a6d7e8c9b"}}),
+    ("purge_kernels", {"type": "purge_kernels"}),
+    ("kernel_exit event", {"type": "kernel_exit", "load": LOAD,
+                           "content": {"kernel_id": "4b9d7e3c-2a6f-4e8d-9c1b-0f5a6d7e8c9b",
+                                       "exitcode": -9, "reason": "exceeded its workspace quota"}}),
+]
+
+CODECS = [("codec", control_codec.encode, control_codec.decode),
+          ("pickle", lambda msg: pickle.dumps(msg, -1), pickle.loads),
+          ("cPickle", lambda msg: cPickle.dumps(msg, -1), cPickle.loads)]
+
+
+def timed(f, arg, count):
+    """ Seconds per call of ``f(arg)``, the best of three runs. """
+    best = float("inf")
+    for run in range(3):
+        started = time.time()
+        for i in xrange(count):
+            f(arg)
+        best = min(best, (time.time() - started) / count)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--count", type=int, default=10000,
+                        help="number of times each message is encoded and decoded")
+    args = parser.parse_args()
+    print "%-20s %-8s %8s %12s %12s" % ("message", "codec", "bytes", "encode (us)", "decode (us)")
+    for name, msg in MESSAGES:
+        for codec, encode, decode in CODECS:
+            data = encode(msg)
+            assert decode(data) == msg
+            print "%-20s %-8s %8d %12.1f %12.1f" % (name, codec, len(data),
+                1e6 * timed(encode, msg, args.count),
+                1e6 * timed(decode, data, args.count))
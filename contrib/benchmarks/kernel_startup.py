@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Compare kernel startup with and without the receiver's zygote mode.
+
+Starts ``receiver.py`` locally, once normally and once with ``--zygote``,
+asks it to start a number of kernels one after another and reports how
+long each start took and how much memory the kernels use on their own.
+Memory is read from ``/proc/<pid>/smaps`` of the kernel processes:
+``private`` is memory no other process shares (what every additional
+kernel costs) and ``pss`` is the kernel's proportional share of all the
+memory it maps.
+
+Run it with the Python the receiver would use, from the root of the
+SageCell checkout::
+
+    sage -python contrib/benchmarks/kernel_startup.py -n 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import zmq
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+import control_codec
+
+
+def children(pid):
+    """ Process ids of the children of a process. """
+    result = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name may contain spaces, so split after it
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            result.append(int(entry))
+    return result
+
+
+def memory(pid):
+    """ Private and proportional set size of a process, in bytes. """
+    private = pss = 0
+    with open("/proc/%d/smaps" % pid) as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                private += int(line.split()[1])
+            elif line.startswith("Pss:"):
+                pss += int(line.split()[1])
+    return private * 1024, pss * 1024
+
+
+class Receiver(object):
+    """ A receiver.py process and a socket to talk to it. """
+    def __init__(self, zygote):
+        self.tmp_dir = tempfile.mkdtemp()
+        args = [sys.executable, os.path.join(ROOT, "receiver.py"),
+                "127.0.0.1", "benchmark", self.tmp_dir]
+        if zygote:
+            args.append("--zygote")
+        started = time.time()
+        self.process = subprocess.Popen(args, cwd=ROOT, stdout=subprocess.PIPE)
+        endpoint = self.process.stdout.readline().strip()
+        self.process.stdout.readline() # sage mode
+        self.ready_time = time.time() - started
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(endpoint)
+        self.msg_id = 0
+
+    def send(self, msg_type, content=None):
+        self.msg_id += 1
+        msg = {"type": msg_type, "content": content or {}}
+        self.socket.send_multipart(["benchmark", str(self.msg_id), control_codec.encode(msg)])
+        while True:
+            source, msg_id, reply = self.socket.recv_multipart()
+            if msg_id == str(self.msg_id):
+                return control_codec.decode(reply)
+
+    def close(self):
+        self.send("remove_computer")
+        self.process.wait()
+        self.socket.close()
+        self.context.term()
+
+
+def run(zygote, count):
+    receiver = Receiver(zygote)
+    try:
+        latencies = []
+        for i in range(count):
+            started = time.time()
+            reply = receiver.send("start_kernel")
+            latencies.append(time.time() - started)
+            if reply["type"] != "success":
+                raise RuntimeError("Could not start a kernel: %s" % reply["content"])
+        time.sleep(1) # let the kernels settle
+        mem = [memory(pid) for pid in children(receiver.process.pid)]
+        return {"ready": receiver.ready_time,
+                "latencies": sorted(latencies),
+                "private": [m[0] for m in mem],
+                "pss": [m[1] for m in mem],
+                "receiver": memory(receiver.process.pid)}
+    finally:
+        receiver.close()
+
+
+def median(values):
+    return values[len(values) // 2] if values else float("nan")
+
+
+def report(results):
+    rows = [("receiver ready (s)", lambda r: r["ready"]),
+            ("kernel start p50 (ms)", lambda r: 1000 * median(r["latencies"])),
+            ("kernel start max (ms)", lambda r: 1000 * r["latencies"][-1]),
+            ("kernel private p50 (MB)", lambda r: median(sorted(r["private"])) / 2.0**20),
+            ("kernel PSS p50 (MB)", lambda r: median(sorted(r["pss"])) / 2.0**20),
+            ("receiver private (MB)", lambda r: r["receiver"][0] / 2.0**20)]
+    print "%-26s %12s %12s" % ("", "fork", "zygote")
+    for name, value in rows:
+        print "%-26s %12.1f %12.1f" % (name, value(results[False]), value(results[True]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--kernels", type=int, default=10,
+                        help="number of kernels to start in each mode")
+    args = parser.parse_args()
+    results = {}
+    for zygote in (False, True):
+        results[zygote] = run(zygote, args.kernels)
+    report(results)
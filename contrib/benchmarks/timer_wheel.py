@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compare the heartbeat timers of many kernels on the timer wheel with one
+Tornado PeriodicCallback per kernel.
+
+Simulates ``-n`` open kernel connections that each "ping" (increment a
+counter) every ``--interval`` seconds, starting at random offsets, on an
+IOLoop that runs for ``--duration`` seconds. For each way of driving the
+timers it reports the CPU time the process spent per second of the run,
+the pings that were sent and, for the wheel, the mean and largest time
+spent per tick and how late the ticks ran (see
+:meth:`timer_wheel.TimerWheel.status`).
+
+Run it from the root of the SageCell checkout::
+
+    python contrib/benchmarks/timer_wheel.py -n 5000 --interval 0.5
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+from zmq.eventloop import ioloop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+from timer_wheel import TimerWheel
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(loop, duration):
+    """ Run the loop for ``duration`` seconds; returns CPU seconds per second. """
+    started, cpu = time.time(), cpu_time()
+    loop.add_timeout(started + duration, loop.stop)
+    loop.start()
+    return (cpu_time() - cpu) / (time.time() - started)
+
+
+def wheel(count, interval, duration):
+    pings = [0]
+    wheel = TimerWheel()
+    def beat():
+        pings[0] += 1
+        wheel.schedule(interval, beat)
+    for i in xrange(count):
+        wheel.schedule(random.uniform(0, interval), beat)
+    loop = ioloop.IOLoop.current()
+    wheel.start()
+    load = run(loop, duration)
+    wheel.stop()
+    return load, pings[0], wheel.status()
+
+
+def periodic(count, interval, duration):
+    pings = [0]
+    loop = ioloop.IOLoop.current()
+    def beat():
+        pings[0] += 1
+    callbacks = [ioloop.PeriodicCallback(beat, interval * 1000) for i in xrange(count)]
+    for callback in callbacks:
+        # the first beat of every kernel, as IOPubHandler used to delay it
+        loop.add_timeout(time.time() + random.uniform(0, interval), callback.start)
+    load = run(loop, duration)
+    for callback in callbacks:
+        callback.stop()
+    return load, pings[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--count", type=int, default=5000,
+                        help="number of kernels")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="seconds between the pings of a kernel")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds each way of driving the timers runs")
+    args = parser.parse_args()
+    load, pings, status = wheel(args.count, args.interval, args.duration)
+    print "%-9s %8s %10s %14s %14s %14s" % ("timers", "cpu", "pings",
+                                           "tick (ms)", "max tick (ms)", "max lag (ms)")
+    print "%-9s %7.1f%% %10d %14.2f %14.2f %14.2f" % ("wheel", 100 * load, pings,
+        1e3 * status["cost"], 1e3 * status["max_cost"], 1e3 * status["max_lag"])
+    load, pings = periodic(args.count, args.interval, args.duration)
+    print "%-9s %7.1f%% %10d" % ("periodic", 100 * load, pings)
@@ -0,0 +1,222 @@
+"""
+The binary encoding of the control messages between the web server and
+the receivers of its computers (see :mod:`sender` and :mod:`receiver`).
+
+A control message is a dictionary of plain data: None, booleans,
+integers, floats, byte and unicode strings, lists, tuples and
+dictionaries. Each value is encoded as a one-byte tag followed by its
+data; integers take 1, 4 or 8 bytes depending on their size, and the
+message types, dictionary keys and other strings that are in almost every
+message (:data:`WORDS`) take two bytes. An encoded message starts with a
+magic byte and the format :data:`VERSION`, which changes whenever
+:data:`WORDS` or the tags change.
+
+Unlike pickle, which the messages used to be encoded with, decoding only
+ever builds these plain types, so a compromised computer cannot make the
+web server run code; malformed data raises :exc:`CodecError`.
+"""
+import struct
+
+#: Version of the format, see :data:`WORDS`
+VERSION = 1
+_MAGIC = 0xc5
+_HEADER = struct.pack(">BB", _MAGIC, VERSION)
+
+#: Strings encoded as a tag and their index; appending to or changing
+#: this tuple requires a new :data:`VERSION`
+WORDS = (
+    # envelope
+    "type", "content", "load", "success", "error",
+    # message types
+    "start_kernel", "kill_kernel", "interrupt_kernel", "restart_kernel",
+    "purge_kernels", "remove_computer", "stats", "list_kernels",
+    "kernel_exit", "invalid_message",
+    # message contents
+    "kernel_id", "kernels", "status", "resource_limits", "workspace_quota",
+    "exitcode", "reason", "kernel_memory",
+    # kernel connection information
+    "connection", "ip", "key", "transport", "tcp", "ipc", "shell_port",
+    "iopub_port", "stdin_port", "hb_port", "forward_endpoint",
+    # load snapshots
+    "time", "loadavg", "cpus", "free_memory", "dying", "workspaces",
+    "fork_latency", "p50", "p90", "p99", "rss", "pss", "uss", "shared",
+    "count", "memory", "parent",
+)
+assert len(WORDS) < 256
+_WORD_BYTES = dict((word, "w" + chr(i)) for i, word in enumerate(WORDS))
+
+_byte = struct.Struct(">b")
+_int = struct.Struct(">i")
+_long = struct.Struct(">q")
+_float = struct.Struct(">d")
+_length = struct.Struct(">I")
+
+
+class CodecError(ValueError):
+    """ Data that is not an encoded control message of this version. """
+
+
+def encode(msg):
+    """
+    :arg msg: the message, made of the types listed in :mod:`control_codec`
+    :returns: the encoded message
+    :rtype: str
+    :raises TypeError: if the message contains another type
+    """
+    chunks = [_HEADER]
+    _encode(msg, chunks.append)
+    return "".join(chunks)
+
+
+def _encode(value, out):
+    t = type(value)
+    if t is str:
+        word = _WORD_BYTES.get(value)
+        if word is not None:
+            out(word)
+        elif len(value) < 256:
+            out("s" + chr(len(value)))
+            out(value)
+        else:
+            out("S" + _length.pack(len(value)))
+            out(value)
+    elif t is dict:
+        out("m" + _length.pack(len(value)))
+        for k, v in value.iteritems():
+            _encode(k, out)
+            _encode(v, out)
+    elif t is int or t is long:
+        if -128 <= value < 128:
+            out("b" + _byte.pack(value))
+        elif -2**31 <= value < 2**31:
+            out("i" + _int.pack(value))
+        elif -2**63 <= value < 2**63:
+            out("q" + _long.pack(value))
+        else:
+            digits = str(value)
+            out("L" + chr(len(digits)))
+            out(digits)
+    elif t is float:
+        out("d" + _float.pack(value))
+    elif value is None:
+        out("N")
+    elif value is True:
+        out("T")
+    elif value is False:
+        out("F")
+    elif t is unicode:
+        data = value.encode("utf-8")
+        out("U" + _length.pack(len(data)))
+        out(data)
+    elif t is list or t is tuple:
+        out(("l" if t is list else "t") + _length.pack(len(value)))
+        for v in value:
+            _encode(v, out)
+    else:
+        raise TypeError("Cannot encode %r in a control message" % (value,))
+
+
+def decode(data):
+    """
+    :arg data: an encoded message, as a string or a :func:`buffer` of
+        one; it is read in place rather than copied piece by piece
+    :returns: the message
+    :raises CodecError: if ``data`` is not an encoded message of this
+        version
+    """
+    if len(data) < 2 or ord(data[0]) != _MAGIC:
+        raise CodecError("Not a control message")
+    if ord(data[1]) != VERSION:
+        raise CodecError("Control message of version %d, expected %d"
+                         % (ord(data[1]), VERSION))
+    try:
+        msg, pos = _decode(data, 2)
+    except CodecError:
+        raise
+    except (IndexError, KeyError, TypeError, struct.error,
+            UnicodeDecodeError, RuntimeError) as e:
+        # truncated data, an unknown tag or word, an unhashable key or
+        # too deep nesting
+        raise CodecError("Malformed control message: %r" % (e,))
+    if pos != len(data):
+        raise CodecError("%d bytes after the end of the control message" % (len(data) - pos))
+    return msg
+
+
+def _decode(data, pos):
+    return _DECODERS[data[pos]](data, pos + 1)
+
+def _string(data, start, end):
+    if end > len(data):
+        raise CodecError("Truncated string")
+    return data[start:end]
+
+def _decode_word(data, pos):
+    return WORDS[ord(data[pos])], pos + 1
+
+def _decode_short_string(data, pos):
+    end = pos + 1 + ord(data[pos])
+    return _string(data, pos + 1, end), end
+
+def _decode_string(data, pos):
+    end = pos + 4 + _length.unpack_from(data, pos)[0]
+    return _string(data, pos + 4, end), end
+
+def _decode_unicode(data, pos):
+    value, end = _decode_string(data, pos)
+    return value.decode("utf-8"), end
+
+def _decode_dict(data, pos):
+    count = _length.unpack_from(data, pos)[0]
+    pos += 4
+    value = {}
+    for i in xrange(count):
+        k, pos = _decode(data, pos)
+        value[k], pos = _decode(data, pos)
+    return value, pos
+
+def _decode_list(data, pos):
+    count = _length.unpack_from(data, pos)[0]
+    pos += 4
+    value = []
+    for i in xrange(count):
+        v, pos = _decode(data, pos)
+        value.append(v)
+    return value, pos
+
+def _decode_tuple(data, pos):
+    value, pos = _decode_list(data, pos)
+    return tuple(value), pos
+
+def _decode_long_digits(data, pos):
+    end = pos + 1 + ord(data[pos])
+    try:
+        return int(_string(data, pos + 1, end)), end
+    except ValueError:
+        raise CodecError("Malformed integer")
+
+def _unpacker(fmt):
+    def decode(data, pos):
+        return fmt.unpack_from(data, pos)[0], pos + fmt.size
+    return decode
+
+def _constant(value):
+    return lambda data, pos: (value, pos)
+
+_DECODERS = {
+    "w": _decode_word,
+    "s": _decode_short_string,
+    "S": _decode_string,
+    "U": _decode_unicode,
+    "m": _decode_dict,
+    "l": _decode_list,
+    "t": _decode_tuple,
+    "b": _unpacker(_byte),
+    "i": _unpacker(_int),
+    "q": _unpacker(_long),
+    "L": _decode_long_digits,
+    "d": _unpacker(_float),
+    "N": _constant(None),
+    "T": _constant(True),
+    "F": _constant(False),
+}
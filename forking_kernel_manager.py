@@ -2,6 +2,8 @@ import uuid
 import os
 import signal
 import resource
+import shutil
+import time
 try:
     from IPython.kernel.zmq.kernelapp import IPKernelApp
 except ImportError:
@@ -11,6 +13,10 @@ from IPython.config.loader import Config
 from multiprocessing import Process, Pipe
 
 from log import kernel_logger
+from workspace import Workspaces
+
+# Seconds a kernel gets to exit after SIGTERM before it is sent SIGKILL
+KILL_GRACE_PERIOD = 5.0
 
 
 def makedirs(path):
@@ -21,21 +27,79 @@ def makedirs(path):
         if exc.errno == errno.EEXIST:
             pass
         else: raise
-    
+
+def process_memory(pid):
+    """ Memory use of a process, accounting for pages shared copy-on-write
+    with the process it was forked from.
+
+    Reads ``/proc/<pid>/smaps_rollup``, or ``/proc/<pid>/smaps`` on Linux
+    kernels older than 4.14.
+
+    :arg int pid: process id
+    :returns: resident set size (``rss``), proportional set size (``pss``,
+        every shared page divided among the processes sharing it), unique
+        set size (``uss``, pages used only by this process) and ``shared``
+        resident bytes, or None if the process does not exist
+    :rtype: dict
+    """
+    fields = {"Rss:": 0, "Pss:": 0, "Private_Clean:": 0, "Private_Dirty:": 0}
+    for name in ("smaps_rollup", "smaps"):
+        try:
+            f = open("/proc/%d/%s" % (pid, name))
+        except IOError:
+            continue
+        with f:
+            for line in f:
+                field = line.split(None, 1)[0]
+                if field in fields:
+                    fields[field] += int(line.split()[1]) * 1024
+        uss = fields["Private_Clean:"] + fields["Private_Dirty:"]
+        return {"rss": fields["Rss:"], "pss": fields["Pss:"], "uss": uss,
+                "shared": fields["Rss:"] - uss}
+    return None
+
 class KernelError(Exception):
     """
     An error relating to starting up kernels
     """
     pass
 
+class KernelKilled(KernelError):
+    """
+    A kernel was killed before it finished starting
+    """
+    pass
+
 class ForkingKernelManager(object):
-    """ A class for managing multiple kernels and forking on the untrusted side. """
-    def __init__(self, ip, update_function=None, tmp_dir = None):
+    """ A class for managing multiple kernels and forking on the untrusted side.
+
+    :arg poll_loop.PollLoop loop: event loop used by :meth:`start_kernel_async`
+        to wait for forked kernels and by :meth:`kill_process` to reap
+        killed kernels without blocking
+    :arg str transport: ``"tcp"`` or ``"ipc"``; with ``"ipc"``, the kernels
+        bind their sockets to files in ``tmp_dir/.sockets/<kernel id>``
+        instead of to TCP ports on ``ip``
+    """
+    def __init__(self, ip, update_function=None, tmp_dir = None, loop = None,
+                 transport = "tcp"):
         self.kernels = {}
+        self.starting = {} # kernel_id: (proc, pipe, timer, errback) of kernels being started
+        self.dying = {} # pid: (proc, SIGKILL timer, callback, time of SIGTERM) of killed kernels
+        # Called as exit_callback(kernel_id, exitcode, reason) when a running
+        # kernel exits on its own or is killed by this manager
+        self.exit_callback = None
         self.ip = ip
         self.update_function = update_function
         self.dir = tmp_dir
+        self.loop = loop
+        self.transport = transport
+        if loop is not None:
+            loop.add_signal_handler(signal.SIGCHLD, self.reap)
         makedirs(self.dir)
+        # Outside the working directories, whose files are sent to the
+        # browser and count against the workspace quota
+        self.sockets = os.path.join(self.dir, ".sockets")
+        self.workspaces = Workspaces(self.dir, loop, exceeded=self._quota_exceeded)
 
     def fork_kernel(self, config, pipe, resource_limits):
         """ A function to be set as the target for the new kernel processes forked in ForkingKernelManager.start_kernel. This method forks and initializes a new kernel, uses the update_function to update the kernel's namespace, sets resource limits for the kernel, and sends kernel connection information through the Pipe object.
@@ -45,10 +109,17 @@ class ForkingKernelManager(object):
         :arg dict resource_limits: a dict with keys resource.RLIMIT_* (see config_default documentation for explanation of valid options) and values of the limit for the given resource to be set in the kernel process
         """
         os.setpgrp()
+        if self.loop is not None:
+            self.loop.reset_signals()
         logger = kernel_logger.getChild(str(uuid.uuid4())[:4])
         logger.debug("kernel forked; now starting and configuring")
         try:
-            ka = IPKernelApp.instance(config=config, ip=config["ip"])
+            if config.get("transport", "tcp") == "tcp":
+                ka = IPKernelApp.instance(config=config, ip=config["ip"])
+            else:
+                # With ipc, ip is the path prefix of the socket files
+                ka = IPKernelApp.instance(config=config, ip=config["ip"],
+                                          transport=config["transport"])
             from namespace import InstrumentedNamespace
             ka.user_ns = InstrumentedNamespace()
             # The following line on UNIX systems (and we are unlikely to run on
@@ -73,7 +144,8 @@ class ForkingKernelManager(object):
         for r, limit in resource_limits.iteritems():
             resource.setrlimit(getattr(resource, r), (limit, limit))
         pipe.send({"ip": ka.ip, "key": ka.session.key, "shell_port": ka.shell_port,
-                "stdin_port": ka.stdin_port, "hb_port": ka.hb_port, "iopub_port": ka.iopub_port})
+                "stdin_port": ka.stdin_port, "hb_port": ka.hb_port, "iopub_port": ka.iopub_port,
+                "transport": getattr(ka, "transport", "tcp")})
         pipe.close()
         # The following line will erase JSON connection file with ports and
         # other numbers. Since we do not reuse the kernels, we don't really need
@@ -86,9 +158,48 @@ class ForkingKernelManager(object):
         ka.cleanup_connection_file()
         ka.start()
 
-    def start_kernel(self, kernel_id=None, config=None, resource_limits=None):
+    def _fork(self, kernel_id, config, resource_limits, workspace_quota=None):
+        """ Fork a kernel process in its own directory.
+
+        :arg dict workspace_quota: limits on the ``bytes`` and number of
+            ``files`` in the kernel's directory, see :class:`workspace.Workspaces`
+        :returns: the process and the parent end of its connection pipe
+        """
+        dir = self.workspaces.create(kernel_id, workspace_quota)
+        if self.transport == "ipc":
+            makedirs(os.path.join(self.sockets, kernel_id))
+        if config is None:
+            if self.transport == "ipc":
+                config = Config({"ip": os.path.join(self.sockets, kernel_id, "kernel"),
+                                 "transport": "ipc"})
+            else:
+                config = Config({"ip": self.ip})
+        if resource_limits is None:
+            resource_limits = {}
+        config.HistoryManager.enabled = False
+        if workspace_quota and workspace_quota.get("bytes") \
+                and "RLIMIT_FSIZE" not in resource_limits:
+            # No single file may be larger than the whole quota
+            resource_limits = dict(resource_limits, RLIMIT_FSIZE=workspace_quota["bytes"])
+
+        currdir = os.getcwd()
+        os.chdir(dir)
+
+        p, q = Pipe()
+        proc = Process(target=self.fork_kernel, args=(config, q, resource_limits))
+        proc.start()
+        # Only the kernel holds the other end now, so we see EOF if it dies
+        q.close()
+        os.chdir(currdir)
+        return proc, p
+
+    def start_kernel(self, kernel_id=None, config=None, resource_limits=None,
+                     workspace_quota=None):
         """ A function for starting new kernels by forking.
 
+        This blocks until the kernel has started; see
+        :meth:`start_kernel_async` for the non-blocking variant.
+
         :arg str kernel_id: the id of the kernel to be started.
             If no id is passed, a uuid will be generated.
         :arg Ipython.config.loader config: kernel configuration.
@@ -96,6 +207,8 @@ class ForkingKernelManager(object):
             (see config_default documentation for explanation of valid options)
             and values of the limit for the given resource to be set in the
             kernel process
+        :arg dict workspace_quota: limits on the ``bytes`` and number of
+            ``files`` in the kernel's working directory
         :returns: kernel id and connection information which includes the
             kernel's ip, session key, and shell, heartbeat, stdin, and iopub
             port numbers
@@ -103,30 +216,13 @@ class ForkingKernelManager(object):
         """
         if kernel_id is None:
             kernel_id = str(uuid.uuid4())
-        if config is None:
-            config = Config({"ip": self.ip})
-        if resource_limits is None:
-            resource_limits = {}
-        config.HistoryManager.enabled = False
-
-        dir = os.path.join(self.dir, kernel_id)
-        try:
-            os.mkdir(dir)
-        except OSError as e:
-            # TODO: take care of race conditions and other problems with us
-            # using an 'unclean' directory
-            pass
-        currdir = os.getcwd()
-        os.chdir(dir)
-
-        p, q = Pipe()
-        proc = Process(target=self.fork_kernel, args=(config, q, resource_limits))
-        proc.start()
-        os.chdir(currdir)
-        # todo: yield back to the message processing while we wait
+        proc, p = self._fork(kernel_id, config, resource_limits, workspace_quota)
         for i in range(5):
             if p.poll(1):
-                connection = p.recv()
+                try:
+                    connection = p.recv()
+                except EOFError:
+                    break
                 p.close()
                 self.kernels[kernel_id] = (proc, connection)
                 return {"kernel_id": kernel_id, "connection": connection}
@@ -135,35 +231,210 @@ class ForkingKernelManager(object):
                                    % (kernel_id[:4], i))
         p.close()
         self.kill_process(proc)
+        self._release(kernel_id, retain=False)
         raise KernelError("Kernel start timeout.")
 
-    def kill_process(self, proc):
+    def start_kernel_async(self, callback, errback, kernel_id=None,
+                           config=None, resource_limits=None, timeout=5.0,
+                           workspace_quota=None):
+        """ Start a new kernel by forking without waiting for it.
+
+        The event loop watches the kernel's connection pipe, so any number
+        of kernels can be starting at the same time.
+
+        :arg callable callback: called with the kernel id and connection
+            information (as returned by :meth:`start_kernel`) once the
+            kernel has started
+        :arg callable errback: called with a :class:`KernelError` if the
+            kernel dies or does not start within ``timeout`` seconds, or
+            with a :class:`KernelKilled` if it is killed while starting
+        :arg float timeout: seconds to wait for the kernel
+        :returns: the kernel id
+        :rtype: str
+
+        The remaining arguments are as for :meth:`start_kernel`.
+        """
+        if kernel_id is None:
+            kernel_id = str(uuid.uuid4())
+        proc, p = self._fork(kernel_id, config, resource_limits, workspace_quota)
+        fd = p.fileno()
+
+        def done():
+            self.loop.remove_handler(fd)
+            self.loop.cancel(timer)
+            del self.starting[kernel_id]
+
+        def ready():
+            done()
+            try:
+                connection = p.recv()
+            except EOFError:
+                p.close()
+                self.kill_process(proc)
+                self._release(kernel_id, retain=False)
+                errback(KernelError("Kernel died while starting."))
+                return
+            p.close()
+            self.kernels[kernel_id] = (proc, connection)
+            callback({"kernel_id": kernel_id, "connection": connection})
+
+        def timed_out():
+            done()
+            kernel_logger.info("Kernel %s did not start after %s seconds."
+                               % (kernel_id[:4], timeout))
+            p.close()
+            self.kill_process(proc)
+            self._release(kernel_id, retain=False)
+            errback(KernelError("Kernel start timeout."))
+
+        timer = self.loop.call_later(timeout, timed_out)
+        self.loop.add_handler(fd, ready)
+        self.starting[kernel_id] = (proc, p, done, errback)
+        return kernel_id
+
+    def memory_usage(self):
+        """ Sample the memory use of this process and of every kernel.
+
+        :returns: :func:`process_memory` of this process as ``parent`` and
+            of every running kernel as ``kernels`` (keyed by kernel id)
+        :rtype: dict
+        """
+        kernels = {}
+        for kernel_id, (proc, connection) in self.kernels.items():
+            usage = process_memory(proc.pid)
+            if usage is not None:
+                kernels[kernel_id] = usage
+        return {"parent": process_memory(os.getpid()), "kernels": kernels}
+
+    def _signal(self, proc, signum):
+        """ Send a signal to the process group of a kernel. """
         try:
-            os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-            # todo: yield back to message processing loop while we join
-            proc.join()
-        except Exception as e:
+            # The kernel leads its own process group (see fork_kernel), unless
+            # it is killed before it gets to call setpgrp
+            try:
+                os.killpg(proc.pid, signum)
+            except OSError:
+                os.kill(proc.pid, signum)
+        except OSError as e:
             # On Unix, we may get an ESRCH error if the process has already
             # terminated. Ignore it.
             from errno import ESRCH
-            if e.errno !=  ESRCH:
+            if e.errno != ESRCH:
                 return False
         return True
 
-    def kill_kernel(self, kernel_id):
+    def kill_process(self, proc, callback=None):
+        """ End a kernel process without waiting for it.
+
+        The kernel's process group is sent SIGTERM, and SIGKILL if the
+        kernel is still running after :data:`KILL_GRACE_PERIOD` seconds.
+        The process is reaped by :meth:`reap` when it exits. Without an
+        event loop this blocks until the process has exited instead.
+
+        :arg multiprocessing.Process proc: the kernel process
+        :arg callable callback: called with the exit code of the process
+            once it has exited
+        :returns: whether the process could be signalled
+        :rtype: bool
+        """
+        if not self._signal(proc, signal.SIGTERM):
+            return False
+        if self.loop is None:
+            proc.join(KILL_GRACE_PERIOD)
+            if proc.exitcode is None:
+                self._signal(proc, signal.SIGKILL)
+                proc.join()
+            if callback is not None:
+                callback(proc.exitcode)
+            return True
+
+        def escalate():
+            if proc.pid in self.dying:
+                kernel_logger.info("Process %d ignored SIGTERM; sending SIGKILL", proc.pid)
+                self._signal(proc, signal.SIGKILL)
+
+        timer = self.loop.call_later(KILL_GRACE_PERIOD, escalate)
+        self.dying[proc.pid] = (proc, timer, callback, time.time())
+        # The process may have exited before the SIGCHLD handler was set up
+        self.reap()
+        return True
+
+    def reap(self):
+        """ Collect the exit status of every kernel process that has exited.
+
+        This is called from the event loop when the receiver gets SIGCHLD.
+        """
+        for pid, (proc, timer, callback, killed) in self.dying.items():
+            # Process.exitcode reaps the process with waitpid(WNOHANG)
+            if proc.exitcode is not None:
+                del self.dying[pid]
+                self.loop.cancel(timer)
+                kernel_logger.debug("Process %d exited with %d after %.3fs",
+                                    pid, proc.exitcode, time.time() - killed)
+                if callback is not None:
+                    callback(proc.exitcode)
+        for kernel_id, (proc, connection) in self.kernels.items():
+            if proc.exitcode is not None:
+                del self.kernels[kernel_id]
+                self._release(kernel_id)
+                self._exited(kernel_id, proc.exitcode, "exited")
+
+    def _release(self, kernel_id, retain=True):
+        """ Clean up after a kernel that ended or did not start. """
+        self.workspaces.release(kernel_id, retain)
+        if self.transport == "ipc":
+            shutil.rmtree(os.path.join(self.sockets, kernel_id), ignore_errors=True)
+
+    def _exited(self, kernel_id, exitcode, reason):
+        kernel_logger.info("Kernel %s %s with %s", kernel_id[:4], reason, exitcode)
+        if self.exit_callback is not None:
+            self.exit_callback(kernel_id, exitcode, reason)
+
+    def wait_dying(self):
+        """ Block until every killed kernel process has exited, e.g. before
+        the event loop goes away.
+        """
+        for pid, (proc, timer, callback, killed) in self.dying.items():
+            proc.join(max(killed + KILL_GRACE_PERIOD - time.time(), 0))
+            if proc.exitcode is None:
+                self._signal(proc, signal.SIGKILL)
+                proc.join()
+        self.reap()
+
+    def kill_kernel(self, kernel_id, callback=None):
         """ A function for ending running kernel processes.
 
+        The kernel is signalled and forgotten immediately; see
+        :meth:`kill_process`.
+
         :arg str kernel_id: the id of the kernel to be killed
+        :arg callable callback: called with the exit code of the kernel
+            process once it has exited
         :returns: whether or not the kernel process was successfully killed
         :rtype: bool
         """
         if kernel_id in self.kernels:
             proc = self.kernels[kernel_id][0]
-            if self.kill_process(proc):
+            if self.kill_process(proc, callback):
                 del self.kernels[kernel_id]
+                self._release(kernel_id)
                 return True
+        elif kernel_id in self.starting:
+            proc, p, done, errback = self.starting[kernel_id]
+            done()
+            p.close()
+            self.kill_process(proc, callback)
+            self._release(kernel_id, retain=False)
+            errback(KernelKilled("Kernel killed while starting."))
+            return True
         return False
 
+    def _quota_exceeded(self, kernel_id, usage):
+        # the files that broke the quota are not kept
+        self._release(kernel_id, retain=False)
+        self.kill_kernel(kernel_id, lambda exitcode:
+            self._exited(kernel_id, exitcode, "exceeded its workspace quota"))
+
     def interrupt_kernel(self, kernel_id):
         """ A function for interrupting running kernel processes.
 
@@ -190,8 +461,12 @@ class ForkingKernelManager(object):
         :rtype: dict
         """
         ports = self.kernels[kernel_id][1]
+        transport = ports.get("transport", "tcp")
         self.kill_kernel(kernel_id)
-        return self.start_kernel(kernel_id, Config({"IPKernelApp": ports, "ip": self.ip}))
+        # with ipc, the "ip" of the connection is the path prefix of the socket files
+        return self.start_kernel(kernel_id, Config({
+            "IPKernelApp": ports, "transport": transport,
+            "ip": self.ip if transport == "tcp" else ports["ip"]}))
 
 if __name__ == "__main__":
     def f(a,b,c,d):
@@ -1,4 +1,4 @@
-import time, urllib, zlib, base64, uuid, json, os.path
+import time, urllib, zlib, base64, uuid, json, os.path, hmac
 
 import tornado.web
 import tornado.websocket
@@ -27,6 +27,75 @@ cron = re.compile("^print [-]?\d+\+[-]?\d+$")
 from log import StatsMessage, logger, stats_logger
 
 
+def charge(limits, remote_ip, referer, api_key, count=1):
+    """
+    Charges a kernel request to its client's keys (see :mod:`ratelimit`).
+
+    :arg ratelimit.RateLimits limits: the kernel manager's limits
+    :arg int count: number of kernels requested
+    :returns: the keys, to be passed to ``limits.assign`` or
+        ``limits.release``, and None, or None and the HTTP status (403 for
+        an unknown API key, 429 for a client over its limits), error
+        message and seconds after which to retry (or None) if the request
+        is refused
+    :rtype: tuple
+    """
+    try:
+        keys = limits.keys(remote_ip, referer, api_key)
+    except KeyError:
+        return None, (403, "Unknown API key", None)
+    refusal = limits.acquire(keys, count)
+    if refusal is None:
+        return keys, None
+    (kind, value), limit, retry_after = refusal
+    logger.info("Refused kernel request of %s %s: over its %s limit", kind, value, limit)
+    if retry_after is not None:
+        retry_after = int(math.ceil(retry_after))
+    if limit == "kernels":
+        return None, (429, "Too many kernels running for this %s" % (kind,), retry_after)
+    return None, (429, "Too many kernel requests from this %s" % (kind,), retry_after)
+
+
+def charge_client(handler, count=1):
+    """
+    Charges a kernel request to its client's keys with :func:`charge`.
+
+    :arg tornado.web.RequestHandler handler: the handler of the request
+    :arg int count: number of kernels requested
+    :returns: the keys and None, or None and an error message if the
+        request is refused; the status and ``Retry-After`` header are then
+        set
+    :rtype: tuple
+    """
+    api_key = handler.request.headers.get("X-API-Key") or handler.get_argument("api_key", None)
+    keys, refusal = charge(handler.application.km.limits, handler.request.remote_ip,
+                           handler.request.headers.get("Referer", ""), api_key, count)
+    if refusal is None:
+        return keys, None
+    status, error, retry_after = refusal
+    handler.set_status(status)
+    if retry_after is not None:
+        handler.set_header("Retry-After", retry_after)
+    return None, error
+
+
+def parse_timeout(timeout):
+    """
+    :returns: the idle timeout a client asked for in seconds, or None if
+        it did not ask for one or asked for an invalid one
+    :rtype: float
+    """
+    if timeout is None:
+        return None
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(timeout) or timeout < 0:
+        return None
+    return timeout
+
+
 class RootHandler(tornado.web.RequestHandler):
     """
     Root URL request handler.
@@ -41,6 +110,9 @@ class RootHandler(tornado.web.RequestHandler):
     ``<root_url>?z=<base64>`` loads base64-compressed code
     ```<root_url>?q=<uuid>`` loads code from a database based
     upon a unique identifying permalink (uuid4-based)
+
+    With ``kernel_leases`` configured, the page also gets a lease on a
+    preforked kernel for its first evaluation (see :mod:`lease`).
     """
     @tornado.web.asynchronous
     def get(self):
@@ -103,7 +175,9 @@ class RootHandler(tornado.web.RequestHandler):
             if isinstance(interacts, unicode):
                 interacts = interacts.encode("utf8")
             interacts = urllib.quote(interacts)
-        self.render("root.html", code=code, lang=language, interacts=interacts, autoeval=autoeval)
+        lease = self.application.km.lease(self.request.remote_ip)
+        self.render("root.html", code=code, lang=language, interacts=interacts,
+                    autoeval=autoeval, lease=lease)
 
     def options(self):
         self.set_status(200)
@@ -126,6 +200,14 @@ class KernelHandler(tornado.web.RequestHandler):
     
     ``<ws_url>/iopub`` is the expected iopub stream url
     ``<ws_url>/shell`` is the expected shell stream url
+
+    A page with many cells can ask for ``count`` kernels at once; the
+    reply then also lists the ids of all kernels that were started
+    (``ids``), which may be fewer than were asked for.
+
+    A page that got a lease on a kernel when it was rendered passes its
+    token as ``lease`` and gets the leased kernel if the lease is still
+    valid.
     """
     @tornado.web.asynchronous
     @gen.engine
@@ -147,16 +229,52 @@ class KernelHandler(tornado.web.RequestHandler):
             ws_url = "%s://%s/" % (proto, host)
             km = self.application.km
             logger.info("Starting session: %s"%timer)
-            timeout = self.get_argument("timeout", None)
-            if timeout is not None:
-                timeout = float(timeout)
-                if math.isnan(timeout) or timeout<0:
-                    timeout = None
-            kernel_id = yield gen.Task(km.new_session_async,
-                                       referer = self.request.headers.get('Referer',''),
-                                       remote_ip = self.request.remote_ip,
-                                       timeout = timeout)
-            data = {"ws_url": ws_url, "id": kernel_id}
+            timeout = parse_timeout(self.get_argument("timeout", None))
+            count = self.get_argument("count", None)
+            if count is not None:
+                batch_max = config.get_config("kernel_batch_max")
+                try:
+                    count = int(count)
+                except ValueError:
+                    count = 0
+                if not 0 < count <= batch_max:
+                    self.set_status(400)
+                    self.write(self.permissions(
+                        {"error": "count must be between 1 and %d" % batch_max}))
+                    self.finish()
+                    return
+            keys, error = charge_client(self, count or 1)
+            if keys is None:
+                self.write(self.permissions({"error": error}))
+                self.finish()
+                return
+            referer = self.request.headers.get('Referer','')
+            if count is None:
+                kernel_id = km.claim_lease(self.get_argument("lease", None), referer,
+                                           self.request.remote_ip, timeout)
+                if kernel_id is None:
+                    kernel_id = yield gen.Task(km.new_session_async,
+                                               referer = referer,
+                                               remote_ip = self.request.remote_ip,
+                                               timeout = timeout)
+                kernel_ids = [kernel_id] if kernel_id else []
+            else:
+                kernel_ids = yield gen.Task(km.new_sessions_async, count,
+                                            referer = referer,
+                                            remote_ip = self.request.remote_ip,
+                                            timeout = timeout)
+            for kernel_id in kernel_ids:
+                km.limits.assign(kernel_id, keys)
+            km.limits.release(keys, (count or 1) - len(kernel_ids))
+            if not kernel_ids:
+                self.set_status(503)
+                self.set_header("Retry-After", km.admission.retry_after())
+                self.write(self.permissions({"error": "Could not start a kernel"}))
+                self.finish()
+                return
+            data = {"ws_url": ws_url, "id": kernel_ids[0]}
+            if count is not None:
+                data["ids"] = kernel_ids
             self.write(self.permissions(data))
             self.set_cookie("accepted_tos", "true", expires_days=365)
             self.finish()
@@ -186,41 +304,68 @@ class Completer(object):
     name_pattern = re.compile(r"\b[a-z_]\w*$", re.IGNORECASE)
 
     def __init__(self, km):
+        self.km = km
         self.waiting = {}
-        self.kernel_id = km.new_session(limited=False)
-        self.session = km._sessions[self.kernel_id]
-        self.stream = km.create_shell_stream(self.kernel_id)
+        self.kernel_id = None
+        self.pending = None # requests received while the kernel is starting
+        self.session = None
+        self.stream = None
+
+    def _start_kernel(self):
+        """ Start the completion kernel, without blocking. """
+        self.pending = []
+        self.km._start_session_async("", "", self._kernel_started, limited=False)
+
+    def _kernel_started(self, kernel_id):
+        pending, self.pending = self.pending, None
+        if kernel_id is False:
+            logger.error("Could not start the completion kernel")
+            # try again with the next request
+            for kc, msg in pending:
+                kc.send("complete/shell," + jsonapi.dumps(self._empty_reply(msg)))
+            return
+        self.kernel_id = kernel_id
+        self.session = self.km.kernel_info(kernel_id).session
+        self.stream = self.km.create_shell_stream(kernel_id)
         self.stream.on_recv(self.on_recv)
+        for kc, msg in pending:
+            self.registerRequest(kc, msg)
+
+    def _empty_reply(self, msg):
+        return {
+            "header": {
+                "msg_id": str(uuid.uuid4()),
+                "username": "",
+                "session": self.kernel_id,
+                "msg_type": "complete_reply"
+            },
+            "parent_header": msg["header"],
+            "metadata": {},
+            "content": {"matches": [], "matched_text": []}
+        }
 
     def registerRequest(self, kc, msg):
         name = None
         if "mode" not in msg["content"] or msg["content"]["mode"] in ("sage", "python"):
+            if self.kernel_id is None:
+                # The kernel is started with the first request, since there
+                # may be no computer to start it on when the server starts
+                if self.pending is None:
+                    self._start_kernel()
+                self.pending.append((kc, msg))
+                return
             self.waiting[msg["header"]["msg_id"]] = kc
             self.session.send(self.stream, msg)
             return
         elif msg["content"]["mode"] in trait_names:
             line = msg["content"]["line"][:msg["content"]["cursor_pos"]]
             name = Completer.name_pattern.search(line)
-        response = {
-            "header": {
-                "msg_id": str(uuid.uuid4()),
-                "username": "",
-                "session": self.kernel_id,
-                "msg_type": "complete_reply"
-            },
-            "parent_header": msg["header"],
-            "metadata": {}
-        }
+        response = self._empty_reply(msg)
         if name is not None:
             response["content"] = {
                 "matches": [t for t in trait_names[msg["content"]["mode"]] if t.startswith(name.group())],
                 "matched_text": name.group()
             }
-        else:
-            response["content"] = {
-                "matches": [],
-                "matched_text": []
-            }
         kc.send("complete/shell," + jsonapi.dumps(response))
 
     def on_recv(self, msg):
@@ -232,11 +377,30 @@ class Completer(object):
         kc.send("complete/shell," + jsonapi.dumps(msg))
 
 class KernelConnection(sockjs.tornado.SockJSConnection):
+    """
+    The SockJS connection of a page, which carries the channels of all of
+    its kernels. Every message starts with ``<kernel id>/<channel>,``.
+
+    A page can also get a kernel over the connection it already has open
+    instead of posting to :class:`KernelHandler`: it sends
+    ``<tag>/acquire,<parameters>`` with a tag of its choosing and the
+    ``timeout``, ``accepted_tos``, ``api_key`` and ``lease`` parameters
+    (see :class:`KernelHandler`) as JSON, and
+    the reply ``<tag>/acquire,`` is followed by ``{"id": <kernel id>}`` or
+    by an ``error`` and the seconds after which to try again
+    (``retry_after``). Messages sent to ``<tag>/shell`` meanwhile are
+    passed on to the kernel right after the reply, so the code to run can
+    go out together with the request for the kernel; the kernel's replies
+    come back under its id.
+    """
     def __init__(self, session):
         super(KernelConnection, self).__init__(session)
 
     def on_open(self, request):
         self.channels = {}
+        self.request = request
+        self.acquiring = {} # tag: messages sent to the kernel before it started
+        self.acquired = {} # tag: kernel id
 
     def on_message(self, message):
         prefix, json_message = message.split(",", 1)
@@ -247,20 +411,30 @@ class KernelConnection(sockjs.tornado.SockJSConnection):
             return
         application = self.session.handler.application
         message = jsonapi.loads(json_message)
+        if channel == "acquire":
+            self.acquire(application, kernel, message)
+            return
         if kernel == "complete":
             if message["header"]["msg_type"] in ("complete_request",
                                                  "object_info_request"):
                 application.completer.registerRequest(self, message)
             return
+        if kernel in self.acquiring:
+            self.acquiring[kernel].append((channel, json_message, message))
+            return
+        self.route(application, self.acquired.get(kernel, kernel), channel, json_message, message)
+
+    def route(self, application, kernel, channel, json_message, message):
+        """ Pass a message on to a channel of a kernel. """
         try:
             if kernel not in self.channels:
                 # handler may be None in certain circumstances (it seems to only be set
                 # in GET requests, not POST requests, so even using it here may
                 # only work with JSONP because of a race condition)
                 kernel_info = application.km.kernel_info(kernel)
-                self.kernel_info = {'remote_ip': kernel_info['remote_ip'],
-                                    'referer': kernel_info['referer'],
-                                    'timeout': kernel_info['timeout']}
+                self.kernel_info = {'remote_ip': kernel_info.remote_ip,
+                                    'referer': kernel_info.referer,
+                                    'timeout': kernel_info.timeout}
             if message["header"]["msg_type"] == "execute_request":
                 stats_logger.info(StatsMessage(
                     kernel_id=kernel,
@@ -269,17 +443,81 @@ class KernelConnection(sockjs.tornado.SockJSConnection):
                     code=message["content"]["code"],
                     execute_type='request'))
             if kernel not in self.channels:
-                self.channels[kernel] = \
-                    {"iopub": IOPubSockJSHandler(kernel, self.send, application),
-                     "shell": ShellSockJSHandler(kernel, self.send, application)}
-                self.channels[kernel]["iopub"].open(kernel)
-                self.channels[kernel]["shell"].open(kernel)
+                self.open_channels(application, kernel)
             self.channels[kernel][channel].on_message(json_message)
         except KeyError:
             # Ignore messages to nonexistent or killed kernels.
             logger.info("%s message sent to nonexistent kernel: %s" %
                         (message["header"]["msg_type"], kernel))
 
+    def open_channels(self, application, kernel):
+        channels = {"iopub": IOPubSockJSHandler(kernel, self.send, application),
+                    "shell": ShellSockJSHandler(kernel, self.send, application)}
+        channels["iopub"].open(kernel)
+        channels["shell"].open(kernel)
+        self.channels[kernel] = channels
+
+    def acquire(self, application, tag, params):
+        """
+        Start a kernel for an ``acquire`` message and open its channels on
+        this connection.
+
+        :arg str tag: the prefix the client chose for the kernel
+        :arg dict params: parameters of the request
+        """
+        def reply(data):
+            self.send("%s/acquire,%s" % (tag, jsonapi.dumps(data)))
+
+        if tag in self.acquiring or tag in self.acquired or tag == "complete":
+            reply({"error": "Tag already in use"})
+            return
+        if not isinstance(params, dict):
+            params = {}
+        cookie = self.request.get_cookie("accepted_tos")
+        if config.get_config("requires_tos") and params.get("accepted_tos") not in (True, "true") \
+                and (cookie is None or cookie.value != "true"):
+            reply({"error": "The terms of service have not been accepted"})
+            return
+        km = application.km
+        referer = self.request.get_header("referer") or ""
+        remote_ip = self.request.ip
+        keys, refusal = charge(km.limits, remote_ip, referer, params.get("api_key"))
+        if refusal is not None:
+            status, error, retry_after = refusal
+            reply({"error": error, "retry_after": retry_after})
+            return
+        self.acquiring[tag] = []
+
+        def started(kernel_id):
+            pending = self.acquiring.pop(tag, [])
+            if not kernel_id:
+                km.limits.release(keys)
+                reply({"error": "Could not start a kernel",
+                       "retry_after": km.admission.retry_after()})
+                return
+            km.limits.assign(kernel_id, keys)
+            if self.is_closed:
+                km.end_session(kernel_id)
+                return
+            self.acquired[tag] = kernel_id
+            try:
+                self.open_channels(application, kernel_id)
+            except KeyError:
+                # the kernel ended already
+                reply({"error": "Could not start a kernel", "retry_after": None})
+                return
+            reply({"id": kernel_id})
+            for channel, json_message, message in pending:
+                self.route(application, kernel_id, channel, json_message, message)
+
+        timeout = parse_timeout(params.get("timeout"))
+        kernel_id = km.claim_lease(params.get("lease"), referer, remote_ip, timeout)
+        if kernel_id is not None:
+            started(kernel_id)
+        else:
+            km.new_session_async(referer=referer, remote_ip=remote_ip,
+                                 timeout=timeout, callback=started)
+
     def on_close(self):
         for channel in self.channels.itervalues():
             channel["shell"].on_close()
@@ -329,15 +567,139 @@ class SageCellHandler(tornado.web.RequestHandler):
         sagecell_json = json.dumps(sagecell_html)
 
     def get(self):
+        # A page fetches the cell once, as it loads, so this is where an
+        # embedding page gets its lease (see :mod:`lease`)
+        html, html_json = self.sagecell_html, self.sagecell_json
+        lease = None
+        if self.get_argument("leased", None) is None:
+            lease = self.application.km.lease(self.request.remote_ip)
+        if lease is not None:
+            html = "<!--lease %s-->%s" % (lease, html)
+            html_json = json.dumps(html)
         if len(self.get_arguments("callback")) == 0:
-            self.write(self.sagecell_html);
+            self.write(html);
             self.set_header("Access-Control-Allow-Origin", self.request.headers.get("Origin", "*"))
             self.set_header("Access-Control-Allow-Credentials", "true")
             self.set_header("Content-Type", "text/html")
         else:
-            self.write("%s(%s);" % (self.get_argument("callback"), self.sagecell_json))
+            self.write("%s(%s);" % (self.get_argument("callback"), html_json))
             self.set_header("Content-Type", "application/javascript")
 
+class ReadyHandler(tornado.web.RequestHandler):
+    """
+    Handler for ``/ready``, which reports whether the server can start
+    kernels and the state of every computer as JSON. The status is 503
+    until the first computer is ready, so load balancers can hold back
+    traffic while the server starts.
+    """
+    def get(self):
+        readiness = self.application.km.readiness()
+        if not readiness["ready"]:
+            self.set_status(503)
+        self.write(readiness)
+
+class AdminHandler(tornado.web.RequestHandler):
+    """
+    Base class of the admin API handlers. Requests must carry the
+    configured ``admin_token`` in an ``Authorization: Bearer <token>``
+    header, or they are refused (403); without a configured token the
+    API is disabled (404).
+    """
+    def prepare(self):
+        token = config.get_config("admin_token")
+        if not token:
+            raise tornado.web.HTTPError(404)
+        auth = self.request.headers.get("Authorization", "")
+        if not (auth.startswith("Bearer ")
+                and hmac.compare_digest(auth[len("Bearer "):].strip(), str(token))):
+            raise tornado.web.HTTPError(403)
+
+    def json_body(self):
+        try:
+            body = json.loads(self.request.body or "{}")
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Request body is not JSON")
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "Request body is not a JSON object")
+        return body
+
+    def computer(self, comp_id):
+        """ Checks that a computer is connected to this server. """
+        if comp_id not in self.application.km._comps:
+            raise tornado.web.HTTPError(404, "Unknown computer %s" % comp_id)
+
+class StatsHandler(AdminHandler):
+    """
+    Handler for ``/stats``, which reports the state of the kernel
+    manager (computers, preforked kernel pools and control messages) as
+    JSON. Like the admin API, it needs the ``admin_token``.
+    """
+    def get(self):
+        self.write(self.application.km.stats())
+
+class AdminComputersHandler(AdminHandler):
+    """
+    ``/admin/computers``: ``GET`` reports the live state of every
+    computer (see :meth:`TrustedMultiKernelManager.computer_status`) and
+    ``POST`` adds a computer, with a JSON object of the computer
+    configuration (as in the ``computers`` list of the config file) as
+    the body. The computer is started in the background; its id is
+    returned right away.
+    """
+    def get(self):
+        self.write(self.application.km.computer_status())
+
+    def post(self):
+        comp_id = self.application.km.add_computer_async(self.json_body())
+        logger.info("Admin API added computer %s", comp_id)
+        self.set_status(202)
+        self.write({"comp_id": comp_id})
+
+class AdminComputerHandler(AdminHandler):
+    """
+    ``/admin/computers/<comp_id>``: ``GET`` reports the state of a
+    computer and ``DELETE`` removes it, ending its kernels. Removing a
+    computer that is already being removed is a conflict (409).
+    """
+    def get(self, comp_id):
+        status = self.application.km.computer_status()
+        if comp_id not in status:
+            raise tornado.web.HTTPError(404, "Unknown computer %s" % comp_id)
+        self.write(status[comp_id])
+
+    @tornado.web.asynchronous
+    def delete(self, comp_id):
+        self.computer(comp_id)
+        logger.info("Admin API removing computer %s", comp_id)
+        if not self.application.km.remove_computer_async(comp_id, callback=self.finish):
+            raise tornado.web.HTTPError(409, "Computer %s is already being removed" % comp_id)
+
+class AdminUsageHandler(AdminHandler):
+    """
+    ``GET /admin/usage``: the running kernels, remaining rate limit
+    tokens and refused requests of every client key (see
+    :meth:`ratelimit.RateLimits.usage`). The ``kind`` argument (``ip``,
+    ``referer`` or ``key``) restricts the report to one kind of key.
+    """
+    def get(self):
+        self.write(self.application.km.limits.usage(self.get_argument("kind", None)))
+
+class AdminDrainHandler(AdminHandler):
+    """
+    ``POST /admin/computers/<comp_id>/drain``: stop placing new kernels
+    on a computer and let its kernels end. With ``{"remove": true}`` as
+    the body, the computer is removed once its last kernel ended. A
+    computer that is being removed cannot be drained (409).
+    """
+    def post(self, comp_id):
+        self.computer(comp_id)
+        remove = bool(self.json_body().get("remove"))
+        logger.info("Admin API draining computer %s (remove: %s)", comp_id, remove)
+        if not self.application.km.drain_computer(comp_id, remove=remove):
+            raise tornado.web.HTTPError(409, "Computer %s is being removed" % comp_id)
+        self.set_status(202)
+        self.write(self.application.km.computer_status()[comp_id])
+
 class StaticHandler(tornado.web.StaticFileHandler):
     """Handler for static requests"""
     def set_extra_headers(self, path):
@@ -351,6 +713,10 @@ class ServiceHandler(tornado.web.RequestHandler):
 
     The code to be executed is given in the code request parameter.
 
+    If some computer has service kernels, the code runs in a forked child
+    of one of them (see :mod:`service_kernels`) rather than in a kernel of
+    its own; it still gets a kernel if that fails.
+
     This handler is currently not production-ready.
     """
     @tornado.web.asynchronous
@@ -375,21 +741,38 @@ accepted_tos=true\n""")
             km = self.application.km
             remote_ip = self.request.remote_ip
             referer = self.request.headers.get('Referer','')
+            keys, error = charge_client(self)
+            if keys is None:
+                self.write(error + "\n")
+                self.finish()
+                return
+            if km.has_service_kernels():
+                result = yield gen.Task(km.execute_forked_async, code,
+                                        self.get_arguments('user_variables'),
+                                        default_timeout)
+                if result is not None:
+                    km.limits.release(keys)
+                    self.log_request(None, code)
+                    streams = dict((name, result[name]) for name in ("stdout", "stderr")
+                                   if result[name])
+                    reply = result["execute_reply"]
+                    success = "abort" if reply["status"] == "abort" else reply["status"] == "ok"
+                    self.write_result(streams, success, reply)
+                    return
             self.kernel_id = yield gen.Task(km.new_session_async,
                                             referer = referer,
                                             remote_ip = remote_ip,
                                             timeout=0)
-            if not (remote_ip=="::1" and referer==""
-                    and cron.match(code) is not None):
-                sm = StatsMessage(kernel_id=self.kernel_id,
-                                  remote_ip=remote_ip,
-                                  referer=referer,
-                                  code=code,
-                                  execute_type='service')
-                if remote_ip == "127.0.0.1" and self.kernel_id:
-                    stats_logger.debug(sm)
-                else:
-                    stats_logger.info(sm)
+            if self.kernel_id:
+                km.limits.assign(self.kernel_id, keys)
+            else:
+                km.limits.release(keys)
+                self.set_status(503)
+                self.set_header("Retry-After", km.admission.retry_after())
+                self.write("Could not start a kernel\n")
+                self.finish()
+                return
+            self.log_request(self.kernel_id, code)
 
             self.shell_handler = ShellServiceHandler(self.application)
             self.iopub_handler = IOPubServiceHandler(self.application)
@@ -402,7 +785,6 @@ accepted_tos=true\n""")
             def done(msg):
                 if msg["msg_type"] == "execute_reply":
                     self.success = msg["content"]["status"] == "ok"
-                    self.user_variables = msg["content"].get("user_variables", [])
                     self.execute_reply = msg['content']
                     loop.remove_timeout(self.timeout_request)
                     loop.add_callback(self.finish_request)
@@ -424,6 +806,21 @@ accepted_tos=true\n""")
                             }
             self.shell_handler.on_message(jsonapi.dumps(exec_message))
 
+    def log_request(self, kernel_id, code):
+        remote_ip = self.request.remote_ip
+        referer = self.request.headers.get('Referer','')
+        if not (remote_ip=="::1" and referer==""
+                and cron.match(code) is not None):
+            sm = StatsMessage(kernel_id=kernel_id,
+                              remote_ip=remote_ip,
+                              referer=referer,
+                              code=code,
+                              execute_type='service')
+            if remote_ip == "127.0.0.1":
+                stats_logger.debug(sm)
+            else:
+                stats_logger.info(sm)
+
     def timeout_request(self):
         ioloop.IOLoop.instance().add_callback(self.finish_request)
     def finish_request(self):
@@ -432,15 +829,18 @@ accepted_tos=true\n""")
         except:
             pass
         #statslogger.info(StatMessage(kernel_id = self.kernel_id, '%r SERVICE DONE'%self.kernel_id)
-        retval = self.iopub_handler.streams
+        streams = self.iopub_handler.streams
         self.shell_handler.on_close()
         self.iopub_handler.on_close()
         # if the timeout is calling the finish_request, the success and other attributes may not be set
-        retval.update(success=getattr(self, 'success', 'abort'))
-        if hasattr(self, 'user_variables'):
-            retval.update(user_variables=self.user_variables)
-        if hasattr(self, 'execute_reply'):
-            retval.update(execute_reply=self.execute_reply)
+        self.write_result(streams, getattr(self, 'success', 'abort'),
+                          getattr(self, 'execute_reply', None))
+
+    def write_result(self, streams, success, execute_reply=None):
+        retval = dict(streams, success=success)
+        if execute_reply is not None:
+            retval.update(user_variables=execute_reply.get("user_variables", []),
+                          execute_reply=execute_reply)
         self.set_header("Access-Control-Allow-Origin", self.request.headers.get("Origin", "*"))
         self.set_header("Access-Control-Allow-Credentials", "true")
         self.write(retval)
@@ -457,8 +857,8 @@ class ZMQStreamHandler(object):
     def open(self, kernel_id):
         self.km = self.application.km
         self.kernel_id = kernel_id
-        self.session = self.km._sessions[self.kernel_id]
-        self.kernel = self.km._kernels[self.kernel_id]
+        self.kernel = self.km.kernel_info(self.kernel_id)
+        self.session = self.kernel.session
         self.msg_from_kernel_callbacks = []
         self.msg_to_kernel_callbacks = []
 
@@ -514,22 +914,22 @@ class ShellHandler(ZMQStreamHandler):
     def _reset_deadline(self, msg):
         if msg["header"]["msg_type"] in ("execute_reply",
                                          "sagenb.interact.update_interact_reply"):
-            timeout = self.kernel["timeout"]
+            timeout = self.kernel.timeout
             if timeout > self.km.max_kernel_timeout:
-                self.kernel["timeout"] = timeout = self.km.max_kernel_timeout
-            if timeout <= 0.0 and self.kernel["executing"] == 1:
+                self.kernel.timeout = timeout = self.km.max_kernel_timeout
+            if timeout <= 0.0 and self.kernel.executing == 1:
                 # kill the kernel before the heartbeat is able to
                 self.kill_kernel = True
             else:
-                self.kernel["deadline"] = (time.time()+timeout)
-                self.kernel["executing"] -= 1
+                self.kernel.deadline = (time.time()+timeout)
+                self.kernel.executing -= 1
 
     def on_message(self, message):
         if self.km._kernels.get(self.kernel_id) is not None:
             msg = jsonapi.loads(message)
             for f in self.msg_to_kernel_callbacks:
                 f(msg)
-            self.kernel["executing"] += 1
+            self.kernel.executing += 1
             self.session.send(self.shell_stream, msg)
 
     def on_close(self):
@@ -549,7 +949,8 @@ class ShellHandler(ZMQStreamHandler):
         super(ShellHandler, self)._on_zmq_reply(msg_list)
         if self.kill_kernel:
             self.shell_stream.flush()
-            self.kernel["kill"]()
+            if self.kernel.kill is not None:
+                self.kernel.kill()
 
 class IOPubHandler(ZMQStreamHandler):
     """
@@ -558,7 +959,12 @@ class IOPubHandler(ZMQStreamHandler):
     heartbeat (hb) stream that same kernel, but there is no
     associated websocket connection. The iopub websocket is
     instead used to notify the client if the heartbeat
-    stream fails.
+    stream fails, the kernel passes its deadline or the
+    untrusted side reports that the kernel exited.
+
+    Computers that report kernel exits can have the
+    network heartbeat switched off; the deadline is still
+    checked every beat.
     """
     def open(self, kernel_id):
         logger.debug("entered IOPubHandler.open for kernel %s", kernel_id)
@@ -567,9 +973,11 @@ class IOPubHandler(ZMQStreamHandler):
         self._beating = False
         self.iopub_stream = self.km.create_iopub_stream(self.kernel_id)
         self.iopub_stream.on_recv(self._on_zmq_reply)
-        self.kernel["kill"] = self.kernel_died
+        self.kernel.kill = self.kernel_died
         logger.debug("set kill handler for kernel %s", kernel_id)
-        self.hb_stream = self.km.create_hb_stream(self.kernel_id)
+        self.hb_stream = None
+        if self.km.uses_heartbeat(self.kernel_id):
+            self.hb_stream = self.km.create_hb_stream(self.kernel_id)
         self.start_hb(self.kernel_died)
         self.msg_from_kernel_callbacks.append(self._reset_timeout)
 
@@ -580,7 +988,7 @@ class IOPubHandler(ZMQStreamHandler):
                 if (not math.isnan(timeout)) and timeout >= 0:
                     if timeout > self.km.max_kernel_timeout:
                         timeout = self.km.max_kernel_timeout
-                    self.kernel["timeout"] = timeout
+                    self.kernel.timeout = timeout
             except:
                 pass
             return False
@@ -592,7 +1000,7 @@ class IOPubHandler(ZMQStreamHandler):
         if hasattr(self, "iopub_stream") and not self.iopub_stream.closed():
             self.iopub_stream.on_recv(None)
             self.iopub_stream.close()
-        if hasattr(self, "hb_stream") and not self.hb_stream.closed():
+        if hasattr(self, "hb_stream"):
             self.stop_hb()
         super(IOPubHandler, self).on_close()
 
@@ -603,26 +1011,34 @@ class IOPubHandler(ZMQStreamHandler):
         an IPython kernel. The specific delay paramaters for
         the callbacks are set by configuration values in a
         kernel manager associated with the web application.
+
+        The callbacks run on the kernel manager's timer wheel,
+        which fires the callbacks of all kernels that are due
+        in the same tick together.
         """
         if not self._beating:
             self._kernel_alive = True
 
             def ping_or_dead():
-                self.hb_stream.flush()
+                if self.hb_stream is not None:
+                    self.hb_stream.flush()
                 try:
-                    if self.kernel["executing"] == 0:
+                    if self.kernel.executing == 0:
                         # only kill the kernel after all pending
                         # execute requests have finished
-                        if time.time() > self.kernel["deadline"]:
+                        if time.time() > self.kernel.deadline:
                             self._kernel_alive = False
                 except:
                     self._kernel_alive = False
 
                 if self._kernel_alive:
-                    self._kernel_alive = False
-                    self.hb_stream.send(b'ping')
-                    # flush stream to force immediate socket send
-                    self.hb_stream.flush()
+                    if self.hb_stream is not None:
+                        self._kernel_alive = False
+                        self.hb_stream.send(b'ping')
+                        # flush stream to force immediate socket send
+                        self.hb_stream.flush()
+                    self._hb_timer = self.km.timers.schedule(
+                        self.beat_interval, ping_or_dead)
                 else:
                     try:
                         callback()
@@ -634,32 +1050,22 @@ class IOPubHandler(ZMQStreamHandler):
             def beat_received(msg):
                 self._kernel_alive = True
 
-            self.hb_stream.on_recv(beat_received)
+            if self.hb_stream is not None:
+                self.hb_stream.on_recv(beat_received)
 
-            loop = ioloop.IOLoop.instance()
- 
             (self.beat_interval, self.first_beat) = self.km.get_hb_info(self.kernel_id)
 
-            self._hb_periodic_callback = ioloop.PeriodicCallback(ping_or_dead, self.beat_interval*1000, loop)
-
-            self._start_hb_handle = loop.add_timeout(time.time()+self.first_beat, self._really_start_hb)
+            # The first ping is sent one beat after the first beat
+            self._hb_timer = self.km.timers.schedule(
+                self.first_beat + self.beat_interval, ping_or_dead)
             self._beating= True
 
-    def _really_start_hb(self):
-        """
-        callback for delayed heartbeat start
-        Only start the hb loop if we haven't been closed during the wait.
-        """
-        if self._beating and not self.hb_stream.closed():
-            self._hb_periodic_callback.start()
-
     def stop_hb(self):
         """Stop the heartbeating and cancel all related callbacks."""
         if self._beating:
             self._beating = False
-            self._hb_periodic_callback.stop()
-            ioloop.IOLoop.instance().remove_timeout(self._start_hb_handle)
-            if not self.hb_stream.closed():
+            self.km.timers.cancel(self._hb_timer)
+            if self.hb_stream is not None and not self.hb_stream.closed():
                 self.hb_stream.on_recv(None)
                 self.hb_stream.close()
 
@@ -0,0 +1,154 @@
+"""
+Multiplexing the iopub streams of all kernels on a computer over one
+connection.
+
+Without it, the web server opens a ZMQ connection to the iopub port of
+every kernel. With it, the receiver subscribes to its kernels' iopub
+ports locally (:class:`Forwarder`) and republishes every message on one
+PUB socket with the kernel id prepended as the first frame. The web
+server keeps a single SUB connection per computer
+(:class:`Demultiplexer`), subscribes to the ids of the kernels it has
+clients for and hands each kernel's messages to a :class:`KernelStream`,
+which stands in for the kernel's own iopub ZMQStream.
+"""
+import zmq
+
+
+class Forwarder(object):
+    """
+    Republishes the iopub messages of the kernels of a receiver.
+
+    :arg zmq.Context context: context for the sockets
+    :arg poll_loop.PollLoop loop: the receiver's event loop
+    :arg str ip: address to bind the PUB socket to
+    :arg str path: if given, the PUB socket is bound to this file
+        (``ipc://``) instead of a TCP port on ``ip``
+    """
+    def __init__(self, context, loop, ip, path=None):
+        self.context = context
+        self.loop = loop
+        self.pub = context.socket(zmq.PUB)
+        self.pub.setsockopt(zmq.LINGER, 0)
+        if path is None:
+            self.endpoint = "tcp://%s:%d" % (ip, self.pub.bind_to_random_port("tcp://%s" % ip))
+        else:
+            self.endpoint = "ipc://" + path
+            self.pub.bind(self.endpoint)
+        self._subs = {} # kernel_id: SUB socket connected to the kernel's iopub port
+        self.forwarded = 0
+
+    def add(self, kernel_id, connection):
+        """
+        Start forwarding the messages of a kernel.
+
+        :arg dict connection: the connection information of the kernel
+        """
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
+        sub.setsockopt(zmq.LINGER, 0)
+        if connection.get("transport", "tcp") == "tcp":
+            sub.connect("tcp://%s:%d" % (connection["ip"], connection["iopub_port"]))
+        else:
+            sub.connect("ipc://%s-%d" % (connection["ip"], connection["iopub_port"]))
+        self._subs[kernel_id] = sub
+        self.loop.add_handler(sub, lambda: self._forward(kernel_id, sub))
+
+    def _forward(self, kernel_id, sub):
+        while sub.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            frames = sub.recv_multipart(copy=False)
+            self.pub.send_multipart([kernel_id] + frames, copy=False)
+            self.forwarded += 1
+
+    def remove(self, kernel_id):
+        """ Stop forwarding the messages of a kernel. """
+        sub = self._subs.pop(kernel_id, None)
+        if sub is not None:
+            self.loop.remove_handler(sub)
+            sub.close()
+
+    def clear(self):
+        """ Stop forwarding the messages of all kernels. """
+        for kernel_id in list(self._subs):
+            self.remove(kernel_id)
+
+    def __len__(self):
+        return len(self._subs)
+
+
+class Demultiplexer(object):
+    """
+    Splits the messages from a :class:`Forwarder` by kernel.
+
+    :arg zmq.eventloop.zmqstream.ZMQStream stream: a SUB stream connected
+        to the forwarder, without subscriptions
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._stream.on_recv(self._dispatch)
+        self._kernels = {} # kernel_id: set of KernelStreams
+
+    def _dispatch(self, frames):
+        for stream in list(self._kernels.get(frames[0], ())):
+            stream._deliver(frames[1:])
+
+    def subscribe(self, kernel_id):
+        """
+        :returns: a stream of the iopub messages of a kernel
+        :rtype: KernelStream
+        """
+        stream = KernelStream(self, kernel_id)
+        self._kernels.setdefault(kernel_id, set()).add(stream)
+        # Subscriptions are counted, so every stream subscribes on its own
+        self._stream.socket.setsockopt(zmq.SUBSCRIBE, kernel_id)
+        return stream
+
+    def _unsubscribe(self, stream):
+        streams = self._kernels.get(stream.kernel_id, set())
+        if stream in streams:
+            streams.remove(stream)
+            if not streams:
+                del self._kernels[stream.kernel_id]
+            if not self._stream.closed():
+                self._stream.socket.setsockopt(zmq.UNSUBSCRIBE, stream.kernel_id)
+
+    def flush(self):
+        return self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+    def __len__(self):
+        return len(self._kernels)
+
+
+class KernelStream(object):
+    """
+    The messages of one kernel from a :class:`Demultiplexer`, with the
+    parts of the :class:`~zmq.eventloop.zmqstream.ZMQStream` interface
+    that the web server uses for iopub streams.
+    """
+    def __init__(self, mux, kernel_id):
+        self.mux = mux
+        self.kernel_id = kernel_id
+        self._callback = None
+        self._closed = False
+
+    def _deliver(self, frames):
+        if self._callback is not None:
+            self._callback(frames)
+
+    def on_recv(self, callback):
+        self._callback = callback
+
+    def flush(self):
+        """ Deliver the messages that have already arrived. """
+        return self.mux.flush()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._callback = None
+            self.mux._unsubscribe(self)
+
+    def closed(self):
+        return self._closed
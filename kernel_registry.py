@@ -0,0 +1,244 @@
+"""
+The web server's records of the kernels it knows about.
+
+Every kernel has one :class:`Kernel` record, which holds its connection
+information, its :class:`Session` and the state of its client
+connections. :class:`KernelRegistry` keeps the records together with
+indexes by computer, client IP address, referer and state, so that
+finding the kernels of a computer or counting the preforked kernels does
+not scan all kernels. A record and all its index entries are dropped in
+one place, :meth:`KernelRegistry.remove`.
+"""
+import sys
+
+#: Kernel states: ``preforked`` kernels wait in a computer's pool,
+#: ``active`` kernels have been handed out to a client and ``dying``
+#: kernels have been asked to end
+STATES = ("preforked", "active", "dying")
+#: Fields of a record that are written to a checkpoint, see
+#: :meth:`KernelRegistry.dump`
+SAVED = ("kernel_id", "comp_id", "connection", "state", "timeout",
+         "deadline", "referer", "remote_ip")
+
+
+class Kernel(object):
+    """
+    The record of a kernel.
+
+    :ivar str kernel_id: id of the kernel
+    :ivar str comp_id: id of the computer the kernel runs on
+    :ivar dict connection: ports, key and transport of the kernel
+    :ivar session: the :class:`Session` for talking to the kernel
+    :ivar str state: one of :data:`STATES`
+    :ivar int executing: number of active execute_requests
+    :ivar float deadline: time after which an idle kernel is ended
+    :ivar float timeout: seconds the deadline is extended by after an
+        execute_request
+    :ivar str referer: referer of the request for the kernel
+    :ivar str remote_ip: IP address of the client of the kernel
+    :ivar bool exited: whether the computer reported that the kernel exited
+    :ivar callable kill: ends the kernel through its open client
+        connection, or None
+    """
+    __slots__ = ("kernel_id", "comp_id", "connection", "session", "state",
+                 "executing", "deadline", "timeout", "referer", "remote_ip",
+                 "exited", "kill")
+
+    def __init__(self, kernel_id, comp_id, connection, session, state, timeout, deadline):
+        self.kernel_id = kernel_id
+        self.comp_id = comp_id
+        self.connection = connection
+        self.session = session
+        self.state = state
+        self.executing = 0
+        self.deadline = deadline
+        self.timeout = timeout
+        self.referer = ""
+        self.remote_ip = ""
+        self.exited = False
+        self.kill = None
+
+    def __repr__(self):
+        return "<Kernel %s on %s, %s>" % (self.kernel_id, self.comp_id[:4], self.state)
+
+
+def _index_add(index, key, kernel_id):
+    ids = index.get(key)
+    if ids is None:
+        ids = index[key] = set()
+    ids.add(kernel_id)
+
+def _index_remove(index, key, kernel_id):
+    ids = index.get(key)
+    if ids is not None:
+        ids.discard(kernel_id)
+        if not ids:
+            # no empty sets are left behind for computers and clients that
+            # are gone
+            del index[key]
+
+
+class KernelRegistry(object):
+    """ The kernel records of the web server, indexed. """
+    def __init__(self):
+        self._kernels = {} # kernel_id: Kernel
+        self._by_comp = {} # comp_id: set of kernel ids
+        self._by_ip = {} # remote_ip: set of kernel ids
+        self._by_referer = {} # referer: set of kernel ids
+        self._by_state = dict((state, set()) for state in STATES)
+        self.changes = 0 # number of changes to the records, to tell whether a checkpoint is out of date
+
+    def __len__(self):
+        return len(self._kernels)
+
+    def __contains__(self, kernel_id):
+        return kernel_id in self._kernels
+
+    def __iter__(self):
+        return iter(self._kernels)
+
+    def __getitem__(self, kernel_id):
+        return self._kernels[kernel_id]
+
+    def get(self, kernel_id):
+        """
+        :returns: the record of a kernel, or None if it is not known
+        :rtype: Kernel
+        """
+        return self._kernels.get(kernel_id)
+
+    def add(self, kernel_id, comp_id, connection, session, state, timeout, deadline):
+        """
+        Record a kernel that started.
+
+        :returns: the new record
+        :rtype: Kernel
+        """
+        if kernel_id in self._kernels:
+            self.remove(kernel_id)
+        kernel = Kernel(kernel_id, comp_id, connection, session, state, timeout, deadline)
+        self._kernels[kernel_id] = kernel
+        self.changes += 1
+        _index_add(self._by_comp, comp_id, kernel_id)
+        self._by_state[state].add(kernel_id)
+        return kernel
+
+    def set_state(self, kernel, state):
+        self._by_state[kernel.state].discard(kernel.kernel_id)
+        kernel.state = state
+        self._by_state[state].add(kernel.kernel_id)
+        self.changes += 1
+
+    def set_client(self, kernel, referer, remote_ip):
+        """ Record the client a kernel was handed out to. """
+        kernel_id = kernel.kernel_id
+        if kernel.referer:
+            _index_remove(self._by_referer, kernel.referer, kernel_id)
+        if kernel.remote_ip:
+            _index_remove(self._by_ip, kernel.remote_ip, kernel_id)
+        kernel.referer = referer or ""
+        kernel.remote_ip = remote_ip or ""
+        if kernel.referer:
+            _index_add(self._by_referer, kernel.referer, kernel_id)
+        if kernel.remote_ip:
+            _index_add(self._by_ip, kernel.remote_ip, kernel_id)
+        self.changes += 1
+
+    def remove(self, kernel_id):
+        """
+        Forget a kernel.
+
+        :returns: its record, or None if it was not known
+        :rtype: Kernel
+        """
+        kernel = self._kernels.pop(kernel_id, None)
+        if kernel is None:
+            return None
+        _index_remove(self._by_comp, kernel.comp_id, kernel_id)
+        _index_remove(self._by_ip, kernel.remote_ip, kernel_id)
+        _index_remove(self._by_referer, kernel.referer, kernel_id)
+        self._by_state[kernel.state].discard(kernel_id)
+        kernel.kill = None # it may refer back to a client connection
+        self.changes += 1
+        return kernel
+
+    def remove_computer(self, comp_id):
+        """
+        Forget all kernels on a computer.
+
+        :returns: their records
+        :rtype: list
+        """
+        return [self.remove(kernel_id) for kernel_id in list(self._by_comp.get(comp_id, ()))]
+
+    def on_computer(self, comp_id):
+        """ :returns: ids of the kernels on a computer
+        :rtype: list """
+        return list(self._by_comp.get(comp_id, ()))
+
+    def count(self, comp_id=None, state=None):
+        """
+        :returns: the number of kernels on a computer, in a state, or both
+        :rtype: int
+        """
+        if comp_id is None:
+            return len(self._by_state[state]) if state is not None else len(self._kernels)
+        ids = self._by_comp.get(comp_id, ())
+        if state is None:
+            return len(ids)
+        return len(ids & self._by_state[state])
+
+    def from_ip(self, remote_ip):
+        """ :returns: ids of the kernels of a client IP address
+        :rtype: list """
+        return list(self._by_ip.get(remote_ip, ()))
+
+    def from_referer(self, referer):
+        """ :returns: ids of the kernels requested from a referer
+        :rtype: list """
+        return list(self._by_referer.get(referer, ()))
+
+    def in_state(self, state):
+        """ :returns: ids of the kernels in a state
+        :rtype: list """
+        return list(self._by_state[state])
+
+    def dump(self, comp_id):
+        """
+        :returns: the :data:`SAVED` fields of the preforked and active
+            kernels on a computer, as dictionaries for a checkpoint;
+            kernels that are being ended are left out
+        :rtype: list
+        """
+        kernels = [self._kernels[kernel_id] for kernel_id in self._by_comp.get(comp_id, ())]
+        return [dict((field, getattr(kernel, field)) for field in SAVED)
+                for kernel in kernels if kernel.state != "dying"]
+
+    def memory(self):
+        """
+        Estimate the memory taken by the records and indexes (not counting
+        the strings, which are shared with other structures).
+
+        :returns: the number of kernels in each state, of index keys and
+            the estimated bytes taken by records, connection information,
+            sessions and indexes
+        :rtype: dict
+        """
+        records = connections = sessions = 0
+        for kernel in self._kernels.itervalues():
+            records += sys.getsizeof(kernel)
+            connections += sys.getsizeof(kernel.connection)
+            if kernel.session is not None:
+                sessions += sys.getsizeof(kernel.session)
+                sessions += sys.getsizeof(getattr(kernel.session, "__dict__", None) or {})
+        indexes = sys.getsizeof(self._kernels)
+        for index in (self._by_comp, self._by_ip, self._by_referer, self._by_state):
+            indexes += sys.getsizeof(index)
+            indexes += sum(sys.getsizeof(ids) for ids in index.itervalues())
+        return {"kernels": dict((state, len(ids)) for state, ids in self._by_state.iteritems()),
+                "computers": len(self._by_comp),
+                "ips": len(self._by_ip),
+                "referers": len(self._by_referer),
+                "bytes": {"records": records, "connections": connections,
+                          "sessions": sessions, "indexes": indexes,
+                          "total": records + connections + sessions + indexes}}
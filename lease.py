@@ -0,0 +1,142 @@
+"""
+Short leases on preforked kernels for pages that are being rendered.
+
+With ``kernel_leases`` set, the web server takes a preforked kernel out
+of the pool when it renders a page and hands the page a signed token for
+it. The page's first kernel request presents the token and gets that
+kernel without waiting for an allocation. A lease that is not claimed
+within ``duration`` seconds ends and its kernel goes back to the pool.
+At most ``max_leases`` kernels are leased at a time, and at most
+``per_ip`` to one client IP address, so pages that are rendered but never
+evaluated cannot drain the pool.
+
+A token names the kernel and the time its lease ends, and carries an HMAC
+of both and of the client's IP address, so it can only be claimed by the
+client it was given to. The secret is made up when the web server starts
+unless one is configured.
+"""
+import hashlib
+import hmac
+import math
+import os
+import time
+
+
+class Leases(object):
+    """
+    The kernels leased to pages.
+
+    :arg float duration: seconds a lease lasts
+    :arg int max_leases: most kernels leased at a time
+    :arg int per_ip: most kernels leased at a time to one IP address
+    :arg str secret: key the tokens are signed with
+    """
+    def __init__(self, duration=5.0, max_leases=10, per_ip=1, secret=None):
+        self.duration = duration
+        self.max_leases = max_leases
+        self.per_ip = per_ip
+        self._secret = secret or os.urandom(32)
+        self._leases = {} # kernel_id: (comp_id, remote_ip, expires, timer)
+        self._by_ip = {} # remote_ip: number of leases
+        self.stats = {"granted": 0, "claimed": 0, "expired": 0, "late": 0, "invalid": 0}
+
+    def __len__(self):
+        return len(self._leases)
+
+    def __contains__(self, kernel_id):
+        return kernel_id in self._leases
+
+    def _sign(self, kernel_id, expires, remote_ip):
+        return hmac.new(self._secret, "%s:%d:%s" % (kernel_id, expires, remote_ip),
+                        hashlib.sha256).hexdigest()
+
+    def available(self, remote_ip):
+        """ :returns: whether a kernel may be leased to a client
+        :rtype: bool """
+        return (len(self._leases) < self.max_leases
+                and self._by_ip.get(remote_ip, 0) < self.per_ip)
+
+    def grant(self, kernel_id, comp_id, remote_ip, timer=None):
+        """
+        Lease a kernel to a client.
+
+        :arg timer: the handle of the timer that ends the lease, which is
+            handed back by :meth:`claim` and :meth:`end`
+        :returns: the token for the lease
+        :rtype: str
+        """
+        expires = int(math.ceil(time.time() + self.duration))
+        self._leases[kernel_id] = (comp_id, remote_ip, expires, timer)
+        self._by_ip[remote_ip] = self._by_ip.get(remote_ip, 0) + 1
+        self.stats["granted"] += 1
+        return "%s:%d:%s" % (kernel_id, expires, self._sign(kernel_id, expires, remote_ip))
+
+    def claim(self, token, remote_ip):
+        """
+        End a lease because its client asked for its kernel.
+
+        :returns: the kernel id, computer id and timer of the lease, or
+            None if the token is not valid for the client, has expired or
+            its lease has ended
+        :rtype: tuple
+        """
+        try:
+            kernel_id, expires, signature = str(token).split(":")
+            expires = int(expires)
+        except (ValueError, UnicodeError):
+            self.stats["invalid"] += 1
+            return None
+        lease = self._leases.get(kernel_id)
+        if (lease is None or lease[1] != remote_ip or lease[2] != expires
+                or not hmac.compare_digest(signature, self._sign(kernel_id, expires, remote_ip))):
+            self.stats["invalid"] += 1
+            return None
+        if expires < time.time():
+            # the lease is left for its timer to end
+            self.stats["late"] += 1
+            return None
+        comp_id, remote_ip, expires, timer = self.end(kernel_id)
+        self.stats["claimed"] += 1
+        return kernel_id, comp_id, timer
+
+    def expire(self, kernel_id):
+        """
+        End a lease that was not claimed in time.
+
+        :returns: the computer id of the lease, or None if the kernel is
+            not leased
+        :rtype: str
+        """
+        lease = self.end(kernel_id)
+        if lease is None:
+            return None
+        self.stats["expired"] += 1
+        return lease[0]
+
+    def end(self, kernel_id):
+        """
+        End a lease.
+
+        :returns: the computer id, client IP address, end time and timer
+            of the lease, or None if the kernel is not leased
+        :rtype: tuple
+        """
+        lease = self._leases.pop(kernel_id, None)
+        if lease is None:
+            return None
+        remote_ip = lease[1]
+        left = self._by_ip[remote_ip] - 1
+        if left > 0:
+            self._by_ip[remote_ip] = left
+        else:
+            del self._by_ip[remote_ip]
+        return lease
+
+    def status(self):
+        """
+        :returns: the number of leased kernels and counts of leases
+            granted, claimed and expired and of claims that came too late
+            or were not valid
+        :rtype: dict
+        """
+        return dict(self.stats, leased=len(self._leases), ips=len(self._by_ip))
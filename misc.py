@@ -61,7 +61,7 @@ class Config(object):
             except AttributeError:
                 pass
 
-        if isinstance(config_val, dict):
+        if isinstance(config_val, dict) and isinstance(default_config_val, dict):
             config_val = dict(default_config_val.items() + config_val.items())
 
         return config_val
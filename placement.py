@@ -0,0 +1,277 @@
+"""
+Choosing the computer on which a new kernel is started.
+
+Every computer gets a load score from its kernel count, the load it
+reports and its kernel spawn latency (see :meth:`Placement.score`).
+Computers that are full or report too much load or too little free
+memory are *hot* and are not offered to any policy. The other
+computers are kept in a heap ordered by score, so the least loaded
+computer is found in O(log n), and in a Fenwick tree of free capacity
+for the weighted policy.
+
+Policies:
+
+``least_loaded``
+    the computer with the lowest score
+``power_of_two``
+    the better of two randomly chosen computers, which avoids herding
+    every request onto the same computer between load reports
+``weighted``
+    a random computer, with probability proportional to its free kernel
+    slots times its configured ``weight``
+"""
+import heapq
+import itertools
+import random
+
+POLICIES = ("least_loaded", "power_of_two", "weighted")
+
+
+class _FenwickTree(object):
+    """ Prefix sums over a growable list of non-negative weights. """
+    def __init__(self):
+        self._tree = [0.0]
+        self._values = []
+
+    def append(self, value):
+        self._values.append(0.0)
+        self._tree.append(0.0)
+        i = len(self._values)
+        # fold in the partial sums this new node covers
+        j = i - 1
+        low = i - (i & -i)
+        while j > low:
+            self._tree[i] += self._tree[j]
+            j -= j & -j
+        self.set(i - 1, value)
+
+    def set(self, index, value):
+        delta = value - self._values[index]
+        self._values[index] = value
+        i = index + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        i = len(self._values)
+        s = 0.0
+        while i > 0:
+            s += self._tree[i]
+            i -= i & -i
+        return s
+
+    def find(self, target):
+        """ Index of the first element whose prefix sum exceeds target. """
+        pos = 0
+        step = 1
+        while step * 2 < len(self._tree):
+            step *= 2
+        while step:
+            nxt = pos + step
+            if nxt < len(self._tree) and self._tree[nxt] <= target:
+                pos = nxt
+                target -= self._tree[nxt]
+            step //= 2
+        return min(pos, len(self._values) - 1)
+
+
+class Placement(object):
+    """
+    Indexed view of the free capacity of all computers.
+
+    :arg str policy: one of :data:`POLICIES`
+    """
+    def __init__(self, policy="least_loaded"):
+        if policy not in POLICIES:
+            raise ValueError("Unknown placement policy %r" % (policy,))
+        self.policy = policy
+        self._comps = {} # comp_id: state, see add_computer
+        self._heap = [] # [score, sequence number, comp_id or None if invalidated]
+        self._entries = {} # comp_id: live heap entry
+        self._counter = itertools.count()
+        self._eligible = [] # comp_ids in the heap, for random sampling
+        self._positions = {} # comp_id: index into _eligible
+        self._slots = _FenwickTree()
+        self._slot_index = {} # comp_id: index into _slots
+        self._slot_ids = []
+
+    def add_computer(self, comp_id, cfg):
+        """
+        Start placing kernels on a computer.
+
+        :arg str comp_id: id of the computer
+        :arg dict cfg: computer configuration; uses ``max_kernels``,
+            ``weight``, ``max_load`` (load average per CPU) and
+            ``min_free_memory`` (bytes)
+        """
+        self._comps[comp_id] = {
+            "capacity": cfg["max_kernels"],
+            "weight": cfg.get("weight", 1),
+            "max_load": cfg.get("max_load"),
+            "min_free_memory": cfg.get("min_free_memory"),
+            "kernels": 0,
+            "load": {},
+            "spawn_latency": 0.0,
+            "available": True}
+        if comp_id not in self._slot_index:
+            self._slot_index[comp_id] = len(self._slot_ids)
+            self._slot_ids.append(comp_id)
+            self._slots.append(0.0)
+        self._reindex(comp_id)
+
+    def remove_computer(self, comp_id):
+        """ Stop placing kernels on a computer. """
+        self._comps.pop(comp_id, None)
+        self._unindex(comp_id)
+        if comp_id in self._slot_index:
+            self._slots.set(self._slot_index[comp_id], 0.0)
+
+    def set_available(self, comp_id, available):
+        """ Include or exclude a computer regardless of its load. """
+        if comp_id in self._comps:
+            self._comps[comp_id]["available"] = available
+            self._reindex(comp_id)
+
+    def update(self, comp_id, kernels=None, load=None, spawn_latency=None):
+        """
+        Update what is known about a computer and reindex it.
+
+        :arg int kernels: number of kernels on the computer
+        :arg dict load: load snapshot reported by the computer; uses
+            ``loadavg`` (1 minute load average), ``cpus`` and
+            ``free_memory`` (bytes)
+        :arg float spawn_latency: seconds it takes to start a kernel
+        """
+        comp = self._comps.get(comp_id)
+        if comp is None:
+            return
+        if kernels is not None:
+            comp["kernels"] = kernels
+        if load is not None:
+            comp["load"] = load
+        if spawn_latency is not None:
+            comp["spawn_latency"] = spawn_latency
+        self._reindex(comp_id)
+
+    def score(self, comp_id):
+        """
+        The load score of a computer: the larger of the fraction of its
+        kernel slots in use and its load average per CPU, plus a tenth
+        of its spawn latency in seconds. Lower is better.
+        """
+        comp = self._comps[comp_id]
+        score = float(comp["kernels"]) / comp["capacity"]
+        load = comp["load"]
+        if "loadavg" in load:
+            score = max(score, load["loadavg"] / load.get("cpus", 1))
+        return score + 0.1 * comp["spawn_latency"]
+
+    def is_hot(self, comp_id, count=True):
+        """
+        :arg bool count: whether a computer with all kernel slots in
+            use counts as hot
+        :returns: whether the computer should not get new kernels
+        :rtype: bool
+        """
+        comp = self._comps[comp_id]
+        if not comp["available"] or (count and comp["kernels"] >= comp["capacity"]):
+            return True
+        load = comp["load"]
+        if comp["max_load"] is not None and "loadavg" in load \
+                and load["loadavg"] / load.get("cpus", 1) > comp["max_load"]:
+            return True
+        if comp["min_free_memory"] is not None and "free_memory" in load \
+                and load["free_memory"] < comp["min_free_memory"]:
+            return True
+        return False
+
+    def _unindex(self, comp_id):
+        entry = self._entries.pop(comp_id, None)
+        if entry is not None:
+            entry[2] = None
+        i = self._positions.pop(comp_id, None)
+        if i is not None:
+            last = self._eligible.pop()
+            if last != comp_id:
+                self._eligible[i] = last
+                self._positions[last] = i
+
+    def _reindex(self, comp_id):
+        self._unindex(comp_id)
+        if comp_id not in self._comps:
+            return
+        comp = self._comps[comp_id]
+        free = 0.0
+        if not self.is_hot(comp_id):
+            entry = [self.score(comp_id), next(self._counter), comp_id]
+            self._entries[comp_id] = entry
+            heapq.heappush(self._heap, entry)
+            if len(self._heap) > 2 * len(self._entries) + 16:
+                # drop invalidated entries
+                self._heap = self._entries.values()
+                heapq.heapify(self._heap)
+            self._positions[comp_id] = len(self._eligible)
+            self._eligible.append(comp_id)
+            free = float(comp["capacity"] - comp["kernels"]) * comp["weight"]
+        self._slots.set(self._slot_index[comp_id], free)
+
+    def _least_loaded(self, exclude, accept):
+        heap = self._heap
+        skipped = []
+        found = None
+        while heap:
+            entry = heap[0]
+            if entry[2] is None:
+                heapq.heappop(heap)
+            elif entry[2] in exclude or not accept(entry[2]):
+                skipped.append(heapq.heappop(heap))
+            else:
+                found = entry[2]
+                break
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return found
+
+    def pick(self, exclude=(), accept=None):
+        """
+        Choose a computer for a new kernel using the placement policy.
+
+        :arg exclude: ids of computers that should not be used
+        :arg callable accept: if given, only computers for which
+            ``accept(comp_id)`` is true are considered
+        :returns: the id of the chosen computer
+        :rtype: str
+        :raises IOError: if no computer can take a new kernel
+        """
+        if accept is None:
+            accept = lambda comp_id: True
+        ok = lambda c: c not in exclude and accept(c)
+        found = None
+        if self.policy == "power_of_two" and self._eligible:
+            a, b = random.choice(self._eligible), random.choice(self._eligible)
+            candidates = [c for c in (a, b) if ok(c)]
+            if candidates:
+                found = min(candidates, key=self.score)
+        elif self.policy == "weighted":
+            total = self._slots.total()
+            if total > 0:
+                c = self._slot_ids[self._slots.find(random.uniform(0, total))]
+                if c in self._positions and ok(c):
+                    found = c
+        if found is None:
+            found = self._least_loaded(exclude, accept)
+        if found is None:
+            raise IOError("Could not find open computer. There are %d computers available."
+                          % len(self._comps))
+        return found
+
+    def status(self):
+        """
+        :returns: score, load and eligibility of every computer
+        :rtype: dict
+        """
+        return {"policy": self.policy,
+                "computers": dict((comp_id, dict(comp, score=self.score(comp_id),
+                                                 hot=self.is_hot(comp_id)))
+                                  for comp_id, comp in self._comps.iteritems())}
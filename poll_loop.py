@@ -0,0 +1,140 @@
+"""
+A minimal event loop for the untrusted side.
+
+The receiver forks kernels from its own process, so it cannot use the
+Tornado IOLoop singleton: every forked kernel would inherit it (and its
+epoll descriptor) and then start its own IOLoop. This loop keeps no
+state that outlives a call to :meth:`zmq.Poller.poll`, which makes it
+safe to fork from inside a callback.
+"""
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import signal
+import time
+
+import zmq
+
+
+class PollLoop(object):
+    """
+    Dispatches readable ZMQ sockets, readable file descriptors and timers.
+    """
+    def __init__(self):
+        self._poller = zmq.Poller()
+        self._handlers = {} # socket or fd: callback
+        self._timers = [] # heap of [deadline, sequence number, callback or None if cancelled]
+        self._counter = itertools.count()
+        self._signal_handlers = {} # signal number: callback
+        self._signals = set() # signals received but not dispatched yet
+        self._wakeup = None # (read, write) ends of the signal wakeup pipe
+        self.running = False
+
+    def add_handler(self, obj, callback):
+        """
+        Call ``callback()`` whenever ``obj`` is readable.
+
+        :arg obj: a ZMQ socket or a file descriptor
+        """
+        self._handlers[obj] = callback
+        self._poller.register(obj, zmq.POLLIN)
+
+    def remove_handler(self, obj):
+        """ Stop watching a socket or file descriptor. """
+        if self._handlers.pop(obj, None) is not None:
+            self._poller.unregister(obj)
+
+    def add_signal_handler(self, signum, callback):
+        """
+        Call ``callback()`` from the loop after the signal ``signum`` is
+        received, instead of from the signal handler.
+
+        The signal handler only records the signal; the interpreter writes
+        to a pipe watched by the loop (see :func:`signal.set_wakeup_fd`),
+        so the loop wakes up even if it is blocked in
+        :meth:`zmq.Poller.poll`. A process forked from the loop should call
+        :meth:`reset_signals`.
+        """
+        if self._wakeup is None:
+            self._wakeup = os.pipe()
+            for fd in self._wakeup:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            signal.set_wakeup_fd(self._wakeup[1])
+            self.add_handler(self._wakeup[0], self._dispatch_signals)
+        self._signal_handlers[signum] = callback
+        signal.signal(signum, lambda signum, frame: self._signals.add(signum))
+        # Restart interrupted system calls other than the poll itself
+        signal.siginterrupt(signum, False)
+
+    def reset_signals(self):
+        """
+        Restore the default handlers of the signals handled by the loop and
+        stop waking it up, e.g. in a forked child.
+        """
+        for signum in self._signal_handlers:
+            signal.signal(signum, signal.SIG_DFL)
+        if self._wakeup is not None:
+            signal.set_wakeup_fd(-1)
+
+    def _dispatch_signals(self):
+        try:
+            while os.read(self._wakeup[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        while self._signals:
+            callback = self._signal_handlers.get(self._signals.pop())
+            if callback is not None:
+                callback()
+
+    def call_later(self, delay, callback):
+        """
+        Call ``callback()`` after ``delay`` seconds.
+
+        :returns: a handle for :meth:`cancel`
+        """
+        timer = [time.time() + delay, next(self._counter), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        """ Cancel a timer returned by :meth:`call_later`. """
+        timer[2] = None
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+
+    def start(self):
+        """ Run the loop until :meth:`stop` is called. """
+        self.running = True
+        while self.running:
+            while self._timers and self._timers[0][2] is None:
+                heapq.heappop(self._timers)
+            timeout = None
+            if self._timers:
+                timeout = max(self._timers[0][0] - time.time(), 0) * 1000
+            try:
+                events = self._poller.poll(timeout)
+            except zmq.ZMQError as e:
+                # a signal arrived; its wakeup byte is handled next time
+                if e.errno != errno.EINTR:
+                    raise
+                events = []
+            for obj, event in events:
+                callback = self._handlers.get(obj)
+                if callback is not None:
+                    callback()
+            self._run_timers()
+
+    def stop(self):
+        """ Stop the loop after the current iteration. """
+        self.running = False
@@ -0,0 +1,274 @@
+"""
+Adaptive sizing of the preforked kernel pool.
+
+The number of preforked kernels a computer keeps ready follows the
+observed demand: by Little's law, the kernels handed out while one
+replacement is being started are ``arrival rate * spawn latency``.
+The target per computer is that figure (scaled by a headroom factor and
+by the computer's share of total capacity) clamped to the computer's
+``preforked_min`` and ``preforked_max``.
+"""
+import math
+import time
+from collections import OrderedDict, deque
+from Queue import Empty
+
+
+class PreforkPool(object):
+    """
+    Book-keeping for preforked kernels on the trusted side.
+
+    The pool does not start or kill kernels itself; the kernel manager
+    asks it which kernels to add (:meth:`wanted`) and which to retire
+    (:meth:`surplus`, :meth:`stale`) and reports back what happened
+    (:meth:`grow`, :meth:`spawning`, :meth:`add`).
+
+    :arg float half_life: seconds after which an observation of the
+        request arrival rate or the spawn latency counts half as much
+    :arg float headroom: factor applied to the estimated number of
+        kernels consumed while a replacement is spawning
+    """
+    def __init__(self, half_life=60.0, headroom=2.0):
+        self.tau = half_life / math.log(2)
+        self.headroom = headroom
+        self._rate = 0.0 # decayed request arrival rate, requests per second
+        self._rate_time = time.time()
+        self._comps = {} # comp_id: {"min", "max", "max_age", "capacity", "spawn_latency", "spawning", "target"}
+        self._ready = {} # comp_id: OrderedDict(kernel_id: time the kernel became ready)
+        self.decisions = deque(maxlen=100) # recent (time, comp_id, action, count, reason)
+
+    def add_computer(self, comp_id, cfg):
+        """
+        Start tracking a computer.
+
+        :arg str comp_id: id of the computer
+        :arg dict cfg: computer configuration; uses ``preforked_min``,
+            ``preforked_max``, ``preforked_max_age``,
+            ``preforked_kernels`` (initial target) and ``max_kernels``
+        """
+        initial = cfg.get("preforked_kernels", 0)
+        lo = cfg.get("preforked_min", initial)
+        hi = max(lo, cfg.get("preforked_max", initial))
+        self._comps[comp_id] = {
+            "min": lo,
+            "max": hi,
+            "max_age": cfg.get("preforked_max_age", float("inf")),
+            "capacity": cfg.get("max_kernels", 1),
+            "spawn_latency": None,
+            "spawning": 0,
+            "target": min(max(initial, lo), hi)}
+        self._ready[comp_id] = OrderedDict()
+
+    def remove_computer(self, comp_id):
+        """
+        Stop tracking a computer and forget its preforked kernels.
+
+        :returns: ids of the preforked kernels that were on the computer
+        :rtype: list
+        """
+        self._comps.pop(comp_id, None)
+        return self._ready.pop(comp_id, OrderedDict()).keys()
+
+    def clear(self, comp_id):
+        """ Forget the preforked kernels of a computer, e.g. after a purge. """
+        if comp_id in self._ready:
+            self._ready[comp_id].clear()
+
+    def record_request(self):
+        """ Record the arrival of a request for a kernel. """
+        self._rate = self.arrival_rate() + 1.0 / self.tau
+        self._rate_time = time.time()
+
+    def arrival_rate(self):
+        """
+        :returns: exponentially decayed request arrival rate
+        :rtype: float
+        """
+        return self._rate * math.exp((self._rate_time - time.time()) / self.tau)
+
+    def spawning(self, comp_id):
+        """ Record that a preforked kernel is being started on a computer. """
+        self._comps[comp_id]["spawning"] += 1
+
+    def pending(self, comp_id):
+        """ :returns: number of preforked kernels being started on a computer
+        :rtype: int """
+        comp = self._comps.get(comp_id)
+        return comp["spawning"] if comp is not None else 0
+
+    def spawn_failed(self, comp_id):
+        """ Record that starting a preforked kernel failed. """
+        if comp_id in self._comps:
+            self._comps[comp_id]["spawning"] -= 1
+
+    def add(self, kernel_id, comp_id, latency):
+        """
+        Add a freshly started kernel to the pool.
+
+        :arg str kernel_id: id of the started kernel
+        :arg str comp_id: id of the computer it runs on
+        :arg float latency: seconds it took to start the kernel
+        :returns: False if the computer is no longer tracked
+        """
+        comp = self._comps.get(comp_id)
+        if comp is None:
+            return False
+        comp["spawning"] -= 1
+        if comp["spawn_latency"] is None:
+            comp["spawn_latency"] = latency
+        else:
+            comp["spawn_latency"] = 0.8 * comp["spawn_latency"] + 0.2 * latency
+        self._ready[comp_id][kernel_id] = time.time()
+        return True
+
+    def adopt(self, kernel_id, comp_id):
+        """
+        Add a kernel that was preforked by an earlier web server (see
+        :mod:`checkpoint`) or whose lease was not claimed (see
+        :mod:`lease`). It counts as ready from now on.
+
+        :returns: False if the computer is not tracked
+        """
+        if comp_id not in self._comps:
+            return False
+        self._ready[comp_id][kernel_id] = time.time()
+        return True
+
+    def pop(self, comp_id=None):
+        """
+        Take a preforked kernel out of the pool.
+
+        :arg str comp_id: computer to take the kernel from; by default
+            the computer with the most preforked kernels is used
+        :returns: the oldest preforked kernel id on the computer and
+            the computer id
+        :rtype: tuple
+        :raises Queue.Empty: if there is no preforked kernel
+        """
+        if comp_id is None:
+            comp_id = max(self._ready, key=lambda c: len(self._ready[c])) \
+                if self._ready else None
+        ready = self._ready.get(comp_id)
+        if not ready:
+            raise Empty
+        kernel_id = ready.popitem(last=False)[0]
+        return kernel_id, comp_id
+
+    def spawn_latency(self, comp_id):
+        """
+        :returns: moving average of the seconds it takes to start a
+            kernel on the computer, or None if unknown
+        """
+        comp = self._comps.get(comp_id)
+        return comp["spawn_latency"] if comp is not None else None
+
+    def discard(self, kernel_id, comp_id):
+        """ Forget a preforked kernel that ended without being used. """
+        self._ready.get(comp_id, {}).pop(kernel_id, None)
+
+    def qsize(self, comp_id=None):
+        """
+        :returns: number of preforked kernels on a computer or in total
+        :rtype: int
+        """
+        if comp_id is not None:
+            return len(self._ready.get(comp_id, ()))
+        return sum(len(r) for r in self._ready.itervalues())
+
+    def _decide(self, comp_id, action, count, reason):
+        self.decisions.append((time.time(), comp_id, action, count, reason))
+
+    def update_targets(self):
+        """
+        Recompute the target pool size of every computer from the
+        current arrival rate and spawn latencies.
+        """
+        rate = self.arrival_rate()
+        total = float(sum(c["capacity"] for c in self._comps.itervalues())) or 1.0
+        for comp_id, comp in self._comps.iteritems():
+            latency = comp["spawn_latency"]
+            if latency is None:
+                continue
+            share = rate * comp["capacity"] / total
+            target = int(math.ceil(share * latency * self.headroom))
+            target = min(max(target, comp["min"]), comp["max"])
+            if target != comp["target"]:
+                self._decide(comp_id, "target", target,
+                             "rate %.3f/s, spawn latency %.2fs" % (rate, latency))
+                comp["target"] = target
+
+    def wanted(self, comp_id):
+        """
+        :returns: number of kernels to start to reach the target
+        :rtype: int
+        """
+        comp = self._comps.get(comp_id)
+        if comp is None:
+            return 0
+        n = comp["target"] - len(self._ready[comp_id]) - comp["spawning"]
+        return max(n, 0)
+
+    def grow(self, comp_id, count):
+        """
+        Record that kernels are being started to bring a computer's pool
+        up to its target, as :meth:`wanted` asked for.
+        """
+        comp = self._comps.get(comp_id)
+        if comp is not None and count > 0:
+            self._decide(comp_id, "grow", count, "below target %d" % comp["target"])
+
+    def surplus(self, comp_id):
+        """
+        Take one kernel above the target size out of the pool. Only one
+        kernel is retired per call so that the pool shrinks gradually.
+
+        :returns: kernel ids to be killed
+        :rtype: list
+        """
+        comp = self._comps.get(comp_id)
+        ready = self._ready.get(comp_id)
+        if comp is None or len(ready) <= comp["target"]:
+            return []
+        self._decide(comp_id, "shrink", 1, "above target %d" % comp["target"])
+        return [ready.popitem(last=False)[0]]
+
+    def stale(self, comp_id):
+        """
+        Take kernels that have waited longer than ``preforked_max_age``
+        out of the pool.
+
+        :returns: kernel ids to be killed
+        :rtype: list
+        """
+        comp = self._comps.get(comp_id)
+        ready = self._ready.get(comp_id)
+        if comp is None:
+            return []
+        cutoff = time.time() - comp["max_age"]
+        old = []
+        for kernel_id, ready_time in ready.iteritems():
+            # kernels are kept in the order they became ready
+            if ready_time > cutoff:
+                break
+            old.append(kernel_id)
+        for kernel_id in old:
+            del ready[kernel_id]
+        if old:
+            self._decide(comp_id, "recycle", len(old),
+                         "older than %ss" % comp["max_age"])
+        return old
+
+    def status(self):
+        """
+        :returns: the state of the pool and its recent decisions, for
+            monitoring
+        :rtype: dict
+        """
+        comps = {}
+        for comp_id, comp in self._comps.iteritems():
+            c = dict(comp)
+            c["ready"] = len(self._ready[comp_id])
+            comps[comp_id] = c
+        return {"arrival_rate": self.arrival_rate(),
+                "computers": comps,
+                "decisions": list(self.decisions)}
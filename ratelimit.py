@@ -0,0 +1,185 @@
+"""
+Rate limits and concurrent kernel quotas for clients.
+
+Every kernel request is charged to a few keys: the client's IP address
+(``ip``), the origin of the page embedding the cell (``referer``) and,
+for clients that send one, an API key (``key``). A client with a known
+API key is charged to the key only. Every kind of key has a token bucket
+(``rate`` requests per second, in bursts of up to ``burst``) and a limit
+on the number of kernels running at a time (``kernels``). A request is
+refused if any of its keys is over a limit.
+
+All operations take O(1) time per key. Token buckets are kept for the
+``max_keys`` most recently seen keys; a key that has not been seen for a
+while has a full bucket anyway.
+"""
+import time
+import urlparse
+from collections import OrderedDict
+
+KINDS = ("ip", "referer", "key")
+
+
+def referer_origin(referer):
+    """
+    :returns: the scheme and host of a referer URL, or None if it has none
+    :rtype: str
+    """
+    parts = urlparse.urlsplit(referer or "")
+    if not parts.netloc:
+        return None
+    return "%s://%s" % (parts.scheme, parts.netloc.lower())
+
+
+class RateLimits(object):
+    """
+    Token buckets and kernel counts for client keys.
+
+    :arg dict limits: for each kind of key in :data:`KINDS`, a dictionary
+        with the ``rate``, ``burst`` and ``kernels`` limits; a missing kind
+        or a limit that is None is not enforced
+    :arg dict api_keys: known API keys, with limits that override those
+        of ``limits["key"]``
+    :arg int max_keys: number of token buckets kept
+    """
+    def __init__(self, limits=None, api_keys=None, max_keys=100000):
+        self.limits = limits or {}
+        self.api_keys = api_keys or {}
+        self.max_keys = max_keys
+        self._buckets = OrderedDict() # (kind, value): [tokens, time, requests, refused]; least recently used first
+        self._kernels = {} # (kind, value): number of kernels running or starting
+        self._tickets = {} # kernel_id: keys its kernel is charged to
+        self.stats = {"allowed": 0, "refused_rate": 0, "refused_kernels": 0}
+
+    def keys(self, remote_ip, referer=None, api_key=None):
+        """
+        The keys a request is charged to.
+
+        :raises KeyError: if ``api_key`` is given but not known
+        :rtype: list
+        """
+        if api_key:
+            if api_key not in self.api_keys:
+                raise KeyError(api_key)
+            return [("key", api_key)]
+        keys = [("ip", remote_ip)]
+        origin = referer_origin(referer)
+        if origin is not None:
+            keys.append(("referer", origin))
+        return keys
+
+    def _limit(self, key, name):
+        if key[0] == "key" and name in self.api_keys.get(key[1], {}):
+            return self.api_keys[key[1]][name]
+        return self.limits.get(key[0], {}).get(name)
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = [self._limit(key, "burst") or 1, now, 0, 0]
+        else:
+            rate = self._limit(key, "rate")
+            if rate is not None:
+                burst = self._limit(key, "burst") or 1
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        self._buckets[key] = bucket
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def acquire(self, keys, count=1):
+        """
+        Charge a kernel request to its keys, if none of them is over a
+        limit. A charged request holds a kernel of every key until it is
+        :meth:`released <release>`.
+
+        :arg list keys: keys from :meth:`keys`
+        :arg int count: number of kernels requested at once, which are
+            charged as that many requests
+        :returns: None if the request may go ahead, or the key that is
+            over its limit, the limit (``"rate"`` or ``"kernels"``) and the
+            seconds after which the request could go ahead (None if that
+            depends on kernels ending)
+        :rtype: tuple
+        """
+        now = time.time()
+        buckets = [self._bucket(key, now) for key in keys]
+        for key, bucket in zip(keys, buckets):
+            bucket[2] += 1
+            kernels = self._limit(key, "kernels")
+            if kernels is not None and self._kernels.get(key, 0) + count > kernels:
+                bucket[3] += 1
+                self.stats["refused_kernels"] += 1
+                return key, "kernels", None
+            rate = self._limit(key, "rate")
+            if rate is not None and bucket[0] < count:
+                bucket[3] += 1
+                self.stats["refused_rate"] += 1
+                if rate <= 0 or count > (self._limit(key, "burst") or 1):
+                    # the bucket never holds enough tokens
+                    return key, "rate", None
+                return key, "rate", (count - bucket[0]) / rate
+        for key, bucket in zip(keys, buckets):
+            if self._limit(key, "rate") is not None:
+                bucket[0] -= count
+            self._kernels[key] = self._kernels.get(key, 0) + count
+        self.stats["allowed"] += 1
+        return None
+
+    def assign(self, kernel_id, keys):
+        """ Record that the kernel of a request from :meth:`acquire` started. """
+        self._tickets[kernel_id] = keys
+
+    def release(self, keys, count=1):
+        """ Give back ``count`` of the kernels that :meth:`acquire` charged
+        to keys. """
+        if count <= 0:
+            return
+        for key in keys:
+            left = self._kernels.get(key, 0) - count
+            if left > 0:
+                self._kernels[key] = left
+            else:
+                self._kernels.pop(key, None)
+
+    def kernel_ended(self, kernel_id):
+        """ Give back the kernels of a kernel from :meth:`assign`. """
+        keys = self._tickets.pop(kernel_id, None)
+        if keys is not None:
+            self.release(keys)
+
+    def usage(self, kind=None):
+        """
+        :arg str kind: report only keys of this kind
+        :returns: for every key with running kernels or a token bucket,
+            its running kernels, remaining tokens and the requests made and
+            refused since its bucket was created, keyed by ``kind:value``
+        :rtype: dict
+        """
+        now = time.time()
+        report = {}
+        for key in set(self._buckets) | set(self._kernels):
+            if kind is not None and key[0] != kind:
+                continue
+            entry = {"kernels": self._kernels.get(key, 0)}
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                rate = self._limit(key, "rate")
+                tokens = bucket[0]
+                if rate is not None:
+                    tokens = min(self._limit(key, "burst") or 1,
+                                 tokens + (now - bucket[1]) * rate)
+                entry.update(tokens=tokens, requests=bucket[2], refused=bucket[3])
+            report["%s:%s" % key] = entry
+        return report
+
+    def status(self):
+        """
+        :returns: the counters in :attr:`stats` and the number of keys with
+            token buckets and with running kernels
+        :rtype: dict
+        """
+        return dict(self.stats, buckets=len(self._buckets),
+                    keys_with_kernels=len(self._kernels),
+                    kernels=len(self._tickets))
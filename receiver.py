@@ -1,28 +1,127 @@
 from untrusted_kernel_manager import UntrustedMultiKernelManager
+from forking_kernel_manager import makedirs
 import zmq
 from zmq import ssh
+import os
 import sys
+import time
+import control_codec
+from collections import deque
+from multiprocessing import cpu_count
 from misc import Timer, sage_json
+from poll_loop import PollLoop
+from iopub_mux import Forwarder
+from service_kernels import ServiceKernels
+
+# Seconds for which a load snapshot is reused in replies
+LOAD_SNAPSHOT_AGE = 1.0
+# Seconds between samples of the memory use of the kernels
+MEMORY_SAMPLE_INTERVAL = 30.0
+# Address of events on the trusted side, see sender.EVENT_CHANNEL
+EVENT_CHANNEL = "events"
+
+def deferred(handler):
+    """
+    Mark a message handler that does not return its reply but passes it
+    to the ``reply`` function it is called with, possibly from a later
+    event loop callback.
+    """
+    handler.deferred = True
+    return handler
 
 class Receiver(object):
-    def __init__(self, ip, tmp_dir):
+    """
+    Handles the control messages of the trusted side and forks kernels.
+
+    :arg str ip: address to bind the control socket and the kernels to
+    :arg str tmp_dir: directory for the kernels' working directories
+    :arg bool zygote: prepare as much of a kernel as possible once in this
+        process before forking, see :meth:`prepare_zygote`
+    :arg bool forward_iopub: republish the iopub messages of all kernels on
+        one socket, see :class:`iopub_mux.Forwarder`
+    :arg bool ipc: bind this receiver's sockets and the kernels' sockets to
+        files in ``tmp_dir`` instead of TCP ports, for a web server on the
+        same machine
+    :arg int service_kernels: number of warm service kernels that run
+        ``execute_forked`` requests, see :mod:`service_kernels`
+
+    The endpoint of the control socket is printed on the first line of
+    standard output, followed by whether Sage could be imported.
+    """
+    def __init__(self, ip, tmp_dir, zygote=False, forward_iopub=False, ipc=False,
+                 service_kernels=0):
         self.context = zmq.Context()
         self.dealer = self.context.socket(zmq.DEALER)
-        self.port = self.dealer.bind_to_random_port("tcp://%s" % ip)
-        print self.port
+        if ipc:
+            makedirs(tmp_dir)
+            self.endpoint = "ipc://" + os.path.join(tmp_dir, ".receiver-%d" % os.getpid())
+            self.dealer.bind(self.endpoint)
+        else:
+            self.endpoint = "tcp://%s:%d" % (ip, self.dealer.bind_to_random_port("tcp://%s" % ip))
+        print self.endpoint
         sys.stdout.flush()
         self.sage_mode = self.setup_sage()
         print self.sage_mode
         sys.stdout.flush()
+        self.zygote_ns = None
+        if zygote:
+            self.prepare_zygote()
+        self.loop = PollLoop()
         self.km = UntrustedMultiKernelManager(ip,
-                update_function=self.update_dict_with_sage, tmp_dir=tmp_dir)
-        self.timer = Timer("", reset=True)
+                update_function=self.update_dict_with_sage, tmp_dir=tmp_dir,
+                loop=self.loop, transport="ipc" if ipc else "tcp")
+        self.km.exit_callback = self._kernel_exited
+        self.service = None
+        if service_kernels:
+            self.service = ServiceKernels(self.loop, self.km.fkm.workspaces, service_kernels,
+                                          self.service_namespace, self.sage_mode)
+        self.forwarder = None
+        if forward_iopub:
+            path = os.path.join(tmp_dir, ".forward-%d" % os.getpid()) if ipc else None
+            self.forwarder = Forwarder(self.context, self.loop, ip, path)
+        self.cpus = cpu_count()
+        self.fork_times = deque(maxlen=100) # seconds taken by recent kernel starts
+        self._load = None
+        self._memory = None
 
     def start(self):
-        self.listen = True
-        while self.listen:
-            source = self.dealer.recv()
-            msg = self.dealer.recv_pyobj()
+        if self.service is not None:
+            self.service.start()
+        self.loop.add_handler(self.dealer, self._on_message)
+        self._sample_memory_periodically()
+        self.loop.start()
+
+    def _sample_memory_periodically(self):
+        self.sample_memory()
+        self.loop.call_later(MEMORY_SAMPLE_INTERVAL, self._sample_memory_periodically)
+
+    def sample_memory(self):
+        """
+        Sample the memory use of this process and of every kernel and keep
+        a summary of it for the load snapshots.
+
+        :returns: the memory use of every kernel, keyed by kernel id, see
+            :func:`forking_kernel_manager.process_memory`
+        :rtype: dict
+        """
+        usage = self.km.fkm.memory_usage()
+        total = dict.fromkeys(("rss", "pss", "uss", "shared"), 0)
+        for kernel in usage["kernels"].itervalues():
+            for k in total:
+                total[k] += kernel[k]
+        self._memory = {"time": time.time(),
+                        "parent": usage["parent"],
+                        "kernels": dict(total, count=len(usage["kernels"]))}
+        return usage["kernels"]
+
+    def _on_message(self):
+        while self.dealer.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            source, msg_id, msg = self.dealer.recv_multipart()
+            try:
+                msg = control_codec.decode(msg)
+            except control_codec.CodecError as e:
+                logger.error("Undecodable message: %s", e)
+                msg = {}
 
             msg_type = "invalid_message"
             if msg.get("type") is not None:
@@ -33,18 +132,105 @@ class Receiver(object):
             if msg.get("content") is None:
                 msg["content"] = {}
 
-            self.timer()
+            timer = Timer("", reset=True)
             logger.debug("Start handler %s" % msg_type)
             handler = getattr(self, msg_type)
-            response = handler(msg["content"])
-            logger.debug("Finished handler %s: %s"%(msg_type, self.timer))
 
-            self.dealer.send(source, zmq.SNDMORE)
-            self.dealer.send_pyobj(response)
+            def reply(response, msg_type=msg_type, source=source,
+                      msg_id=msg_id, timer=timer):
+                logger.debug("Finished handler %s: %s"%(msg_type, timer))
+                self.dealer.send_multipart([source, msg_id, control_codec.encode(response)])
+
+            if getattr(handler, "deferred", False):
+                handler(msg["content"], reply)
+            else:
+                reply(handler(msg["content"]))
+
+    def send_event(self, msg_type, content):
+        """
+        Send a message to the trusted side without being asked; it is
+        handled by the ``event_callback`` of the trusted side's sender.
+        """
+        msg = {"type": msg_type, "content": content, "load": self.load_snapshot()}
+        self.dealer.send_multipart([EVENT_CHANNEL, "", control_codec.encode(msg)])
+
+    def _forward(self, reply_content):
+        """ Forward the iopub messages of a newly started kernel. """
+        if self.forwarder is not None:
+            connection = reply_content["connection"]
+            self.forwarder.add(reply_content["kernel_id"], connection)
+            connection["forward_endpoint"] = self.forwarder.endpoint
+
+    def _unforward(self, kernel_id):
+        if self.forwarder is not None:
+            self.forwarder.remove(kernel_id)
+
+    def _kernel_exited(self, kernel_id, exitcode, reason):
+        self._load = None
+        self._unforward(kernel_id)
+        self.send_event("kernel_exit", {"kernel_id": kernel_id,
+                                        "exitcode": exitcode,
+                                        "reason": reason})
 
     def _form_message(self, content, error=False):
         return {"content": content,
-                "type": "error" if error else "success"}
+                "type": "error" if error else "success",
+                "load": self.load_snapshot()}
+
+    def load_snapshot(self, fresh=False):
+        """
+        A compact summary of the load of this computer, which is attached
+        to every reply so the trusted side always has a recent view of it.
+
+        :arg bool fresh: do not reuse a snapshot taken within the last
+            ``LOAD_SNAPSHOT_AGE`` seconds
+        :returns: the 1-minute load average, number of CPUs, available
+            memory in bytes, number of kernels, number of killed kernels
+            that have not exited yet, percentiles of recent kernel start
+            times in seconds, the resident memory in bytes of this
+            process, from which kernels are forked, the state of the kernel
+            workspaces (see :meth:`workspace.Workspaces.status`) and the
+            last summary of the memory use of this process and the kernels
+            taken by :meth:`sample_memory`
+        :rtype: dict
+        """
+        now = time.time()
+        if not fresh and self._load is not None \
+                and now - self._load["time"] < LOAD_SNAPSHOT_AGE:
+            return self._load
+        page = os.sysconf("SC_PAGE_SIZE")
+        free_memory = None
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        free_memory = int(line.split()[1]) * 1024
+                        break
+        except IOError:
+            pass
+        if free_memory is None:
+            free_memory = os.sysconf("SC_AVPHYS_PAGES") * page
+        try:
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * page
+        except IOError:
+            rss = None
+        times = sorted(self.fork_times)
+        percentile = lambda p: times[min(int(p * len(times)), len(times) - 1)] \
+            if times else None
+        self._load = {"time": now,
+                      "loadavg": os.getloadavg()[0],
+                      "cpus": self.cpus,
+                      "free_memory": free_memory,
+                      "kernels": len(self.km._kernels),
+                      "dying": len(self.km.fkm.dying),
+                      "workspaces": self.km.fkm.workspaces.status(),
+                      "fork_latency": {"p50": percentile(0.5),
+                                       "p90": percentile(0.9),
+                                       "p99": percentile(0.99)},
+                      "rss": rss,
+                      "memory": self._memory}
+        return self._load
 
     def setup_sage(self):
         try:
@@ -319,12 +505,15 @@ from sagenb.misc.support import automatic_names
         sys._sage_.clear = clear
         if self.sage_mode:
             ka.kernel.shell.extension_manager.load_extension('sage.repl.ipython_extension')
-            user_ns.update(self.sage_dict)
-            sage_code = """
-# Ensure unique random state after forking
-set_random_seed()
-"""
-            exec sage_code in user_ns
+        user_ns.update(self.zygote_ns if self.zygote_ns is not None
+                       else self.kernel_namespace())
+        # Ensure unique random state after forking
+        import random
+        random.seed()
+        if "numpy" in sys.modules:
+            sys.modules["numpy"].random.seed()
+        if self.sage_mode:
+            exec "set_random_seed()" in user_ns
         def getsource(obj, is_binary):
             # modified from sage.misc.sagedoc.my_getsource
             from sage.misc.sagedoc import sageinspect, format_src
@@ -337,16 +526,65 @@ set_random_seed()
         from IPython.core import oinspect
         oinspect.getsource = getsource
         import interact_sagecell
+        # interact_sagecell registers this itself when it is first imported,
+        # but in zygote mode that happened before sys._sage_ existed
+        register_handler("sagenb.interact.update_interact",
+                         interact_sagecell.update_interact_msg)
+        sys._sage_.update_interact = interact_sagecell.update_interact
+
+    def kernel_namespace(self):
+        """
+        Import the SageCell modules and collect what they (and Sage) add to
+        the namespace of a kernel.
+
+        In zygote mode this is done once, before any kernel is forked, so
+        that forked kernels share the imported modules and only have to
+        copy the resulting dictionary; otherwise every kernel calls it
+        after it has been forked.
+
+        :rtype: dict
+        """
+        import graphics
+        import interact_sagecell
         import interact_compatibility
         import dynamic
         import exercise
+        ns = dict(self.sage_dict)
         # overwrite Sage's interact command with our own
-        user_ns.update(interact_sagecell.imports)
-        user_ns.update(interact_compatibility.imports)
-        user_ns.update(dynamic.imports)
-        user_ns.update(exercise.imports)
-        user_ns['threejs']=sys._sage_.threejs
-        sys._sage_.update_interact = interact_sagecell.update_interact
+        ns.update(interact_sagecell.imports)
+        ns.update(interact_compatibility.imports)
+        ns.update(dynamic.imports)
+        ns.update(exercise.imports)
+        ns['threejs'] = graphics.show_3d_plot_using_threejs
+        return ns
+
+    def service_namespace(self):
+        """
+        The namespace the code of ``execute_forked`` requests runs in,
+        built once in every service kernel.
+
+        :rtype: dict
+        """
+        return dict(self.zygote_ns if self.zygote_ns is not None
+                    else self.kernel_namespace())
+
+    def prepare_zygote(self):
+        """
+        Do everything in setting up a kernel that does not depend on the
+        particular kernel, so that a forked kernel only has to bind its
+        sockets, fill its namespace and reseed its random state.
+        """
+        # IPKernelApp itself is imported by forking_kernel_manager; these
+        # are imported when a kernel is initialized
+        from IPython.core import oinspect, completer, history
+        if self.sage_mode:
+            import sage.repl.ipython_extension
+            from sage.misc import sagedoc
+        self.zygote_ns = self.kernel_namespace()
+        # Free garbage now rather than in every kernel, where collecting it
+        # would copy the pages it is on
+        import gc
+        gc.collect()
 
     """
     Message Handlers
@@ -355,20 +593,80 @@ set_random_seed()
         """Handler for unsupported messages."""
         return self._form_message({"status": "Invalid message!"}, error = True)
 
-    def start_kernel(self, msg_content):
-        """Handler for start_kernel messages."""
-        resource_limits = msg_content.get("resource_limits")
+    def _start_kernel(self, msg_content, callback, errback):
+        """
+        Start a kernel with the resource limits and workspace quota of a
+        start message. ``callback`` gets the kernel id and connection
+        information, ``errback`` the error.
+        """
+        started = time.time()
+
+        def started_kernel(reply_content):
+            self.fork_times.append(time.time() - started)
+            self._load = None
+            self._forward(reply_content)
+            callback(reply_content)
+
+        def failed(e):
+            logger.error("Error starting kernel: %s", e)
+            errback(e)
+
         try:
-            reply_content = self.km.start_kernel(resource_limits=resource_limits)
-            return self._form_message(reply_content)
+            self.km.start_kernel_async(started_kernel, failed,
+                                       resource_limits=msg_content.get("resource_limits"),
+                                       workspace_quota=msg_content.get("workspace_quota"))
         except Exception as e:
             logger.exception("Error starting kernel")
-            return self._form_message(str(e), error=True)
+            errback(e)
+
+    @deferred
+    def start_kernel(self, msg_content, reply):
+        """Handler for start_kernel messages.
+
+        Other messages are handled while the kernel is starting.
+        """
+        self._start_kernel(msg_content,
+                           lambda reply_content: reply(self._form_message(reply_content)),
+                           lambda e: reply(self._form_message(str(e), error=True)))
+
+    @deferred
+    def start_kernels(self, msg_content, reply):
+        """Handler for start_kernels messages, which start ``count``
+        kernels in one pass, for a page with many cells.
+
+        The reply, once every kernel has started or failed to, lists the
+        kernel ids and connection information of the kernels that started
+        and the errors of those that did not; it is an error reply if no
+        kernel started.
+        """
+        count = max(msg_content.get("count", 1), 1)
+        kernels = []
+        errors = []
+
+        def done():
+            if len(kernels) + len(errors) == count:
+                reply(self._form_message({"kernels": kernels, "errors": errors},
+                                         error=not kernels))
+
+        def callback(reply_content):
+            kernels.append(reply_content)
+            done()
+
+        def errback(e):
+            errors.append(str(e))
+            done()
+
+        for i in range(count):
+            self._start_kernel(msg_content, callback, errback)
 
     def kill_kernel(self, msg_content):
         """Handler for kill_kernel messages."""
         kernel_id = msg_content["kernel_id"]
-        success = self.km.kill_kernel(kernel_id)
+        # The reply does not wait for the kernel to exit
+        success = self.km.kill_kernel(kernel_id, lambda exitcode:
+            logger.debug("Kernel %s exited with %s", kernel_id, exitcode))
+        self._load = None
+        self._unforward(kernel_id)
 
         reply_content = {"status": "Kernel %s killed!"%(kernel_id)}
         if not success:
@@ -379,6 +677,8 @@ set_random_seed()
     def purge_kernels(self, msg_content):
         """Handler for purge_kernels messages."""
         failures = self.km.purge_kernels()
+        if self.forwarder is not None:
+            self.forwarder.clear()
         reply_content = {"status": "All kernels killed!"}
         success = (len(failures) == 0)
         if not success:
@@ -388,7 +688,10 @@ set_random_seed()
     def restart_kernel(self, content):
         """Handler for restart_kernel messages."""
         kernel_id = content["kernel_id"]
-        return self._form_message(self.km.restart_kernel(kernel_id))
+        self._unforward(kernel_id)
+        reply_content = self.km.restart_kernel(kernel_id)
+        self._forward(reply_content)
+        return self._form_message(reply_content)
 
     def interrupt_kernel(self, msg_content):
         """Handler for interrupt_kernel messages."""
@@ -400,20 +703,81 @@ set_random_seed()
             reply_content["status"] = "Could not interrupt kernel %s!"%(kernel_id)
         return self._form_message(reply_content, error=(not success))
 
+    def stats(self, msg_content):
+        """Handler for stats messages.
+
+        The reply carries a fresh load snapshot, taken after sampling the
+        memory use of the kernels, and that memory use per kernel.
+        """
+        kernels = self.sample_memory()
+        self.load_snapshot(fresh=True)
+        return self._form_message({"kernel_memory": kernels})
+
+    @deferred
+    def execute_forked(self, msg_content, reply):
+        """Handler for execute_forked messages, which run ``code`` in a
+        forked child of a service kernel instead of a kernel of its own.
+
+        The reply has the standard output and error of the code and its
+        ``execute_reply``; it is an error reply if this receiver has no
+        service kernels or the code could not be run.
+        """
+        if self.service is None:
+            reply(self._form_message({"status": "No service kernels"}, error=True))
+            return
+
+        def done(result):
+            if result is None:
+                reply(self._form_message({"status": "Could not run the code"}, error=True))
+            else:
+                reply(self._form_message(result))
+
+        self.service.execute(msg_content.get("code", ""), done,
+                             resource_limits=msg_content.get("resource_limits"),
+                             workspace_quota=msg_content.get("workspace_quota"),
+                             timeout=msg_content.get("timeout", 30.0),
+                             user_variables=msg_content.get("user_variables", ()))
+
+    def list_kernels(self, msg_content):
+        """Handler for list_kernels messages, with which a restarted web
+        server finds out which of the kernels in its checkpoint still run."""
+        return self._form_message({"kernels": self.km.kernel_ids()})
+
     def remove_computer(self, msg_content):
         """Handler for remove_computer messages."""
-        self.listen = False
+        self.loop.stop()
+        if self.service is not None:
+            self.service.stop()
         return self.purge_kernels(msg_content)
 
 
 if __name__ == '__main__':
-    ip = sys.argv[1]
-    comp_id = sys.argv[2]
-    tmp_dir = sys.argv[3]
+    import argparse
+    parser = argparse.ArgumentParser(description='Fork kernels for a SageCell web server')
+    parser.add_argument('ip', help='address to bind to')
+    parser.add_argument('comp_id', help='id of this computer on the web server')
+    parser.add_argument('tmp_dir', help='directory for the kernel working directories')
+    parser.add_argument('--zygote', action='store_true',
+                        help='set up as much of a kernel as possible before forking')
+    parser.add_argument('--forward-iopub', action='store_true',
+                        help='republish the iopub messages of all kernels on one socket')
+    parser.add_argument('--ipc', action='store_true',
+                        help='use ipc:// instead of tcp:// sockets, for a web server on this machine')
+    parser.add_argument('--service-kernels', type=int, default=0,
+                        help='number of warm kernels that run /service requests in forked children')
+    args = parser.parse_args()
     from log import receiver_logger
     import uuid
-    logger = receiver_logger.getChild(comp_id[:4])
+    logger = receiver_logger.getChild(args.comp_id[:4])
     logger.debug('started')
-    receiver = Receiver(ip, tmp_dir)
+    receiver = Receiver(args.ip, args.tmp_dir, zygote=args.zygote,
+                        forward_iopub=args.forward_iopub, ipc=args.ipc,
+                        service_kernels=args.service_kernels)
+    # The web server has read the endpoint; once it exits, standard output
+    # is closed, and the receiver should keep running for its successor
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
     receiver.start()
+    receiver.km.fkm.wait_dying()
     logger.debug('ended')
@@ -1,14 +1,35 @@
 import uuid
+import time
+import itertools
 import threading
+from collections import OrderedDict
 import zmq
+from zmq.eventloop import ioloop
 from zmq.eventloop.zmqstream import ZMQStream
-import pickle
+import control_codec
+from control_codec import CodecError
+from log import logger
+
+# Number of timed out requests remembered so that their late replies
+# can still be handed to ``AsyncSender.late_reply_callback``
+EXPIRED_HISTORY = 1000
+# Identity of the channel to which untrusted computers send events (messages
+# that are not replies); receiver.py sends them to this address
+EVENT_CHANNEL = "events"
 
 class AsyncSender(object):
     """
     Manages asynchronous communication between a trusted
     manager with multiple threaded requests and multiple
     untrusted devices.
+
+    Requests are sent over two long-lived DEALER channels
+    connected to the Sender's ROUTER socket: one driven by
+    the IOLoop for asynchronous requests and one (guarded by
+    a lock) for blocking requests. Every request carries a
+    request id frame which the untrusted side echoes back, so
+    a reply is matched to its callback with a single
+    dictionary lookup.
     """
     def __init__(self, filename=None):
         self._dealers = {}
@@ -17,10 +38,30 @@ class AsyncSender(object):
             filename = 'router-ipc/router-%s.ipc'%uuid4()
         self.filename = "ipc://"+filename
 
-        context = zmq.Context()
-        self.router = context.socket(zmq.ROUTER)
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
         self.router.bind(self.filename)
 
+        self._msg_ids = itertools.count()
+        self._pending = {} # msg_id: (comp_id, msg, callback, errback, sent, timeout handle)
+        self._expired = OrderedDict() # msg_id: (comp_id, msg) of timed out requests
+        # Called as late_reply_callback(comp_id, msg, reply) when a reply
+        # arrives after its request timed out
+        self.late_reply_callback = None
+        # Called as reply_callback(comp_id, reply) with every reply from an
+        # untrusted computer, before the reply is handed to its requester
+        self.reply_callback = None
+        # Called as event_callback(comp_id, event) with every event from an
+        # untrusted computer, see receive_events
+        self.event_callback = None
+        self._event_channel = None
+        self.stats = {"sent": 0, "replied": 0, "timed_out": 0, "late": 0,
+                      "undecodable": 0}
+        self.rtt = {} # comp_id: moving average of the round trip time
+        self._async_channel = None
+        self._sync_channel = None
+        self._sync_lock = threading.Lock()
+
         self.poll = zmq.Poller()
         self.poll.register(self.router, zmq.POLLIN)
 
@@ -54,21 +95,21 @@ class AsyncSender(object):
 
             # If the ROUTER socket has received anything
             if sockets.get(self.router) == zmq.POLLIN:
-                (source, sink, msg) = self.router.recv_multipart()
+                (source, sink, msg_id, msg) = self.router.recv_multipart()
                 if sink in self._dealers:
                     sock = self._dealers[sink]
-                    sock.send_multipart([source, msg])
+                    sock.send_multipart([source, msg_id, msg])
                 else:
-                    self.router.send_multipart([source, source, msg])
+                    self.router.send_multipart([source, source, msg_id, msg])
 
             # If any DEALER socket has received anything
             for dealer_id in self._dealers.keys():
                 sock = self._dealers[dealer_id]
                 if sockets.get(sock) == zmq.POLLIN:
-                    (dest, msg) = sock.recv_multipart()
-                    self.router.send_multipart([dest, dealer_id, msg])
+                    (dest, msg_id, msg) = sock.recv_multipart()
+                    self.router.send_multipart([dest, dealer_id, msg_id, msg])
 
-    def register_computer(self, host, port, comp_id = None):
+    def register_computer(self, host, port, comp_id = None, endpoint = None):
         """
         This registers an untrusted computer and sets up a
         DEALER socket to the specified host:port over TCP.
@@ -79,15 +120,19 @@ class AsyncSender(object):
         :arg str comp_id: A unique ID for the registered
             DEALER socket. This is set to a uuid if it is
             not specified
+        :arg str endpoint: ZMQ endpoint of the untrusted
+            DEALER socket (e.g. ``ipc://...``), used instead
+            of ``host`` and ``port`` if given
         :returns: the unique ID ``comp_id``
         :rtype: str
         """
         if comp_id is None:
             comp_id = str(uuid.uuid4())
+        if endpoint is None:
+            endpoint = "tcp://%s:%d"%(host,port)
 
-        context = zmq.Context()
-        sock = context.socket(zmq.DEALER)
-        sock.connect("tcp://%s:%d"%(host,port))
+        sock = self.context.socket(zmq.DEALER)
+        sock.connect(endpoint)
 
         self._dealers[comp_id] = sock
 
@@ -95,58 +140,182 @@ class AsyncSender(object):
 
         return comp_id
 
-    def send_msg(self, msg, comp_id):
+    def _channel(self, identity=None):
+        """
+        Create a DEALER socket connected to the ROUTER socket.
+        """
+        sock = self.context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, identity or str(uuid.uuid4()))
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.filename)
+        return sock
+
+    def _next_msg_id(self):
+        return "%x" % next(self._msg_ids)
+
+    def send_msg(self, msg, comp_id, timeout=None):
         """
         Sends a message to a given untrusted computer and
         returns the reply.
 
-        A short-lived in-process ZMQ socket is created to
-        the Sender's ROUTER socket and multipart messages
-        are used to asynchronously send the message to the
-        correct untrusted DEALER socket and return the
-        correct reply message.
+        The message is sent through a long-lived DEALER
+        channel connected to the Sender's ROUTER socket, which
+        forwards it to the correct untrusted DEALER socket and
+        routes the reply back. This blocks the calling thread
+        until the reply arrives.
 
         :arg dict msg: message to send
         :arg str comp_id: identifier returned by
             register_computer corresponding to a unique
+        :arg float timeout: seconds to wait for the reply, or
+            None to wait forever
         :returns: reply message from the untrusted side, or
-            an None if an invalid ID was specified
+            an None if an invalid ID was specified or the
+            request timed out
+        """
+        with self._sync_lock:
+            if self._sync_channel is None:
+                self._sync_channel = self._channel()
+            sock = self._sync_channel
+            msg_id = self._next_msg_id()
+            sock.send_multipart([comp_id, msg_id, control_codec.encode(msg)])
+            self.stats["sent"] += 1
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                if deadline is not None:
+                    wait = max(deadline - time.time(), 0)
+                    if not sock.poll(wait * 1000):
+                        self.stats["timed_out"] += 1
+                        return None
+                source, reply_id, reply = sock.recv_multipart()
+                # Discard anything left over from an earlier request
+                if reply_id == msg_id:
+                    break
+        self.stats["replied"] += 1
+        if source == comp_id:
+            try:
+                return self._load_reply(comp_id, reply)
+            except CodecError:
+                return None
+        return None
+
+    def _load_reply(self, comp_id, reply):
         """
+        Decode a reply or event from an untrusted computer.
 
-        _id = str(uuid.uuid4())
-        context = zmq.Context()
-        sock = context.socket(zmq.DEALER)
-        sock.setsockopt(zmq.IDENTITY, _id)
-        sock.connect(self.filename)
-        sock.send(comp_id, zmq.SNDMORE)
-        sock.send_pyobj(msg)
+        :raises control_codec.CodecError: if it is not a control message
+            of this version, which is logged and counted
+        """
+        try:
+            reply = control_codec.decode(reply)
+        except CodecError as e:
+            self.stats["undecodable"] += 1
+            logger.error("Undecodable message from computer %s: %s", comp_id, e)
+            raise
+        if self.reply_callback is not None:
+            self.reply_callback(comp_id, reply)
+        return reply
 
-        source = sock.recv()
-        reply = sock.recv_pyobj()
-        retval = None
+    def _on_async_reply(self, frames):
+        source, msg_id, reply = frames
+        try:
+            comp_id, msg, callback, errback, sent, handle = \
+                self._pending.pop(msg_id)
+        except KeyError:
+            expired = self._expired.pop(msg_id, None)
+            if expired is not None:
+                self.stats["late"] += 1
+                if self.late_reply_callback is not None \
+                        and source == expired[0]:
+                    try:
+                        reply = self._load_reply(expired[0], reply)
+                    except CodecError:
+                        return
+                    self.late_reply_callback(expired[0], expired[1], reply)
+            return
+        self.stats["replied"] += 1
+        if handle is not None:
+            ioloop.IOLoop.instance().remove_timeout(handle)
+        rtt = time.time() - sent
+        self.rtt[comp_id] = 0.8 * self.rtt.get(comp_id, rtt) + 0.2 * rtt
         if source == comp_id:
-            retval = reply
+            try:
+                reply = self._load_reply(comp_id, reply)
+            except CodecError:
+                reply = None
+        else:
+            reply = None
+        if reply is not None:
+            callback(reply)
+        elif errback is not None:
+            errback()
+        else:
+            callback(None)
 
-        sock.close()
+    def receive_events(self, callback):
+        """
+        Start passing the events that untrusted computers send without
+        being asked to ``callback(comp_id, event)`` on the IOLoop.
 
-        return retval
-    
-    def send_msg_async(self, msg, comp_id, callback):
-        _id = str(uuid.uuid4())
-        context = zmq.Context()
-        sock = context.socket(zmq.DEALER)
-        sock.setsockopt(zmq.IDENTITY, _id)
-        sock.connect(self.filename)
-        stream = ZMQStream(sock)
-        
-        @stream.on_recv
-        def on_recv(msg):
-            reply = pickle.loads(msg[1])
-            stream.close()
-            if msg[0] == comp_id:
-                callback(reply)
-            else:
-                callback(None)
-        sock.send(comp_id, zmq.SNDMORE)
-        sock.send_pyobj(msg)
-    
+        An untrusted computer sends an event like a reply, addressed to
+        :data:`EVENT_CHANNEL` and with an empty request id; the ROUTER
+        socket forwards it to a channel with that identity.
+        """
+        self.event_callback = callback
+        if self._event_channel is None:
+            self._event_channel = ZMQStream(self._channel(EVENT_CHANNEL))
+            self._event_channel.on_recv(self._on_event)
+
+    def _on_event(self, frames):
+        source, msg_id, event = frames
+        if source in self._dealers and self.event_callback is not None:
+            try:
+                event = self._load_reply(source, event)
+            except CodecError:
+                return
+            self.event_callback(source, event)
+
+    def _on_async_timeout(self, msg_id):
+        comp_id, msg, callback, errback, sent, handle = \
+            self._pending.pop(msg_id)
+        self.stats["timed_out"] += 1
+        self._expired[msg_id] = (comp_id, msg)
+        if len(self._expired) > EXPIRED_HISTORY:
+            self._expired.popitem(last=False)
+        if errback is not None:
+            errback()
+        else:
+            callback(None)
+
+    def send_msg_async(self, msg, comp_id, callback, timeout=None,
+                       errback=None):
+        """
+        Sends a message to a given untrusted computer without
+        blocking.
+
+        :arg dict msg: message to send
+        :arg str comp_id: identifier returned by
+            register_computer
+        :arg callable callback: called from the IOLoop with the
+            reply message
+        :arg float timeout: seconds to wait for the reply, or
+            None to wait forever
+        :arg callable errback: called without arguments if the
+            request timed out or an invalid ID was specified;
+            if it is not given, ``callback`` is called with None
+            instead
+        """
+        if self._async_channel is None:
+            self._async_channel = ZMQStream(self._channel())
+            self._async_channel.on_recv(self._on_async_reply)
+        msg_id = self._next_msg_id()
+        handle = None
+        if timeout is not None:
+            handle = ioloop.IOLoop.instance().add_timeout(
+                time.time() + timeout,
+                lambda: self._on_async_timeout(msg_id))
+        self._pending[msg_id] = (comp_id, msg, callback, errback,
+                                 time.time(), handle)
+        self.stats["sent"] += 1
+        self._async_channel.send_multipart(
+            [comp_id, msg_id, control_codec.encode(msg)])
@@ -0,0 +1,370 @@
+"""
+Warm service kernels that run every /service request in a forked child.
+
+A request to /service used to take a whole preforked kernel, run one
+execute_request in it and end it, which cost a kernel start (and a refill
+of the pool) per request. A receiver with ``service_kernels`` set keeps
+that many service kernels instead: long-lived processes forked from the
+receiver, which build the namespace of a kernel (Sage and the SageCell
+modules) once and then wait for code. For every ``execute_forked`` message
+the receiver hands the code to an idle service kernel, which forks a
+child for it. The child changes to a fresh workspace, sets the kernel
+resource limits, runs the code with its standard output and error
+captured and sends them back; then it exits, so the service kernel never
+runs user code itself and every request starts from the same state.
+
+There is no IPython kernel in the child: the code is Sage-preparsed and
+run in the namespace directly, and only the streams, the status and the
+requested ``user_variables`` are returned, as /service always did. Output
+that a kernel would send as display data is dropped.
+
+The child runs untrusted code, so it keeps no file descriptor but its
+result pipe, and its result is JSON that is checked field by field (see
+:func:`_checked`) before it goes any further. The service kernels and
+the receiver exchange JSON too, never pickles.
+"""
+import json
+import os
+import resource
+import select
+import signal
+import sys
+import time
+import traceback
+import uuid
+from collections import deque
+from multiprocessing import Process, Pipe
+from StringIO import StringIO
+
+from log import kernel_logger
+
+#: Largest output of a stream that is sent back, in characters
+MAX_OUTPUT = 1 << 20
+#: Largest result a child may send, in bytes of JSON
+MAX_RESULT = 16 << 20
+
+
+class ServiceKernels(object):
+    """
+    The service kernels of a receiver and the requests waiting for them.
+
+    :arg poll_loop.PollLoop loop: the receiver's event loop, which watches
+        the service kernels' pipes
+    :arg workspace.Workspaces workspaces: where the requests get their
+        working directories
+    :arg int count: number of service kernels
+    :arg callable make_namespace: called in every service kernel to build
+        the namespace the code runs in
+    :arg bool sage_mode: whether to Sage-preparse the code
+    :arg int max_waiting: most requests that wait for a service kernel;
+        further requests are refused
+    """
+    def __init__(self, loop, workspaces, count, make_namespace, sage_mode=False,
+                 max_waiting=100):
+        self.loop = loop
+        self.workspaces = workspaces
+        self.count = count
+        self.make_namespace = make_namespace
+        self.sage_mode = sage_mode
+        self.max_waiting = max_waiting
+        self._idle = [] # (proc, pipe) of service kernels waiting for a request
+        self._busy = {} # fd: (proc, pipe, execution id, callback)
+        self._waiting = deque() # (request, callback)
+        self.stats = {"executed": 0, "failed": 0, "refused": 0, "restarted": 0}
+
+    def start(self):
+        """ Fork the service kernels. """
+        for i in range(self.count):
+            self._idle.append(self._fork())
+
+    def _fork(self):
+        p, q = Pipe()
+        proc = Process(target=serve, args=(q, self.make_namespace, self.sage_mode, self.loop))
+        proc.start()
+        q.close()
+        return proc, p
+
+    def execute(self, code, callback, resource_limits=None, workspace_quota=None,
+                timeout=30.0, user_variables=()):
+        """
+        Run code in a child of a service kernel.
+
+        :arg callable callback: called with the result, a dictionary with
+            the ``stdout`` and ``stderr`` of the code and the
+            ``execute_reply`` (its ``status``, ``user_variables`` or the
+            error), or with None if the request was refused or the
+            service kernel died
+        :arg dict resource_limits: as for kernels, see
+            :meth:`forking_kernel_manager.ForkingKernelManager.start_kernel`
+        :arg dict workspace_quota: limits on the working directory
+        :arg float timeout: seconds after which the child is killed
+        :arg list user_variables: names of variables whose ``repr`` is
+            returned
+        """
+        if len(self._waiting) >= self.max_waiting:
+            self.stats["refused"] += 1
+            callback(None)
+            return
+        request = {"code": code, "resource_limits": resource_limits or {},
+                   "workspace_quota": workspace_quota, "timeout": timeout,
+                   "user_variables": list(user_variables)}
+        self._waiting.append((request, callback))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiting and self._idle:
+            request, callback = self._waiting.popleft()
+            proc, pipe = self._idle.pop()
+            execution_id = str(uuid.uuid4())
+            quota = request.pop("workspace_quota")
+            try:
+                request["dir"] = self.workspaces.create(execution_id, quota)
+            except OSError as e:
+                kernel_logger.error("Could not create a workspace for a service request: %s", e)
+                self._idle.append((proc, pipe))
+                callback(None)
+                continue
+            if quota and quota.get("bytes") and "RLIMIT_FSIZE" not in request["resource_limits"]:
+                # No single file may be larger than the whole quota
+                request["resource_limits"] = dict(request["resource_limits"],
+                                                  RLIMIT_FSIZE=quota["bytes"])
+            fd = pipe.fileno()
+            self._busy[fd] = (proc, pipe, execution_id, callback)
+            self.loop.add_handler(fd, lambda fd=fd: self._done(fd))
+            pipe.send_bytes(json.dumps(request))
+
+    def _done(self, fd):
+        self.loop.remove_handler(fd)
+        proc, pipe, execution_id, callback = self._busy.pop(fd)
+        self.workspaces.release(execution_id, retain=False)
+        try:
+            result = json.loads(pipe.recv_bytes())
+        except (EOFError, IOError, ValueError):
+            kernel_logger.error("Service kernel %d died; starting another one", proc.pid)
+            pipe.close()
+            proc.terminate()
+            proc.join(1)
+            self.stats["restarted"] += 1
+            self._idle.append(self._fork())
+            result = None
+        else:
+            self._idle.append((proc, pipe))
+        self.stats["executed" if result is not None else "failed"] += 1
+        callback(result)
+        self._dispatch()
+
+    def stop(self):
+        """ End the service kernels and refuse the waiting requests. """
+        for proc, pipe in self._idle + [b[:2] for b in self._busy.values()]:
+            pipe.close()
+            proc.terminate()
+        for fd, (proc, pipe, execution_id, callback) in self._busy.items():
+            self.loop.remove_handler(fd)
+            self.workspaces.release(execution_id, retain=False)
+            callback(None)
+        while self._waiting:
+            self._waiting.popleft()[1](None)
+        self._idle = []
+        self._busy = {}
+
+    def status(self):
+        """
+        :returns: the number of service kernels, of busy ones and of
+            waiting requests, and counts of the requests so far
+        :rtype: dict
+        """
+        return dict(self.stats, kernels=self.count, busy=len(self._busy),
+                    waiting=len(self._waiting))
+
+
+class _Sage(object):
+    """ The ``sys._sage_`` of a child: display output is dropped. """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.sent_files = {}
+
+    def display_message(self, *args, **kwargs):
+        pass
+
+    stream_message = javascript = clear = display_message
+
+    def reset_kernel_timeout(self, timeout):
+        pass
+
+    def register_handler(self, key, handler):
+        pass
+
+
+def serve(pipe, make_namespace, sage_mode, loop=None):
+    """
+    The main function of a service kernel: build the namespace, then run
+    the requests that come in over ``pipe``, each in a forked child.
+    """
+    os.setpgrp()
+    if loop is not None:
+        loop.reset_signals()
+    sys._sage_ = _Sage({})
+    namespace = sys._sage_.namespace = make_namespace()
+    preparse = None
+    if sage_mode:
+        from sage.repl.preparse import preparse_file
+        preparse = preparse_file
+    import gc
+    gc.collect()
+    while True:
+        try:
+            request = json.loads(pipe.recv_bytes())
+        except (EOFError, IOError):
+            # the receiver is gone
+            os._exit(0)
+        pipe.send_bytes(json.dumps(_fork_execution(request, namespace, preparse)))
+
+
+def _fork_execution(request, namespace, preparse):
+    """ Run a request in a child and wait for its result. """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child never returns to the loop of the service kernel
+        try:
+            _close_inherited(w)
+            try:
+                result = _execute(request, namespace, preparse)
+            except BaseException as e:
+                result = {"stdout": "", "stderr": "",
+                          "execute_reply": {"status": "error", "ename": type(e).__name__,
+                                            "evalue": _text(str(e)), "traceback": []}}
+            data = json.dumps(result)
+            while data:
+                data = data[os.write(w, data):]
+        finally:
+            os._exit(0)
+    os.close(w)
+    chunks = []
+    size = 0
+    reason = None
+    deadline = time.time() + request["timeout"]
+    while True:
+        wait = deadline - time.time()
+        if wait <= 0 or not select.select([r], [], [], wait)[0]:
+            reason = "timed out"
+            break
+        chunk = os.read(r, 65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_RESULT:
+            reason = "sent too large a result"
+            break
+        chunks.append(chunk)
+    os.close(r)
+    # Also ends whatever the child left running in its process group, and
+    # a child that closed its end of the pipe without exiting
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        os.kill(pid, signal.SIGKILL)
+    exitcode = os.waitpid(pid, 0)[1]
+    if reason is None:
+        if not chunks:
+            reason = "exited with %d" % exitcode
+        else:
+            result = _checked("".join(chunks), request)
+            if result is not None:
+                return result
+            reason = "sent a malformed result"
+    return {"stdout": "", "stderr": "",
+            "execute_reply": {"status": "abort", "reason": reason}}
+
+
+def _close_inherited(keep):
+    """
+    Close every file descriptor a child inherited (the pipe to the
+    receiver and the receiver's sockets among them) except ``keep``,
+    and point its standard streams to ``/dev/null``.
+    """
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def _checked(data, request):
+    """
+    Check the result a child sent. The child ran untrusted code, which
+    may have written anything into the pipe, so only the fields of a
+    result are kept, and only if they have the right types.
+
+    :arg str data: the JSON the child sent
+    :arg dict request: the request the child ran
+    :returns: the result, or None if it is malformed
+    :rtype: dict
+    """
+    try:
+        result = json.loads(data)
+        reply = result["execute_reply"]
+        if reply["status"] == "ok":
+            variables = reply["user_variables"]
+            checked = {"status": "ok", "user_variables": dict(
+                (name, _text(variables[name])) for name in request["user_variables"])}
+        elif reply["status"] == "error":
+            checked = {"status": "error", "ename": _text(reply["ename"]),
+                       "evalue": _text(reply["evalue"]),
+                       "traceback": [_text(line) for line in reply["traceback"]]}
+        else:
+            return None
+        return {"stdout": _text(result["stdout"]), "stderr": _text(result["stderr"]),
+                "execute_reply": checked}
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _execute(request, namespace, preparse):
+    """ Run a request in the forked child of a service kernel. """
+    os.setpgrp()
+    os.chdir(request["dir"])
+    for r, limit in request["resource_limits"].iteritems():
+        resource.setrlimit(getattr(resource, r), (limit, limit))
+    stdout, stderr = StringIO(), StringIO()
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        code = request["code"]
+        if preparse is not None:
+            code = preparse(code)
+        exec compile(code, "<string>", "exec") in namespace
+    except:
+        etype, evalue, tb = sys.exc_info()
+        reply = {"status": "error", "ename": etype.__name__, "evalue": _text(str(evalue)),
+                 "traceback": [_text(line) for line in
+                               traceback.format_exception(etype, evalue, tb)]}
+        stderr.write("".join(reply["traceback"]))
+    else:
+        reply = {"status": "ok", "user_variables": {}}
+        for name in request["user_variables"]:
+            try:
+                reply["user_variables"][name] = _text(repr(namespace[name]))
+            except Exception as e:
+                reply["user_variables"][name] = _text("[ERROR] %s: %s" % (type(e).__name__, e))
+    finally:
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    return {"stdout": _text(stdout.getvalue()), "stderr": _text(stderr.getvalue()),
+            "execute_reply": reply}
+
+
+def _text(s):
+    """ :returns: a string as unicode, cut to :data:`MAX_OUTPUT`
+    :raises TypeError: if ``s`` is not a string """
+    if isinstance(s, str):
+        s = s.decode("utf-8", "replace")
+    elif not isinstance(s, unicode):
+        raise TypeError("%s is not a string" % type(s).__name__)
+    return s[:MAX_OUTPUT]
@@ -150,6 +150,80 @@ sagecell.Session = function (outputDiv, language, interact_vals, k, linked) {
         this.kernel.post = function (url, callback) {
             sagecell.sendRequest("POST", url, {}, function (data) { callback(JSON.parse(data)); });
         }
+        /**
+         * Ask for the kernel over the SockJS connection that the page's
+         * kernels share, which saves an HTTP request. The code waiting
+         * for the kernel is sent under the same tag right behind the
+         * request; the server passes it on once the kernel has started,
+         * and the replies come back under the kernel's id. If the terms
+         * of service have to be accepted first or the connection closes,
+         * start the kernel with an HTTP request as IPython does; other
+         * refusals (such as rate limits) are shown in the cell. The first
+         * kernel of the page claims the kernel the server reserved for
+         * it, if any.
+         * @method start
+         */
+        this.kernel.start = function (params) {
+            var kernel = this;
+            params = params || {};
+            if (sagecell.lease) {
+                params.lease = sagecell.lease;
+                sagecell.lease = undefined;
+            }
+            var http_start = IPython.Kernel.prototype.start;
+            var tag = IPython.utils.uuid();
+            var acquire = new sagecell.MultiSockJS(null, tag + "/acquire");
+            var sent_code = [];
+            var done = false;
+            var fall_back = function () {
+                if (!done) {
+                    done = true;
+                    acquire.close();
+                    // the server dropped the code sent with the request
+                    kernel.deferred_code = sent_code.concat(kernel.deferred_code);
+                    http_start.call(kernel, params);
+                }
+            };
+            acquire.onopen = function () {
+                acquire.send(JSON.stringify(params));
+                if (kernel.deferred_code.length > 0) {
+                    kernel.shell_channel = {send: function (msg) {
+                        sagecell.MultiSockJS.sockjs.send(tag + "/shell," + msg);
+                    }};
+                    kernel.opened = true;
+                    while (kernel.deferred_code.length > 0) {
+                        sent_code.push(kernel.deferred_code[0]);
+                        kernel.session.execute(kernel.deferred_code.shift());
+                    }
+                    kernel.opened = false;
+                    kernel.shell_channel = null;
+                }
+            };
+            acquire.onmessage = function (e) {
+                var data = JSON.parse(e.data);
+                if (data.id === undefined) {
+                    sagecell.log("Could not acquire a kernel: " + data.error);
+                    if (/terms of service/.test(data.error)) {
+                        fall_back();
+                        return;
+                    }
+                    done = true;
+                    acquire.close();
+                    var text = "Could not start a kernel: " + data.error;
+                    if (data.retry_after) {
+                        text += ". Please try again in " + Math.ceil(data.retry_after) + " seconds.";
+                    }
+                    kernel.session.spinner.style.display = "none";
+                    kernel.session.output(ce("pre", {"class": "sagecell_pyerr"}, [text]), null);
+                    return;
+                }
+                done = true;
+                acquire.close();
+                data.ws_url = sagecell.URLs.root.replace(/^http/, "ws");
+                kernel._kernel_started(data);
+            };
+            acquire.onclose = fall_back;
+        };
     /**
      * Copied from IPython and slightly modified (comment out session_id send, add deferred code execution
      * Handle a websocket entering the open state
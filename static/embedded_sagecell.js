@@ -218,8 +218,16 @@ sagecell.init = function (callback) {
     // Preload images
     new Image().src = sagecell.URLs.sage_logo;
     new Image().src = sagecell.URLs.spinner;
-    sagecell.sendRequest("GET", sagecell.URLs.cell, {},
+    // A page served by the cell server itself got its lease already
+    sagecell.sendRequest("GET", sagecell.URLs.cell, sagecell.lease ? {"leased": "true"} : {},
         function (data) {
+            // A kernel the server reserved for this page, see
+            // Session.kernel.start
+            var lease = /^<!--lease (\S+)-->/.exec(data);
+            if (lease) {
+                sagecell.lease = lease[1];
+                data = data.substring(lease[0].length);
+            }
             $(function () {
                 sagecell.body = data;
                 // many prerequisites that have been smashed together into all.min.js
@@ -0,0 +1,75 @@
+import json
+
+import tornado.testing
+import tornado.web
+
+import handlers
+from fake_sender import kernel_manager
+from misc import assert_equal, assert_not_in
+
+_comp_id_regex = r"(?P<comp_id>\w+-\w+-\w+-\w+-\w+)"
+
+class TestAdminAPI(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.token = "s3cret"
+        get_config = handlers.config.get_config
+        handlers.config.get_config = lambda attr: \
+            self.token if attr == "admin_token" else get_config(attr)
+        self.auth = {"Authorization": "Bearer s3cret"}
+        super(TestAdminAPI, self).setUp()
+
+    def tearDown(self):
+        super(TestAdminAPI, self).tearDown()
+        self.km.stop()
+        del handlers.config.get_config
+
+    def get_app(self):
+        self.km, self.comp_ids = kernel_manager(5, 5)
+        app = tornado.web.Application([
+            (r"/admin/computers", handlers.AdminComputersHandler),
+            (r"/admin/computers/%s" % _comp_id_regex, handlers.AdminComputerHandler),
+            (r"/admin/computers/%s/drain" % _comp_id_regex, handlers.AdminDrainHandler)])
+        app.km = self.km
+        return app
+
+    def test_token(self):
+        assert_equal(self.fetch("/admin/computers").code, 403)
+        assert_equal(self.fetch("/admin/computers",
+                                headers={"Authorization": "Bearer wrong"}).code, 403)
+        response = self.fetch("/admin/computers", headers=self.auth)
+        assert_equal(response.code, 200)
+        assert_equal(sorted(json.loads(response.body)), sorted(self.comp_ids))
+        self.token = None
+        assert_equal(self.fetch("/admin/computers", headers=self.auth).code, 404)
+
+    def test_drain(self):
+        drained, other = self.comp_ids
+        response = self.fetch("/admin/computers/%s/drain" % drained, method="POST",
+                              body="{}", headers=self.auth)
+        assert_equal(response.code, 202)
+        assert_equal(json.loads(response.body)["state"], "draining")
+        for i in range(4):
+            self.km.new_session_async(callback=lambda kernel_id: None)
+        assert_equal(set(r.comp_id for r in self.km._sender.take("start_kernel")),
+                     set([other]))
+
+    def test_repeated_delete(self):
+        comp_id = self.comp_ids[0]
+        codes = []
+        def fetched(response):
+            codes.append(response.code)
+            self.stop()
+        for i in range(2):
+            self.http_client.fetch(self.get_url("/admin/computers/%s" % comp_id),
+                                   fetched, method="DELETE", headers=self.auth)
+        # the first request waits for the receiver to answer
+        self.wait()
+        assert_equal(codes, [409])
+        [remove] = self.km._sender.take("remove_computer")
+        remove.reply({})
+        self.wait()
+        assert_equal(codes, [409, 200])
+        assert_not_in(comp_id, self.km._comps)
+        response = self.fetch("/admin/computers/%s" % comp_id, method="DELETE",
+                              headers=self.auth)
+        assert_equal(response.code, 404)
@@ -0,0 +1,61 @@
+import admission
+from misc import assert_equal, assert_is, assert_is_not_none, assert_greater
+
+class TestAdmissionQueue(object):
+    def setUp(self):
+        self.queue = admission.AdmissionQueue(max_size=3, max_wait=30.0,
+                                              shed_wait=10.0, half_life=10.0)
+        self.events = []
+
+    def _offer(self, name):
+        return self.queue.offer(lambda: self.events.append(("start", name)),
+                                lambda: self.events.append(("fail", name)))
+
+    def test_fifo(self):
+        for name in "abc":
+            assert_is_not_none(self._offer(name))
+        assert_equal(len(self.queue), 3)
+        self.queue.pop()()
+        self.queue.pop()()
+        assert_equal(self.events, [("start", "a"), ("start", "b")])
+        assert_equal(len(self.queue), 1)
+        assert_equal(self.queue.stats["admitted"], 2)
+
+    def test_full(self):
+        for name in "abc":
+            self._offer(name)
+        assert_is(self._offer("d"), None)
+        assert_equal(self.queue.stats["rejected_full"], 1)
+
+    def test_expire(self):
+        a = self._offer("a")
+        self._offer("b")
+        self.queue.expire(a)
+        self.queue.expire(a)
+        assert_equal(self.events, [("fail", "a")])
+        self.queue.pop()()
+        assert_equal(self.events[-1], ("start", "b"))
+        assert_is(self.queue.pop(), None)
+        assert_equal(len(self.queue), 0)
+        # expiring an admitted request does nothing
+        b = self._offer("c")
+        self.queue.pop()
+        self.queue.expire(b)
+        assert_equal(self.queue.stats["expired"], 1)
+
+    def test_shed_on_expected_wait(self):
+        # no kernel has ended yet, so the wait is unknown
+        assert_is(self.queue.expected_wait(), None)
+        assert_equal(self.queue.retry_after(), 10)
+        # about one kernel ends every 14 seconds
+        self.queue.record_release()
+        assert_greater(self.queue.expected_wait(), 10)
+        # the first request in line waits anyway
+        assert_is_not_none(self._offer("a"))
+        assert_is(self._offer("b"), None)
+        assert_equal(self.queue.stats["rejected_wait"], 1)
+        assert_equal(self.queue.retry_after(), 29)
+        for i in range(9):
+            self.queue.record_release()
+        assert_is_not_none(self._offer("b"))
+        assert_greater(self.queue.expected_wait(), self.queue.expected_wait(0))
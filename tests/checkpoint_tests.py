@@ -0,0 +1,47 @@
+import os
+import shutil
+import stat
+import tempfile
+
+import checkpoint
+from misc import assert_equal, assert_is, assert_is_instance, assert_len
+
+class TestCheckpoint(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "kernels.checkpoint")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        kernels = [{"kernel_id": "k0", "comp_id": "c0", "state": "preforked",
+                    "connection": {"key": "secret", "shell_port": 5000},
+                    "timeout": float("inf"), "deadline": float("inf"),
+                    "referer": "", "remote_ip": ""}]
+        computers = [{"comp_id": "c0", "config": {"host": "localhost"},
+                      "endpoint": "tcp://127.0.0.1:6000"}]
+        checkpoint.save(self.path, computers, kernels)
+        data = checkpoint.load(self.path)
+        assert_equal(data["kernels"], kernels)
+        assert_equal(data["computers"], computers)
+        assert_is_instance(data["kernels"][0]["connection"]["key"], str)
+        # only the owner may read the HMAC keys
+        assert_equal(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+        checkpoint.save(self.path, [], [])
+        assert_equal(checkpoint.load(self.path)["kernels"], [])
+        assert_len(os.listdir(self.dir), 1)
+
+    def test_unusable(self):
+        assert_is(checkpoint.load(self.path), None)
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        assert_is(checkpoint.load(self.path), None)
+        with open(self.path, "w") as f:
+            f.write('{"version": 0, "computers": [], "kernels": []}')
+        assert_is(checkpoint.load(self.path), None)
+
+    def test_same_config(self):
+        assert checkpoint.same_config({"host": "a", "limits": (1, 2)},
+                                      {u"limits": [1, 2], u"host": u"a"})
+        assert not checkpoint.same_config({"host": "a"}, {"host": "b"})
@@ -0,0 +1,36 @@
+import pickle
+
+import control_codec
+from control_codec import CodecError
+from misc import assert_equal, assert_raises, assert_is_instance, assert_greater
+
+class TestControlCodec(object):
+    def test_round_trip(self):
+        msg = {"type": "success",
+               "content": {"kernel_id": "4b9d7e3c", "connection": {"ip": "10.0.3.15", "hb_port": 49156},
+                           "status": u"caf\xe9", "limits": {0: 30, 9: 2**40},
+                           "big": -2**70, "ports": [1, -200, 70000], "pair": (None, True, False),
+                           "ratio": 0.25, "blob": "x" * 1000}}
+        decoded = control_codec.decode(control_codec.encode(msg))
+        assert_equal(decoded, msg)
+        assert_is_instance(decoded["content"]["pair"], tuple)
+        assert_is_instance(decoded["content"]["status"], unicode)
+        assert_is_instance(decoded["content"]["kernel_id"], str)
+        assert_equal(control_codec.decode(buffer(control_codec.encode(msg))), msg)
+
+    def test_compact(self):
+        msg = {"type": "kill_kernel", "content": {"kernel_id": "4b9d7e3c-2a6f-4e8d-9c1b-0f5a6d7e8c9b"}}
+        assert_greater(len(pickle.dumps(msg, -1)), len(control_codec.encode(msg)))
+
+    def test_unencodable(self):
+        assert_raises(TypeError, control_codec.encode, {"type": object()})
+        assert_raises(TypeError, control_codec.encode, set())
+
+    def test_malformed(self):
+        data = control_codec.encode({"type": "stats", "content": {"kernel_id": "k"}})
+        for bad in ["", data[:1], data[:-1], data + "N", data[:2] + "?",
+                    data[:1] + chr(control_codec.VERSION + 1) + data[2:],
+                    # a dictionary with a list for a key
+                    data[:2] + "m\x00\x00\x00\x01l\x00\x00\x00\x00N",
+                    pickle.dumps({"type": "stats"}, -1)]:
+            assert_raises(CodecError, control_codec.decode, bad)
@@ -0,0 +1,107 @@
+"""
+A stand-in for :class:`sender.AsyncSender`, which lets tests drive a
+:class:`trusted_kernel_manager.TrustedMultiKernelManager` without any
+receivers: the tests answer the messages sent to computers themselves,
+or let them time out.
+"""
+import config_default
+import trusted_kernel_manager
+
+
+class Request(object):
+    """ A message sent to a computer, waiting for its reply. """
+    def __init__(self, sender, comp_id, msg, callback, errback):
+        self.sender = sender
+        self.comp_id = comp_id
+        self.msg = msg
+        self.callback = callback
+        self.errback = errback
+
+    def reply(self, content, type="success"):
+        self.callback({"type": type, "content": content})
+
+    def time_out(self):
+        if self.errback is not None:
+            self.errback()
+        else:
+            self.callback(None)
+
+    def reply_late(self, content, type="success"):
+        """ Answer after :meth:`time_out`, as :class:`sender.AsyncSender`
+        passes such a reply on. """
+        self.sender.late_reply_callback(self.comp_id, self.msg,
+                                        {"type": type, "content": content})
+
+
+class FakeSender(object):
+    def __init__(self, *args, **kwargs):
+        self.requests = []
+        self.stats = {}
+        self.rtt = {}
+        self.late_reply_callback = None
+        self.reply_callback = None
+
+    def receive_events(self, callback):
+        pass
+
+    def register_computer(self, host, port, comp_id=None, endpoint=None):
+        return comp_id
+
+    def send_msg(self, msg, comp_id, timeout=None):
+        self.requests.append(Request(self, comp_id, msg, None, None))
+        return {"type": "success", "content": {}}
+
+    def send_msg_async(self, msg, comp_id, callback, timeout=None, errback=None):
+        self.requests.append(Request(self, comp_id, msg, callback, errback))
+
+    def take(self, msg_type):
+        """ Removes the requests of a type and returns them in the order
+        they were sent. """
+        taken = [r for r in self.requests if r.msg["type"] == msg_type]
+        self.requests = [r for r in self.requests if r.msg["type"] != msg_type]
+        return taken
+
+
+class FakeSSH(object):
+    def close(self):
+        pass
+
+
+class KernelManager(trusted_kernel_manager.TrustedMultiKernelManager):
+    """ A kernel manager whose computers need no receivers. """
+    def __init__(self, **kwargs):
+        AsyncSender = trusted_kernel_manager.sender.AsyncSender
+        trusted_kernel_manager.sender.AsyncSender = FakeSender
+        try:
+            super(KernelManager, self).__init__(default_computer_config=dict(
+                config_default._default_config, preforked_kernels=0,
+                preforked_min=0, preforked_max=0), **kwargs)
+        finally:
+            trusted_kernel_manager.sender.AsyncSender = AsyncSender
+
+    def _start_receiver(self, comp_id, cfg):
+        return {"ssh": FakeSSH()}, "tcp://%s:5555" % cfg["host"]
+
+    def stop(self):
+        self._pool_callback.stop()
+        self._stats_callback.stop()
+        self.timers.stop()
+
+
+def kernel_manager(*max_kernels, **kwargs):
+    """ A :class:`KernelManager` with a computer for each number of
+    kernel slots.
+
+    :returns: the kernel manager and the ids of its computers
+    """
+    km = KernelManager(**kwargs)
+    comp_ids = [km.add_computer({"host": "127.0.0.%d" % (i + 1), "max_kernels": n})
+                for i, n in enumerate(max_kernels)]
+    return km, comp_ids
+
+
+def kernel(kernel_id):
+    """ The content of a reply to start_kernel. """
+    return {"kernel_id": kernel_id,
+            "connection": {"key": "secret", "ip": "127.0.0.1", "hb_port": 1,
+                           "iopub_port": 2, "shell_port": 3, "stdin_port": 4}}
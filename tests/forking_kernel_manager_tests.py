@@ -88,3 +88,34 @@ class TestForkingKernelManager(object):
 
         for s in ("stdin_port", "hb_port", "shell_port", "iopub_port"):
             assert_equal(preports[s], postports[s]) # and that it has the same ports as before
+
+    def test_start_kernel_async_success(self):
+        from poll_loop import PollLoop
+        self.a.loop = loop = PollLoop()
+        started = []
+        def callback(y):
+            started.append(y)
+            loop.stop()
+        kernel_id = self.a.start_kernel_async(callback, lambda e: loop.stop())
+        assert_in(kernel_id, self.a.starting)
+        loop.start()
+
+        assert_len(started, 1)
+        assert_equal(started[0]["kernel_id"], kernel_id)
+        assert_not_in(kernel_id, self.a.starting)
+        assert_in(kernel_id, self.a.kernels.keys())
+        assert_is(self.a.kernels[kernel_id][0].is_alive(), True)
+
+    def test_kill_starting_kernel(self):
+        from poll_loop import PollLoop
+        self.a.loop = PollLoop()
+        errors = []
+        kernel_id = self.a.start_kernel_async(None, errors.append)
+        proc = self.a.starting[kernel_id][0]
+
+        assert_is(self.a.kill_kernel(kernel_id), True)
+        assert_len(errors, 1)
+        assert_is_instance(errors[0], forking_kernel_manager.KernelKilled)
+        assert_not_in(kernel_id, self.a.starting)
+        assert_not_in(kernel_id, self.a.kernels.keys())
+        assert_is(proc.is_alive(), False)
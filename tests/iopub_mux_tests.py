@@ -0,0 +1,70 @@
+import time
+
+import zmq
+from zmq.eventloop.zmqstream import ZMQStream
+
+from iopub_mux import Forwarder, Demultiplexer
+from poll_loop import PollLoop
+from misc import assert_equal
+
+class TestIOPubMux(object):
+    def setUp(self):
+        self.context = zmq.Context()
+        self.loop = PollLoop()
+        self.forwarder = Forwarder(self.context, self.loop, "127.0.0.1")
+        self.kernels = {}
+        for kernel_id in ("k1", "k2"):
+            pub = self.context.socket(zmq.PUB)
+            pub.setsockopt(zmq.LINGER, 0)
+            port = pub.bind_to_random_port("tcp://127.0.0.1")
+            self.forwarder.add(kernel_id, {"ip": "127.0.0.1", "iopub_port": port})
+            self.kernels[kernel_id] = pub
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.LINGER, 0)
+        sub.connect(self.forwarder.endpoint)
+        self.mux = Demultiplexer(ZMQStream(sub))
+
+    def tearDown(self):
+        self.mux.close()
+        self.forwarder.clear()
+        self.forwarder.pub.close()
+        for pub in self.kernels.values():
+            pub.close()
+        self.context.term()
+
+    def _listen(self, stream):
+        received = []
+        stream.on_recv(received.append)
+        return received
+
+    def _send(self, kernel_id, msg):
+        """ Publish a message from a kernel and pass it through. """
+        self.kernels[kernel_id].send_multipart(msg)
+        self.loop.call_later(0.2, self.loop.stop)
+        self.loop.start()
+        time.sleep(0.1)
+        self.mux.flush()
+
+    def test_forward_and_unsubscribe(self):
+        a = self.mux.subscribe("k1")
+        b = self.mux.subscribe("k1")
+        received_a, received_b = self._listen(a), self._listen(b)
+        # let the subscriptions reach the forwarder
+        time.sleep(0.2)
+        self._send("k1", [b"header", b"content"])
+        self._send("k2", [b"not subscribed"])
+        assert_equal(received_a, [[b"header", b"content"]])
+        assert_equal(received_b, received_a)
+        assert_equal(self.forwarder.forwarded, 2)
+
+        a.close()
+        assert_equal(a.closed(), True)
+        self._send("k1", [b"after close"])
+        assert_equal(len(received_a), 1)
+        assert_equal(received_b[-1], [b"after close"])
+        assert_equal(len(self.mux), 1)
+        b.close()
+        assert_equal(len(self.mux), 0)
+
+        self.forwarder.remove("k1")
+        assert_equal(len(self.forwarder), 1)
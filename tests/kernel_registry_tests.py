@@ -0,0 +1,64 @@
+import kernel_registry
+from misc import assert_equal, assert_is, assert_in, assert_not_in, assert_len, assert_greater
+
+class TestKernelRegistry(object):
+    def setUp(self):
+        self.registry = kernel_registry.KernelRegistry()
+        for i, comp_id in enumerate(["c1", "c1", "c2"]):
+            self.registry.add("k%d" % i, comp_id, {"key": "x"}, None, "preforked", 0.0, 0.0)
+
+    def test_indexes(self):
+        registry = self.registry
+        assert_len(registry, 3)
+        assert_equal(sorted(registry.on_computer("c1")), ["k0", "k1"])
+        assert_equal(registry.count("c1"), 2)
+        assert_equal(registry.count(state="preforked"), 3)
+        kernel = registry["k1"]
+        registry.set_state(kernel, "active")
+        registry.set_client(kernel, "http://example.org/", "1.2.3.4")
+        assert_equal(registry.count("c1", "active"), 1)
+        assert_equal(registry.in_state("active"), ["k1"])
+        assert_equal(registry.from_ip("1.2.3.4"), ["k1"])
+        assert_equal(registry.from_referer("http://example.org/"), ["k1"])
+        registry.set_client(kernel, "", "5.6.7.8")
+        assert_equal(registry.from_ip("1.2.3.4"), [])
+        assert_equal(registry.from_referer("http://example.org/"), [])
+
+    def test_remove_leaves_nothing_behind(self):
+        registry = self.registry
+        kernel = registry["k2"]
+        registry.set_state(kernel, "active")
+        registry.set_client(kernel, "http://example.org/", "1.2.3.4")
+        kernel.kill = lambda: None
+        assert_is(registry.remove("k2"), kernel)
+        assert_is(kernel.kill, None)
+        assert_is(registry.remove("k2"), None)
+        assert_not_in("k2", registry)
+        assert_equal(registry.memory()["computers"], 1)
+        assert_equal(registry.memory()["ips"], 0)
+        assert_equal(registry.memory()["referers"], 0)
+        assert_equal(sorted(k.kernel_id for k in registry.remove_computer("c1")), ["k0", "k1"])
+        assert_len(registry, 0)
+        memory = registry.memory()
+        assert_equal(memory["computers"], 0)
+        assert_equal(memory["kernels"], {"preforked": 0, "active": 0, "dying": 0})
+
+    def test_memory(self):
+        memory = self.registry.memory()
+        assert_equal(memory["kernels"]["preforked"], 3)
+        assert_greater(memory["bytes"]["records"], 0)
+        assert_equal(memory["bytes"]["sessions"], 0)
+        assert_in("total", memory["bytes"])
+
+    def test_dump(self):
+        registry = self.registry
+        changes = registry.changes
+        registry.set_state(registry["k0"], "dying")
+        registry.set_client(registry["k1"], "http://example.org/", "1.2.3.4")
+        assert_greater(registry.changes, changes)
+        records = registry.dump("c1")
+        assert_len(records, 1)
+        assert_equal(records[0]["kernel_id"], "k1")
+        assert_equal(records[0]["remote_ip"], "1.2.3.4")
+        assert_equal(sorted(records[0]), sorted(kernel_registry.SAVED))
+        assert_equal(registry.dump("c3"), [])
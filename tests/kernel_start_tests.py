@@ -0,0 +1,107 @@
+from fake_sender import kernel_manager, kernel
+from misc import assert_equal, assert_in, assert_not_in
+
+class TestStartRetries(object):
+    def setUp(self):
+        self.km, self.comp_ids = kernel_manager(5, 5, start_retries=1)
+        self.sender = self.km._sender
+        self.started = []
+
+    def tearDown(self):
+        self.km.stop()
+
+    def test_retry_on_other_computer(self):
+        self.km.new_session_async(callback=self.started.append)
+        [first] = self.sender.take("start_kernel")
+        first.time_out()
+        assert_equal(self.started, [])
+        [second] = self.sender.take("start_kernel")
+        assert_not_in(second.comp_id, [first.comp_id])
+        second.reply(kernel("k1"))
+        assert_equal(self.started, ["k1"])
+        assert_equal(self.km._kernels["k1"].comp_id, second.comp_id)
+
+    def test_give_up(self):
+        self.km.new_session_async(callback=self.started.append)
+        [first] = self.sender.take("start_kernel")
+        first.reply("out of memory", type="error")
+        [second] = self.sender.take("start_kernel")
+        second.time_out()
+        assert_equal(self.started, [False])
+        assert_equal(self.sender.take("start_kernel"), [])
+
+    def test_late_reply(self):
+        self.km.new_session_async(callback=self.started.append)
+        [first] = self.sender.take("start_kernel")
+        first.time_out()
+        first.reply_late(kernel("k0"))
+        # the kernel that started too late is killed, not handed out
+        [kill] = self.sender.take("kill_kernel")
+        assert_equal((kill.comp_id, kill.msg["content"]), (first.comp_id, {"kernel_id": "k0"}))
+        assert_equal(self.started, [])
+        [second] = self.sender.take("start_kernel")
+        second.reply(kernel("k1"))
+        assert_equal(self.started, ["k1"])
+        assert_equal(self.km.get_kernel_ids(), ["k1"])
+
+class TestBatches(object):
+    def setUp(self):
+        self.km, self.comp_ids = kernel_manager(2, 4, start_retries=1)
+        self.max_kernels = dict(zip(self.comp_ids, (2, 4)))
+        self.sender = self.km._sender
+        self.started = []
+
+    def tearDown(self):
+        self.km.stop()
+
+    def _kernels(self, *kernel_ids):
+        return {"kernels": [kernel(k) for k in kernel_ids], "errors": []}
+
+    def test_split(self):
+        self.km.new_sessions_async(5, callback=self.started.append)
+        batches = self.sender.take("start_kernels")
+        counts = dict((b.comp_id, b.msg["content"]["count"]) for b in batches)
+        assert_equal(sorted(counts), sorted(self.comp_ids))
+        assert_equal(sum(counts.values()), 5)
+        for comp_id, count in counts.items():
+            assert_in(count, range(1, self.max_kernels[comp_id] + 1))
+        batches[0].reply(self._kernels(*["a%d" % i for i in range(counts[batches[0].comp_id])]))
+        assert_equal(self.started, [])
+        batches[1].reply(self._kernels(*["b%d" % i for i in range(counts[batches[1].comp_id])]))
+        assert_equal(len(self.started), 1)
+        assert_equal(len(self.started[0]), 5)
+
+    def test_retry_on_timeout(self):
+        self.km.new_sessions_async(2, callback=self.started.append)
+        [first] = self.sender.take("start_kernels")
+        first.time_out()
+        [second] = self.sender.take("start_kernels")
+        assert_not_in(second.comp_id, [first.comp_id])
+        assert_equal(second.msg["content"]["count"], 2)
+        second.reply(self._kernels("k1", "k2"))
+        assert_equal(self.started, [["k1", "k2"]])
+        assert_equal(sorted(self.km.get_kernel_ids(second.comp_id)), ["k1", "k2"])
+
+    def test_late_reply(self):
+        self.km.new_sessions_async(2, callback=self.started.append)
+        [first] = self.sender.take("start_kernels")
+        first.time_out()
+        first.reply_late(self._kernels("k1", "k2"))
+        kills = self.sender.take("kill_kernel")
+        assert_equal(sorted((k.comp_id, k.msg["content"]["kernel_id"]) for k in kills),
+                     [(first.comp_id, "k1"), (first.comp_id, "k2")])
+        [second] = self.sender.take("start_kernels")
+        second.reply(self._kernels("k3", "k4"))
+        assert_equal(self.started, [["k3", "k4"]])
+        assert_equal(sorted(self.km.get_kernel_ids()), ["k3", "k4"])
+
+    def test_partial_reply(self):
+        self.km.new_sessions_async(2, callback=self.started.append)
+        [first] = self.sender.take("start_kernels")
+        first.reply({"kernels": [kernel("k1")], "errors": ["fork failed"]})
+        # the kernel that did not start is retried on the other computer
+        [second] = self.sender.take("start_kernels")
+        assert_not_in(second.comp_id, [first.comp_id])
+        assert_equal(second.msg["content"]["count"], 1)
+        second.reply(self._kernels("k2"))
+        assert_equal(self.started, [["k1", "k2"]])
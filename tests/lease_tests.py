@@ -0,0 +1,48 @@
+import time
+
+import lease
+from misc import assert_equal, assert_is, assert_in
+
+class TestLeases(object):
+    def setUp(self):
+        self.leases = lease.Leases(duration=5.0, max_leases=2, per_ip=1, secret="s")
+
+    def test_claim(self):
+        token = self.leases.grant("k1", "c1", "1.2.3.4", timer="t")
+        assert_in("k1", self.leases)
+        assert_is(self.leases.claim(token, "5.6.7.8"), None)
+        assert_equal(self.leases.claim(token, "1.2.3.4"), ("k1", "c1", "t"))
+        # a lease is claimed once
+        assert_is(self.leases.claim(token, "1.2.3.4"), None)
+        assert_equal(len(self.leases), 0)
+        assert_equal((self.leases.stats["claimed"], self.leases.stats["invalid"]), (1, 2))
+
+    def test_forged(self):
+        token = self.leases.grant("k1", "c1", "1.2.3.4")
+        kernel_id, expires, signature = token.split(":")
+        for bad in ["", "k1", "k1:x:y", "%s:%d:%s" % (kernel_id, int(expires) + 60, signature),
+                    token[:-1] + ("0" if token[-1] != "0" else "1"),
+                    lease.Leases(secret="other").grant("k1", "c1", "1.2.3.4")]:
+            assert_is(self.leases.claim(bad, "1.2.3.4"), None)
+        assert_in("k1", self.leases)
+
+    def test_limits(self):
+        self.leases.grant("k1", "c1", "a")
+        assert not self.leases.available("a")
+        assert self.leases.available("b")
+        self.leases.grant("k2", "c1", "b")
+        assert not self.leases.available("c")
+        assert_equal(self.leases.expire("k1"), "c1")
+        assert_is(self.leases.expire("k1"), None)
+        assert self.leases.available("a")
+        assert_equal(self.leases.status()["leased"], 1)
+
+    def test_late(self):
+        self.leases.grant("k1", "c1", "a")
+        expires = int(time.time()) - 1
+        self.leases._leases["k1"] = ("c1", "a", expires, None)
+        token = "k1:%d:%s" % (expires, self.leases._sign("k1", expires, "a"))
+        assert_is(self.leases.claim(token, "a"), None)
+        # left for the timer to end
+        assert_in("k1", self.leases)
+        assert_equal(self.leases.stats["late"], 1)
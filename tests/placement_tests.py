@@ -0,0 +1,63 @@
+from collections import Counter
+
+import placement
+from misc import assert_equal, assert_raises, assert_in, assert_greater
+
+def make(policy, comps):
+    p = placement.Placement(policy)
+    for comp_id, cfg in comps.iteritems():
+        p.add_computer(comp_id, cfg)
+    return p
+
+def test_unknown_policy():
+    assert_raises(ValueError, placement.Placement, "nope")
+
+class TestLeastLoaded(object):
+    def setUp(self):
+        self.p = make("least_loaded", {"a": {"max_kernels": 10},
+                                       "b": {"max_kernels": 10},
+                                       "c": {"max_kernels": 10, "max_load": 1.0}})
+
+    def test_picks_least_loaded(self):
+        self.p.update("a", kernels=5)
+        self.p.update("b", kernels=2)
+        self.p.update("c", kernels=7)
+        assert_equal(self.p.pick(), "b")
+        assert_equal(self.p.pick(exclude=("b",)), "a")
+        assert_equal(self.p.pick(accept=lambda c: c == "c"), "c")
+
+    def test_reported_load(self):
+        self.p.update("a", load={"loadavg": 7.0, "cpus": 8})
+        self.p.update("b", load={"loadavg": 1.0, "cpus": 1})
+        assert_equal(self.p.pick(), "c")
+
+    def test_hot_computers_are_skipped(self):
+        self.p.update("a", kernels=10)
+        self.p.update("c", load={"loadavg": 4.0, "cpus": 2})
+        self.p.set_available("b", False)
+        assert_raises(IOError, self.p.pick)
+        assert_equal(self.p.is_hot("a", count=False), False)
+        self.p.update("a", kernels=9)
+        assert_equal(self.p.pick(), "a")
+
+    def test_remove_computer(self):
+        self.p.remove_computer("a")
+        self.p.remove_computer("b")
+        assert_equal(self.p.pick(), "c")
+        self.p.remove_computer("c")
+        assert_raises(IOError, self.p.pick)
+
+def test_power_of_two():
+    p = make("power_of_two", dict((str(i), {"max_kernels": 10}) for i in range(5)))
+    p.update("0", kernels=9)
+    for i in range(50):
+        assert_in(p.pick(exclude=("1",)), ("0", "2", "3", "4"))
+
+def test_weighted():
+    p = make("weighted", {"a": {"max_kernels": 10, "weight": 3},
+                          "b": {"max_kernels": 10},
+                          "c": {"max_kernels": 10}})
+    p.update("c", kernels=10)
+    counts = Counter(p.pick() for i in range(2000))
+    assert_equal(counts["c"], 0)
+    assert_greater(counts["a"], 2 * counts["b"])
@@ -0,0 +1,60 @@
+import time
+from Queue import Empty
+
+import prefork_pool
+from misc import assert_equal, assert_raises, assert_greater
+
+cfg = {"preforked_kernels": 2, "preforked_min": 1, "preforked_max": 5,
+       "preforked_max_age": 60, "max_kernels": 10}
+
+class TestPreforkPool(object):
+    def setUp(self):
+        self.pool = prefork_pool.PreforkPool(half_life=10.0)
+        self.pool.add_computer("comp", cfg)
+
+    def _fill(self, n, latency=1.0):
+        for i in range(n):
+            self.pool.spawning("comp")
+            self.pool.add("k%d" % i, "comp", latency)
+
+    def test_initial_target(self):
+        assert_equal(self.pool.wanted("comp"), 2)
+        self.pool.spawning("comp")
+        assert_equal(self.pool.wanted("comp"), 1)
+        # asking is not deciding
+        assert_equal(len(self.pool.decisions), 0)
+        self.pool.grow("comp", 1)
+        assert_equal([d[2:4] for d in self.pool.decisions], [("grow", 1)])
+
+    def test_pop_is_fifo(self):
+        self._fill(2)
+        assert_equal(self.pool.pop(), ("k0", "comp"))
+        assert_equal(self.pool.pop("comp"), ("k1", "comp"))
+        assert_raises(Empty, self.pool.pop)
+
+    def test_target_follows_demand(self):
+        self._fill(1, latency=3.0)
+        for i in range(50):
+            self.pool.record_request()
+        self.pool.update_targets()
+        assert_equal(self.pool.status()["computers"]["comp"]["target"], 5)
+        self.pool._rate = 0.0
+        self.pool.update_targets()
+        assert_equal(self.pool.status()["computers"]["comp"]["target"], 1)
+
+    def test_surplus_shrinks_one_at_a_time(self):
+        self._fill(4)
+        assert_equal(self.pool.surplus("comp"), ["k0"])
+        assert_equal(self.pool.qsize("comp"), 3)
+
+    def test_stale(self):
+        self._fill(2)
+        self.pool._ready["comp"]["k0"] = time.time() - 120
+        assert_equal(self.pool.stale("comp"), ["k0"])
+        assert_equal(self.pool.stale("comp"), [])
+        assert_greater(len(self.pool.decisions), 0)
+
+    def test_remove_computer(self):
+        self._fill(2)
+        assert_equal(sorted(self.pool.remove_computer("comp")), ["k0", "k1"])
+        assert_equal(self.pool.wanted("comp"), 0)
@@ -0,0 +1,63 @@
+import ratelimit
+from misc import assert_equal, assert_is, assert_raises, assert_in
+
+limits = {"ip": {"rate": 1.0, "burst": 2, "kernels": 3},
+          "referer": {"kernels": 4}}
+
+class TestRateLimits(object):
+    def setUp(self):
+        self.limits = ratelimit.RateLimits(limits, {"secret": {"kernels": 1}})
+
+    def test_keys(self):
+        assert_equal(self.limits.keys("1.2.3.4", "https://Example.org/page?x=1"),
+                     [("ip", "1.2.3.4"), ("referer", "https://example.org")])
+        assert_equal(self.limits.keys("1.2.3.4", ""), [("ip", "1.2.3.4")])
+        assert_equal(self.limits.keys("1.2.3.4", "https://example.org", "secret"),
+                     [("key", "secret")])
+        assert_raises(KeyError, self.limits.keys, "1.2.3.4", None, "wrong")
+
+    def test_rate(self):
+        keys = self.limits.keys("a")
+        assert_is(self.limits.acquire(keys), None)
+        assert_is(self.limits.acquire(keys), None)
+        key, limit, retry_after = self.limits.acquire(keys)
+        assert_equal((key, limit), (("ip", "a"), "rate"))
+        assert 0 < retry_after <= 1
+        # another client has its own bucket
+        assert_is(self.limits.acquire(self.limits.keys("b")), None)
+        self.limits._buckets[("ip", "a")][1] -= 1
+        assert_is(self.limits.acquire(keys), None)
+        assert_equal(self.limits.stats["refused_rate"], 1)
+
+    def test_kernels(self):
+        keys = self.limits.keys("1.2.3.4", None, "secret")
+        assert_is(self.limits.acquire(keys), None)
+        self.limits.assign("k1", keys)
+        assert_equal(self.limits.acquire(keys)[1], "kernels")
+        self.limits.kernel_ended("k1")
+        self.limits.kernel_ended("k1")
+        assert_is(self.limits.acquire(keys), None)
+        self.limits.release(keys)
+        assert_equal(self.limits.usage()["key:secret"]["kernels"], 0)
+
+    def test_refused_request_charges_nothing(self):
+        referer = "http://example.org/"
+        for ip in "abcd":
+            assert_is(self.limits.acquire(self.limits.keys(ip, referer)), None)
+        # the referer is full, so the new client's kernel is not counted
+        assert_equal(self.limits.acquire(self.limits.keys("e", referer))[1], "kernels")
+        usage = self.limits.usage()
+        assert_equal(usage["referer:http://example.org"]["kernels"], 4)
+        assert_equal(usage["ip:e"]["kernels"], 0)
+        assert_in("ip:a", self.limits.usage("ip"))
+        assert_equal(len(self.limits.usage("referer")), 1)
+
+    def test_count(self):
+        keys = self.limits.keys("a")
+        assert_equal(self.limits.acquire(keys, 4)[1], "kernels")
+        assert_equal(self.limits.acquire(keys, 3), (("ip", "a"), "rate", None))
+        assert_is(self.limits.acquire(keys, 2), None)
+        assert_equal(self.limits.usage()["ip:a"]["kernels"], 2)
+        self.limits.release(keys, 0)
+        self.limits.release(keys, 2)
+        assert_equal(self.limits.usage()["ip:a"]["kernels"], 0)
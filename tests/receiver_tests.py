@@ -0,0 +1,30 @@
+import receiver
+from misc import assert_equal
+
+class TestStartKernels(object):
+    def setUp(self):
+        # only the parts of a receiver that start_kernels uses
+        self.receiver = receiver.Receiver.__new__(receiver.Receiver)
+        self.receiver.load_snapshot = lambda: {}
+        self.receiver._start_kernel = lambda content, callback, errback: \
+            self.starting.append((callback, errback))
+        self.starting = []
+        self.replies = []
+
+    def test_partial(self):
+        self.receiver.start_kernels({"count": 3}, self.replies.append)
+        assert_equal(len(self.starting), 3)
+        self.starting[2][0]({"kernel_id": "k2"})
+        self.starting[1][1](OSError("fork failed"))
+        assert_equal(self.replies, [])
+        self.starting[0][0]({"kernel_id": "k0"})
+        assert_equal(self.replies, [{"type": "success", "load": {},
+            "content": {"kernels": [{"kernel_id": "k2"}, {"kernel_id": "k0"}],
+                        "errors": ["fork failed"]}}])
+
+    def test_none_started(self):
+        self.receiver.start_kernels({"count": 2}, self.replies.append)
+        for callback, errback in self.starting:
+            errback(OSError("fork failed"))
+        assert_equal(self.replies, [{"type": "error", "load": {},
+            "content": {"kernels": [], "errors": ["fork failed", "fork failed"]}}])
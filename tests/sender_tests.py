@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import time
+
+import zmq
+from zmq.eventloop import ioloop
+from zmq.eventloop.zmqstream import ZMQStream
+ioloop.install()
+
+import control_codec
+import sender
+from misc import assert_equal
+
+class FakeReceiver(object):
+    """
+    The control socket of a receiver, which answers each request as
+    ``answer(msg)`` says: with a message, with raw bytes, or not at all
+    (None), after ``delay`` seconds.
+    """
+    def __init__(self, context, answer, delay=0):
+        self.sock = context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.port = self.sock.bind_to_random_port("tcp://127.0.0.1")
+        self.stream = ZMQStream(self.sock)
+        self.stream.on_recv(self._received)
+        self.answer = answer
+        self.delay = delay
+        self.requests = []
+
+    def _received(self, frames):
+        source, msg_id, msg = frames
+        msg = control_codec.decode(msg)
+        self.requests.append(msg)
+        reply = self.answer(msg)
+        if reply is None:
+            return
+        if isinstance(reply, dict):
+            reply = control_codec.encode(reply)
+        ioloop.IOLoop.instance().add_timeout(time.time() + self.delay,
+            lambda: self.stream.send_multipart([source, msg_id, reply]))
+
+    def close(self):
+        self.stream.close()
+
+class TestAsyncSender(object):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.sender = sender.AsyncSender(os.path.join(self.dir, "router.ipc"))
+        self.calls = []
+        self.sender.late_reply_callback = lambda comp_id, msg, reply: \
+            self.calls.append(("late", comp_id, msg["type"], reply["type"]))
+        self.receiver = None
+
+    def tearDown(self):
+        if self.receiver is not None:
+            self.receiver.close()
+        shutil.rmtree(self.dir)
+
+    def _connect(self, answer, delay=0):
+        self.receiver = FakeReceiver(self.sender.context, answer, delay)
+        self.sender.register_computer("127.0.0.1", self.receiver.port, "comp")
+
+    def _send(self, timeout, errback=True, wait=0.5):
+        self.sender.send_msg_async(
+            {"type": "stats"}, "comp", timeout=timeout,
+            callback=lambda reply: self.calls.append(("callback", reply and reply["type"])),
+            errback=(lambda: self.calls.append(("errback",))) if errback else None)
+        loop = ioloop.IOLoop.instance()
+        loop.add_timeout(time.time() + wait, loop.stop)
+        loop.start()
+
+    def test_reply(self):
+        self._connect(lambda msg: {"type": "success", "content": {}})
+        self._send(timeout=1.0)
+        assert_equal(self.calls, [("callback", "success")])
+        assert_equal(self.receiver.requests, [{"type": "stats"}])
+        assert_equal(self.sender.stats["replied"], 1)
+
+    def test_no_reply(self):
+        self._connect(lambda msg: None)
+        self._send(timeout=0.1)
+        assert_equal(self.calls, [("errback",)])
+        # without an errback, the callback gets None
+        self._send(timeout=0.1, errback=False)
+        assert_equal(self.calls, [("errback",), ("callback", None)])
+        assert_equal(self.sender.stats["timed_out"], 2)
+        assert_equal(self.sender.send_msg({"type": "stats"}, "comp", timeout=0.1), None)
+
+    def test_late_reply(self):
+        self._connect(lambda msg: {"type": "success", "content": {}}, delay=0.3)
+        self._send(timeout=0.1, wait=0.6)
+        assert_equal(self.calls, [("errback",), ("late", "comp", "stats", "success")])
+        assert_equal(self.sender.stats["late"], 1)
+
+    def test_undecodable_reply(self):
+        self._connect(lambda msg: "\x80garbage")
+        self._send(timeout=1.0)
+        assert_equal(self.calls, [("errback",)])
+        assert_equal(self.sender.stats["undecodable"], 1)
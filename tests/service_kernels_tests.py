@@ -0,0 +1,69 @@
+import shutil
+import tempfile
+
+import service_kernels
+import workspace
+from poll_loop import PollLoop
+from misc import assert_equal, assert_in
+
+class TestServiceKernels(object):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.loop = PollLoop()
+        self.service = service_kernels.ServiceKernels(
+            self.loop, workspace.Workspaces(self.root, self.loop), 2, lambda: {"base": 41})
+        self.service.start()
+        self.results = []
+
+    def tearDown(self):
+        self.service.stop()
+        shutil.rmtree(self.root)
+
+    def _run(self, *requests):
+        def done(result):
+            self.results.append(result)
+            if len(self.results) == len(requests):
+                self.loop.stop()
+        for code, kwargs in requests:
+            self.service.execute(code, done, **kwargs)
+        self.loop.call_later(10, self.loop.stop)
+        self.loop.start()
+        return dict((r["stdout"] or r["execute_reply"]["status"], r) for r in self.results)
+
+    def test_execute(self):
+        results = self._run(("x = base + 1\nprint x", {"user_variables": ["x"]}),
+                            ("base = 0\nprint 'changed'", {}),
+                            ("print base", {}),
+                            ("1/0", {}))
+        assert_equal(results["42\n"]["execute_reply"],
+                     {"status": "ok", "user_variables": {"x": "42"}})
+        # every request starts from the namespace of the service kernel
+        assert_in("41\n", results)
+        error = results["error"]
+        assert_equal(error["execute_reply"]["ename"], "ZeroDivisionError")
+        assert_in("ZeroDivisionError", error["stderr"])
+        assert_equal(self.service.status()["executed"], 4)
+
+    def test_limits(self):
+        results = self._run(("while True: pass", {"timeout": 0.2}),
+                            ("open('f', 'w').write('x' * 5000)",
+                             {"workspace_quota": {"bytes": 1000}}))
+        assert_equal(results["abort"]["execute_reply"]["reason"], "timed out")
+        assert_equal(results["error"]["execute_reply"]["ename"], "IOError")
+
+    def test_untrusted_output(self):
+        # a pickle that would run code wherever it is loaded
+        forged = "cos\nsystem\n(S'touch pwned'\ntR."
+        results = self._run(
+            ("import os\n"
+             "for fd in os.listdir('/proc/self/fd'):\n"
+             "    try: os.write(int(fd), %r)\n"
+             "    except OSError: pass\n"
+             "os._exit(0)" % forged, {}),
+            # standard streams, the result pipe and the listing itself
+            ("import os\nprint len(os.listdir('/proc/self/fd'))", {}),
+            ("print base", {}))
+        assert_equal(results["abort"]["execute_reply"]["reason"], "sent a malformed result")
+        assert_in("5\n", results)
+        assert_in("41\n", results)
+        assert_equal(self.service.status()["restarted"], 0)
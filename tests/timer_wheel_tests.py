@@ -0,0 +1,38 @@
+import timer_wheel
+from misc import assert_equal
+
+class TestTimerWheel(object):
+    def setUp(self):
+        self.wheel = timer_wheel.TimerWheel(tick=1.0)
+        self.fired = []
+
+    def _schedule(self, delay, name):
+        return self.wheel.schedule(delay, lambda: self.fired.append((name, self.wheel._ticks)))
+
+    def _advance(self, ticks):
+        for i in range(ticks):
+            self.wheel._advance()
+
+    def test_fires_on_time_across_levels(self):
+        delays = [1, 2.5, 255, 256, 300, 16383, 16384, 70000]
+        for d in delays:
+            self._schedule(d, d)
+        self._advance(70001)
+        assert_equal(self.fired, [(d, -int(-d // 1)) for d in delays])
+        assert_equal(len(self.wheel), 0)
+
+    def test_cancel(self):
+        t = self._schedule(3, "a")
+        self._schedule(3, "b")
+        self.wheel.cancel(t)
+        self._advance(5)
+        assert_equal(self.fired, [("b", 3)])
+
+    def test_reschedule_from_callback(self):
+        def beat():
+            self.fired.append(self.wheel._ticks)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, beat)
+        self.wheel.schedule(1, beat)
+        self._advance(10)
+        assert_equal(self.fired, [1, 3, 5])
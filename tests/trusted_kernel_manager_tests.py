@@ -18,7 +18,7 @@ from IPython.testing.decorators import skip
 
 def test_init():
     tmkm = trusted_kernel_manager.TrustedMultiKernelManager()
-    assert_len(tmkm._kernels.keys(), 0)
+    assert_len(tmkm._kernels, 0)
     assert_len(tmkm._comps.keys(), 0)
     assert_len(tmkm._clients.keys(), 0)
     assert_is(hasattr(tmkm, "context"), True)
@@ -44,19 +44,20 @@ class TestTrustedMultiKernelManager(object):
     def _populate_comps_kernels(self):
         self.a._comps["testcomp1"] = {"host": "localhost",
                                  "port": random.randrange(50000,60000),
-                                 "kernels": {"kone": None, "ktwo": None},
                                  "max_kernels": 10,
                                  "beat_interval": 3.0,
                                  "first_beat": 5.0}
         self.a._comps["testcomp2"] = {"host": "localhost",
                                  "port": random.randrange(50000,60000),
-                                 "kernels": {"kthree": None},
                                  "max_kernels": 15,
                                  "beat_interval": 2.0,
                                  "first_beat": 4.0}
-        self.a._kernels["kone"] = {"comp_id": "testcomp1", "ports": {"hb_port": 50001, "iopub_port": 50002, "shell_port": 50003, "stdin_port": 50004}}
-        self.a._kernels["ktwo"] = {"comp_id": "testcomp1", "ports": {"hb_port": 50005, "iopub_port": 50006, "shell_port": 50007, "stdin_port": 50008}}
-        self.a._kernels["kthree"] = {"comp_id": "testcomp2", "ports": {"hb_port": 50009, "iopub_port": 50010, "shell_port": 50011, "stdin_port": 50012}}
+        self._add_kernel("kone", "testcomp1", {"hb_port": 50001, "iopub_port": 50002, "shell_port": 50003, "stdin_port": 50004})
+        self._add_kernel("ktwo", "testcomp1", {"hb_port": 50005, "iopub_port": 50006, "shell_port": 50007, "stdin_port": 50008})
+        self._add_kernel("kthree", "testcomp2", {"hb_port": 50009, "iopub_port": 50010, "shell_port": 50011, "stdin_port": 50012})
+
+    def _add_kernel(self, kernel_id, comp_id, connection):
+        self.a._kernels.add(kernel_id, comp_id, connection, None, "active", 0.0, time.time())
 
     def tearDown(self):
         for i in list(self.a._comps):
@@ -86,7 +87,6 @@ class TestTrustedMultiKernelManager(object):
       
     def test_get_kernel_ids_no_args(self):
         self._populate_comps_kernels()
-        self.a._kernels = {"a": None, "b": None, "c": None}
         x = self.a.get_kernel_ids()
         assert_len(x, 3)
 
@@ -118,7 +118,7 @@ class TestTrustedMultiKernelManager(object):
 
     def test_add_computer_success(self): # depends on _setup_ssh_connection, _ssh_untrusted
         new_config = self.default_comp_config.copy()
-        new_config.update({'beat_interval': 0.5, 'first_beat': 1, 'kernels': {}})
+        new_config.update({'beat_interval': 0.5, 'first_beat': 1})
 
         with capture_output(split=True) as (out,err):
             x = self.a.add_computer(self.default_comp_config)
@@ -151,8 +151,8 @@ class TestTrustedMultiKernelManager(object):
         out = out[0]
 
         self._check_all_kernels_killed_out(out)
-        assert_equal(self.a._comps[x]["kernels"], {})
-        assert_equal(self.a._kernels, {})
+        assert_equal(self.a.get_kernel_ids(x), [])
+        assert_len(self.a._kernels, 0)
 
     def test_purge_kernels_success(self): # depends on add_computer, new_session
         x = self.a.add_computer(self.default_comp_config)
@@ -163,8 +163,8 @@ class TestTrustedMultiKernelManager(object):
             self.a.purge_kernels(x)
         out = out[0]
         self._check_all_kernels_killed_out(out)
-        assert_equal(self.a._comps[x]["kernels"], {})
-        assert_equal(self.a._kernels, {})
+        assert_equal(self.a.get_kernel_ids(x), [])
+        assert_len(self.a._kernels, 0)
 
     def test_remove_computer_success(self): # depends on add_computer, new_session
         x = self.a.add_computer(self.default_comp_config)
@@ -231,16 +231,14 @@ class TestTrustedMultiKernelManager(object):
         out = out[0]
 
         assert_in(kern1, self.a._kernels)
-        assert_in("comp_id", self.a._kernels[kern1])
-        assert_uuid(self.a._kernels[kern1]["comp_id"])
-        assert_in("connection", self.a._kernels[kern1])
-        assert_in("executing", self.a._kernels[kern1])
-        assert_is(self.a._kernels[kern1]["executing"], False)
-        assert_in("timeout", self.a._kernels[kern1])
-        assert_greater(time.time(), self.a._kernels[kern1]["timeout"])
-        x = self.a._kernels[kern1]["comp_id"]
-        assert_in(kern1, self.a._comps[x]["kernels"])
-        assert_is_instance(self.a._sessions[kern1], Session)
+        kernel = self.a._kernels[kern1]
+        assert_uuid(kernel.comp_id)
+        assert_in("key", kernel.connection)
+        assert_equal(kernel.executing, 0)
+        assert_equal(kernel.state, "active")
+        assert_greater(time.time(), kernel.timeout)
+        assert_in(kern1, self.a.get_kernel_ids(kernel.comp_id))
+        assert_is_instance(kernel.session, Session)
         #assert_in("CONNECTION FILE ::: ", out)
 
     def test_end_session_success(self): # depends on add_computer, new_session
@@ -250,29 +248,31 @@ class TestTrustedMultiKernelManager(object):
         with capture_output(split=True) as (out,err):
             self.a.end_session(kern1)
 
-        assert_not_in(kern1, self.a._kernels.keys())
-        for v in self.a._comps.values():
-            assert_not_in(kern1, v["kernels"])
+        assert_not_in(kern1, self.a._kernels)
+        for comp_id in self.a._comps:
+            assert_not_in(kern1, self.a.get_kernel_ids(comp_id))
         #assert_in("Killing Kernel ::: %s at "%kern1, out[0])
         #assert_in("Kernel %s successfully killed."%kern1, out[1])
         with capture_output(split=True) as (out,err):
             self.a.end_session(kern2)
 
         assert_not_in(kern2, self.a._kernels)
-        for v in self.a._comps.values():
-            assert_not_in(kern2, v["kernels"])
+        for comp_id in self.a._comps:
+            assert_not_in(kern2, self.a.get_kernel_ids(comp_id))
 
         #assert_in("Killing Kernel ::: %s at "%kern2, out[0])
         #assert_in("Kernel %s successfully killed."%kern2, out[1])
 
     def test_find_open_computer_success(self):
-        self.a._comps["testcomp1"] = {"max_kernels": 3, "kernels": {}}
-        self.a._comps["testcomp2"] = {"max_kernels": 5, "kernels": {}}
+        for comp_id, max_kernels in (("testcomp1", 3), ("testcomp2", 5)):
+            self.a._comps[comp_id] = {"max_kernels": max_kernels}
+            self.a._placement.add_computer(comp_id, self.a._comps[comp_id])
 
         for i in range(8):
             y = self.a._find_open_computer()
             assert_equal(y == "testcomp1" or y == "testcomp2", True)
-            self.a._comps[y]["max_kernels"] -= 1
+            self._add_kernel("k%d" % i, y, {})
+            self.a._placement.update(y, kernels=len(self.a.get_kernel_ids(y)))
 
         try:
             self.a._find_open_computer()
@@ -313,7 +313,7 @@ class TestTrustedMultiKernelManager(object):
     def test_create_iopub_stream(self): # depends on create_connected_stream
         kernel_id = "kern1"
         comp_id = "testcomp1"
-        self.a._kernels[kernel_id] = {"comp_id": comp_id, "connection": {"ip": "127.0.0.1", "iopub_port": 50101}}
+        self._add_kernel(kernel_id, comp_id, {"ip": "127.0.0.1", "iopub_port": 50101})
         self.a._comps[comp_id] = {"host": "localhost"}
 
         ret = self.a.create_iopub_stream(kernel_id)
@@ -325,7 +325,7 @@ class TestTrustedMultiKernelManager(object):
     def test_create_shell_stream(self): # depends on create_connected_stream
         kernel_id = "kern1"
         comp_id = "testcomp1"
-        self.a._kernels[kernel_id] = {"comp_id": comp_id, "connection": {"ip": "127.0.0.1", "shell_port": 50101}}
+        self._add_kernel(kernel_id, comp_id, {"ip": "127.0.0.1", "shell_port": 50101})
         self.a._comps[comp_id] = {"host": "localhost"}
 
         ret = self.a.create_shell_stream(kernel_id)
@@ -337,7 +337,7 @@ class TestTrustedMultiKernelManager(object):
     def test_create_hb_stream(self): # depends on create_connected_stream
         kernel_id = "kern1"
         comp_id = "testcomp1"
-        self.a._kernels[kernel_id] = {"comp_id": comp_id, "connection": {"ip": "127.0.0.1", "hb_port": 50101}}
+        self._add_kernel(kernel_id, comp_id, {"ip": "127.0.0.1", "hb_port": 50101})
         self.a._comps[comp_id] = {"host": "localhost"}
 
         ret = self.a.create_hb_stream(kernel_id)
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+import workspace
+from poll_loop import PollLoop
+from misc import assert_equal
+
+class TestWorkspaces(object):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.calls = []
+        self.ws = workspace.Workspaces(self.root,
+                                       exceeded=lambda k, usage: self.calls.append((k, usage)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _fill(self, kernel_id, files, size=10):
+        path = self.ws.path(kernel_id)
+        for i in range(files):
+            with open(os.path.join(path, "f%d" % i), "w") as f:
+                f.write("x" * size)
+
+    def test_create_and_release(self):
+        path = self.ws.create("k")
+        os.mkdir(os.path.join(path, "sub"))
+        self._fill("k", 3)
+        self.ws.release("k")
+        assert_equal(os.path.exists(path), False)
+        assert_equal(os.listdir(self.ws.trash), [])
+        assert_equal(self.ws.stats["reclaimed_bytes"], 30)
+        assert_equal(self.ws.stats["reclaimed_files"], 5)
+
+    def test_retention(self):
+        loop = PollLoop()
+        ws = workspace.Workspaces(self.root, loop, retention=0.2)
+        kept = ws.create("kept")
+        self._fill("kept", 2)
+        ws.release("kept")
+        dropped = ws.create("dropped")
+        ws.release("dropped", retain=False)
+        assert_equal(ws.status()["retained"], 1)
+        loop.call_later(0.1, loop.stop)
+        loop.start()
+        # the files of an ended kernel can still be served for a while
+        assert_equal(sorted(os.listdir(kept)), ["f0", "f1"])
+        assert_equal(os.path.exists(dropped), False)
+        loop.call_later(0.3, loop.stop)
+        loop.start()
+        assert_equal(os.path.exists(kept), False)
+        assert_equal(os.listdir(ws.trash), [])
+        assert_equal(ws.status()["retained"], 0)
+
+    def test_create_replaces_stale_directory(self):
+        self.ws.create("k")
+        self._fill("k", 2)
+        self.ws.create("k")
+        assert_equal(os.listdir(self.ws.path("k")), [])
+
+    def test_quota(self):
+        self.ws.create("small", {"files": 5})
+        self.ws.create("large", {"bytes": 100, "files": 5})
+        self._fill("small", 4)
+        self._fill("large", 2, size=60)
+        self.ws.scan()
+        assert_equal(self.calls, [("large", {"bytes": 120, "files": 2})])
+        assert_equal(self.ws.status()["bytes"], 160)
+
+    def test_filesystem_type(self):
+        assert_equal(workspace.filesystem_type("/proc/self"), "proc")
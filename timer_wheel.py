@@ -0,0 +1,139 @@
+"""
+A hierarchical timer wheel for the web server's periodic per-kernel work.
+
+Every open kernel connection pings its kernel's heartbeat and checks its
+deadline a few times a second. With one Tornado timer per kernel, the
+IOLoop spends its time managing thousands of timers. The wheel instead
+keeps timers in buckets of ``tick`` seconds, so scheduling and cancelling
+is O(1), and a single IOLoop callback fires all the timers that are due
+in one pass per tick.
+
+There are three levels of 256, 64 and 64 buckets, covering about
+``tick * 2**20`` seconds (29 hours at the default tick of 0.1s). Timers
+further out are parked in the last bucket and rescheduled from there.
+A timer on an outer level is moved inwards when the wheel reaches its
+bucket, as in the Linux kernel's timer wheel.
+"""
+import math
+import time
+
+from zmq.eventloop import ioloop
+
+from log import logger
+
+_LEVELS = ((0, 256), (8, 64), (14, 64)) # (shift, number of buckets)
+_HORIZON = 1 << 20 # ticks covered by all levels together
+
+
+class TimerWheel(object):
+    """
+    Fires callbacks after a delay, with a resolution of ``tick`` seconds.
+
+    :arg float tick: seconds per tick
+    """
+    def __init__(self, tick=0.1):
+        self.tick = tick
+        self._buckets = [[[] for i in range(size)] for shift, size in _LEVELS]
+        self._ticks = 0 # ticks since start
+        self._start = time.time()
+        self._count = 0 # scheduled timers, including cancelled ones not yet dropped
+        self._callback = None
+        self.stats = {"ticks": 0, "fired": 0, "errors": 0,
+                      "cost": 0.0, "max_cost": 0.0, # seconds spent per tick
+                      "lag": 0.0, "max_lag": 0.0} # seconds a tick ran late
+
+    def start(self):
+        """ Start ticking on the IOLoop. """
+        self._start = time.time() - self._ticks * self.tick
+        self._callback = ioloop.PeriodicCallback(self._run, self.tick * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def schedule(self, delay, callback):
+        """
+        Call ``callback()`` once, ``delay`` seconds from now, rounded up to
+        the next tick.
+
+        :returns: a handle for :meth:`cancel`
+        """
+        # allow for rounding errors, e.g. 0.3 / 0.1 > 3
+        ticks = int(math.ceil(delay / self.tick - 1e-9))
+        timer = [self._ticks + max(ticks, 1), callback]
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """ Cancel a timer returned by :meth:`schedule`. """
+        timer[1] = None
+
+    def __len__(self):
+        return self._count
+
+    def _insert(self, timer):
+        due = min(timer[0], self._ticks + _HORIZON - 1)
+        delta = due - self._ticks
+        for (shift, size), buckets in zip(_LEVELS, self._buckets):
+            if delta < size << shift:
+                buckets[(due >> shift) & (size - 1)].append(timer)
+                return
+
+    def _cascade(self, level):
+        shift, size = _LEVELS[level]
+        bucket = self._buckets[level][(self._ticks >> shift) & (size - 1)]
+        self._buckets[level][(self._ticks >> shift) & (size - 1)] = []
+        for timer in bucket:
+            self._insert(timer)
+
+    def _advance(self):
+        """ Move to the next tick and fire the timers that are due. """
+        self._ticks += 1
+        if self._ticks & 255 == 0:
+            if (self._ticks >> 8) & 63 == 0:
+                self._cascade(2)
+            self._cascade(1)
+        index = self._ticks & 255
+        due = self._buckets[0][index]
+        self._buckets[0][index] = []
+        for timer in due:
+            self._count -= 1
+            callback = timer[1]
+            if callback is None:
+                continue
+            if timer[0] > self._ticks:
+                # parked beyond the horizon
+                self._insert(timer)
+                self._count += 1
+                continue
+            timer[1] = None
+            try:
+                callback()
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("Error in timer callback")
+            self.stats["fired"] += 1
+
+    def _run(self):
+        now = time.time()
+        lag = now - (self._start + (self._ticks + 1) * self.tick)
+        # catch up on ticks missed while the IOLoop was busy
+        while self._start + (self._ticks + 1) * self.tick <= now:
+            self._advance()
+        cost = time.time() - now
+        stats = self.stats
+        stats["ticks"] += 1
+        stats["cost"] = 0.9 * stats["cost"] + 0.1 * cost
+        stats["max_cost"] = max(stats["max_cost"], cost)
+        stats["lag"] = 0.9 * stats["lag"] + 0.1 * max(lag, 0)
+        stats["max_lag"] = max(stats["max_lag"], lag)
+
+    def status(self):
+        """
+        :returns: the number of timers and the counters in :attr:`stats`
+        :rtype: dict
+        """
+        return dict(self.stats, timers=self._count, tick=self.tick)
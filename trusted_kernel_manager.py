@@ -1,4 +1,4 @@
-import uuid, random
+import uuid
 import zmq
 import socket
 from zmq.eventloop.zmqstream import ZMQStream
@@ -9,43 +9,118 @@ except ImportError:
     from IPython.zmq.session import Session
 from zmq import ssh
 import paramiko
+import math
 import os
 import time
 import sys
-from Queue import Queue, Empty
+import select
+import shlex
+import subprocess
+import threading
+from zmq.eventloop import ioloop
 import sender
+from prefork_pool import PreforkPool
+from placement import Placement
+from admission import AdmissionQueue
+from ratelimit import RateLimits
+from lease import Leases
+from kernel_registry import KernelRegistry
+from timer_wheel import TimerWheel
+from iopub_mux import Demultiplexer
+import checkpoint
 
 from log import logger
 
+# Seconds an adopted kernel in use is kept past its deadline for its client
+# to reconnect to the new web server
+ADOPTION_GRACE = 30.0
+
 
 class TrustedMultiKernelManager(object):
     """ A class for managing multiple kernels on the trusted side. """
     def __init__(self, computers = None, default_computer_config = None,
-                 max_kernel_timeout = 0.0, tmp_dir = None):
+                 max_kernel_timeout = 0.0, tmp_dir = None,
+                 msg_timeout = 20.0, start_retries = 1, pool_interval = 5.0,
+                 placement_policy = "least_loaded", stats_interval = 10.0,
+                 timer_tick = 0.1, admission_queue_size = 100,
+                 admission_max_wait = 30.0, admission_shed_wait = 10.0,
+                 rate_limits = None, api_keys = None,
+                 registry_checkpoint = None, checkpoint_interval = 5.0,
+                 kernel_leases = None):
 
-        self._kernel_queue = Queue()
+        self._pool = PreforkPool() # Preforked kernels and their target counts
+        self._placement = Placement(placement_policy) # Chooses computers for new kernels
+        self.timers = TimerWheel(timer_tick) # Heartbeats of the kernel connections
+        # Kernel requests waiting for room when every computer is full
+        self.admission = AdmissionQueue(admission_queue_size, admission_max_wait,
+                                        admission_shed_wait)
+        # Rate limits and kernel quotas of clients, enforced by the handlers
+        self.limits = RateLimits(rate_limits, api_keys)
+        # Preforked kernels reserved for pages as they are rendered, or None
+        self.leases = Leases(**kernel_leases) if kernel_leases else None
 
-        self._kernels = {} #kernel_id: {"comp_id": comp_id, "connection": {"key": hmac_key, "hb_port": hb, "iopub_port": iopub, "shell_port": shell, "stdin_port": stdin, "referer": referer, "remote_ip": remote_ip}}
-        self._comps = {} #comp_id: {"host:"", "port": ssh_port, "kernels": {}, "max": #, "beat_interval": Float, "first_beat": Float, "resource_limits": {resource: limit}}
+        self._kernels = KernelRegistry() # Records of all kernels, indexed by computer, client and state
+        self._comps = {} #comp_id: {"host:"", "port": ssh_port, "max": #, "beat_interval": Float, "first_beat": Float, "resource_limits": {resource: limit}}
         self._clients = {} #comp_id: {"ssh": paramiko client}
-        self._sessions = {} # kernel_id: Session
+        self._bringup = {} #comp_id: {"host": host, "state": "starting"/"ready"/"failed", "started": time, "finished": time}
+        self._configs = {} #comp_id: configuration the computer was added with, for checkpoints
+        self._waiting = [] # kernel requests that arrived before any computer was ready
+        self._closed = False
+        self._iopub_mux = {} # comp_id: Demultiplexer of the computer's forwarded iopub messages
+        self._batches = {} # comp_id: number of kernels being started in batches
+        self._service_busy = {} # comp_id: number of execute_forked requests in flight
 
         self._sender = sender.AsyncSender() # Manages asynchronous communication
+        self._sender.late_reply_callback = self._late_reply
+        self._sender.reply_callback = self._record_load
+        self._sender.receive_events(self._on_event)
 
         self.context = zmq.Context()
         self.default_computer_config = default_computer_config
 
         self.max_kernel_timeout = float(max_kernel_timeout)
         self.tmp_dir = tmp_dir
+        # Seconds to wait for an untrusted computer to answer a message
+        self.msg_timeout = msg_timeout
+        # Number of other computers to try when starting a kernel fails
+        self.start_retries = start_retries
+
+        # File the computers and kernels are saved to, so that the next web
+        # server can adopt them (see the checkpoint module)
+        self.registry_checkpoint = registry_checkpoint
+        self._checkpointed = None
 
-        if computers is not None:
-            for comp in computers:
-                comp_id = self.add_computer(comp)
-                preforked = comp.get("preforked_kernels", 0)
-                if preforked:
-                    for i in range(preforked):
-                        self.new_session_prefork(comp_id = comp_id)
-                    logger.debug("Requested %d preforked kernels"%preforked)
+        # Computers are brought up in the background, all at once; kernel
+        # requests are served as soon as the first one is ready. Computers
+        # in the checkpoint of an earlier web server are adopted instead.
+        computers = list(computers or [])
+        saved = checkpoint.load(registry_checkpoint) if registry_checkpoint else None
+        if saved is not None:
+            logger.info("Adopting %d computers and %d kernels from the checkpoint of %s",
+                        len(saved["computers"]), len(saved["kernels"]), time.ctime(saved["time"]))
+            kernels = {}
+            for record in saved["kernels"]:
+                kernels.setdefault(record["comp_id"], []).append(record)
+            for entry in saved["computers"]:
+                for comp in computers:
+                    if checkpoint.same_config(comp, entry["config"]):
+                        computers.remove(comp)
+                        break
+                self._adopt_computer(entry, kernels.get(entry["comp_id"], []))
+        for comp in computers:
+            self.add_computer_async(comp)
+
+        self._pool_callback = ioloop.PeriodicCallback(self._adjust_pools,
+                                                      pool_interval * 1000)
+        self._pool_callback.start()
+        self._stats_callback = ioloop.PeriodicCallback(self._request_stats,
+                                                       stats_interval * 1000)
+        self._stats_callback.start()
+        if registry_checkpoint:
+            self._checkpoint_callback = ioloop.PeriodicCallback(self._checkpoint_if_changed,
+                                                                checkpoint_interval * 1000)
+            self._checkpoint_callback.start()
+        self.timers.start()
 
     def get_kernel_ids(self, comp = None):
         """ A function for obtaining kernel ids of a particular computer.
@@ -54,14 +129,9 @@ class TrustedMultiKernelManager(object):
         :returns: kernel ids of a computer if its id is given or all kernel ids if no id is given
         :rtype: list
         """
-        ids = []
-        if comp is not None and comp in self._comps:
-            ids = self._comps[comp]["kernels"].keys()
-        elif comp is not None and comp not in self._comps:
-            pass
-        else:
-            ids = self._kernels.keys()
-        return ids
+        if comp is not None:
+            return self._kernels.on_computer(comp)
+        return list(self._kernels)
 
     def get_hb_info(self, kernel_id):
         """ Returns basic heartbeat information for a given kernel. 
@@ -71,8 +141,7 @@ class TrustedMultiKernelManager(object):
         :rtype: tuple
         """
         
-        comp_id = self._kernels[kernel_id]["comp_id"]
-        comp = self._comps[comp_id]
+        comp = self._comps[self._kernels[kernel_id].comp_id]
         return (comp["beat_interval"], comp["first_beat"])
 
     def _setup_ssh_connection(self, host, username):
@@ -87,10 +156,50 @@ class TrustedMultiKernelManager(object):
         ssh_client.connect(host, username=username)
         return ssh_client
 
-    def _ssh_untrusted(self, cfg, client, comp_id):
+    def _receiver_command(self, cfg, comp_id):
+        """ The shell command that starts the receiver of a computer. """
         ip = socket.gethostbyname(cfg["host"])
         code = "%s '%s/receiver.py' '%s' '%s' '%s'"%(cfg["python"], cfg["location"], ip, comp_id, self.tmp_dir)
+        if cfg.get("zygote"):
+            code += " --zygote"
+        if cfg.get("forward_iopub"):
+            code += " --forward-iopub"
+        if cfg.get("local"):
+            code += " --ipc"
+        if cfg.get("service_kernels"):
+            code += " --service-kernels %d" % cfg["service_kernels"]
         logger.debug(code)
+        return code
+
+    def _launch_local(self, cfg, comp_id):
+        """ Starts the receiver of a computer on this machine.
+
+        :returns: the receiver process and the endpoint of its control socket,
+            or None if it did not start within 40 seconds
+        :rtype: tuple
+        """
+        code = self._receiver_command(cfg, comp_id)
+        # With checkpoints, the receiver outlives this web server, so it
+        # should not get the signals meant for this process group
+        proc = subprocess.Popen(shlex.split(code), stdout=subprocess.PIPE,
+                                preexec_fn=os.setsid if self.registry_checkpoint else None)
+        deadline = time.time() + 40
+        lines = []
+        while len(lines) < 2:
+            if not select.select([proc.stdout], [], [], max(deadline - time.time(), 0))[0]:
+                break
+            line = proc.stdout.readline()
+            if not line:
+                break
+            lines.append(line)
+        if len(lines) < 2:
+            logger.error("The receiver on this machine did not start.")
+            proc.kill()
+            return proc, None
+        return proc, lines[0].strip()
+
+    def _ssh_untrusted(self, cfg, client, comp_id):
+        code = self._receiver_command(cfg, comp_id)
         ssh_stdin, ssh_stdout, ssh_stderr = client.exec_command(code)
         stdout_channel = ssh_stdout.channel
 
@@ -110,34 +219,328 @@ class TrustedMultiKernelManager(object):
                 return None
             if polls>20:
                 return None
-        return int(output.split("\n")[0])
+        return output.split("\n")[0]
 
     def add_computer(self, config):
         """ Adds a tracked computer.
 
+        This blocks until the computer's receiver has started; see
+        :meth:`add_computer_async`.
+
         :arg dict config: configuration dictionary of the computer to be added
-        :returns: computer id assigned to added computer
+        :returns: computer id assigned to added computer, or None if it
+            could not be started
         :rtype: string
         """
+        comp_id, cfg = self._new_computer(config)
+        client, endpoint = self._start_receiver(comp_id, cfg)
+        return self._computer_started(comp_id, cfg, client, endpoint)
+
+    def add_computer_async(self, config, callback=None):
+        """ Adds a tracked computer without blocking.
+
+        The computer's receiver is started (over SSH or as a subprocess) in
+        a separate thread and the computer is registered on the IOLoop once
+        it answers. Until then, its state in :meth:`readiness` is
+        ``"starting"``.
+
+        :arg dict config: configuration dictionary of the computer to be added
+        :arg callable callback: called on the IOLoop with the computer id,
+            or None if the computer could not be started
+        :returns: computer id assigned to the computer
+        :rtype: string
+        """
+        comp_id, cfg = self._new_computer(config)
+        loop = ioloop.IOLoop.instance()
+        def start():
+            try:
+                client, endpoint = self._start_receiver(comp_id, cfg)
+            except Exception:
+                logger.exception("Could not start computer %s", comp_id)
+                client, endpoint = None, None
+            loop.add_callback(lambda: finish(client, endpoint))
+        def finish(client, endpoint):
+            retval = self._computer_started(comp_id, cfg, client, endpoint)
+            if retval is not None:
+                self._adjust_pool(comp_id)
+            if callback is not None:
+                callback(retval)
+        thread = threading.Thread(target=start, name="computer-%s" % comp_id[:4])
+        thread.daemon = True
+        thread.start()
+        return comp_id
+
+    def _new_computer(self, config):
         defaults = self.default_computer_config
         comp_id = str(uuid.uuid4())
         cfg = dict(defaults.items() + config.items())
-        cfg["kernels"] = {}
-        req = self.context.socket(zmq.REQ)
-
-        client = self._setup_ssh_connection(cfg["host"], cfg["username"])
-        port = self._ssh_untrusted(cfg, client, comp_id)
-        retval = None
-        if port is None:
-            logger.error("Computer %s did not respond, connecting failed!"%comp_id)
+        self._bringup[comp_id] = {"host": cfg["host"], "state": "starting",
+                                  "started": time.time()}
+        self._configs[comp_id] = config
+        return comp_id, cfg
+
+    def _start_receiver(self, comp_id, cfg):
+        """ Starts the receiver of a computer. This blocks, but touches no
+        state of the kernel manager, so it may run in any thread.
+
+        :returns: the client the receiver runs under and the endpoint of its
+            control socket, which is None if it did not start
+        :rtype: tuple
+        """
+        if cfg.get("local"):
+            process, endpoint = self._launch_local(cfg, comp_id)
+            return {"process": process}, endpoint
+        ssh = self._setup_ssh_connection(cfg["host"], cfg["username"])
+        return {"ssh": ssh}, self._ssh_untrusted(cfg, ssh, comp_id)
+
+    def _computer_started(self, comp_id, cfg, client, endpoint):
+        """ Registers a computer whose receiver has started.
+
+        :returns: the computer id, or None if the receiver did not start
+        """
+        status = self._bringup[comp_id]
+        if endpoint is None or self._closed:
+            status["finished"] = time.time()
+            status["state"] = "failed"
+            self._configs.pop(comp_id, None)
+            if endpoint is None:
+                logger.error("Computer %s did not respond, connecting failed!"%comp_id)
+            if client is not None:
+                self._close_client(client)
+            if not self._starting():
+                # nothing left to wait for, so the waiting requests fail
+                self._start_waiting()
+            return None
+        self._sender.register_computer(cfg["host"], None, comp_id=comp_id, endpoint=endpoint)
+        client["endpoint"] = endpoint
+        self._computer_ready(comp_id, cfg, client)
+        return comp_id
+
+    def _computer_ready(self, comp_id, cfg, client, kernels=()):
+        """ Starts placing kernels on a registered computer.
+
+        :arg list kernels: records of kernels from a checkpoint that the
+            computer still runs
+        """
+        status = self._bringup[comp_id]
+        status["finished"] = time.time()
+        self._clients[comp_id] = client
+        self._comps[comp_id] = cfg
+        self._pool.add_computer(comp_id, cfg)
+        self._placement.add_computer(comp_id, cfg)
+        for record in kernels:
+            self._adopt_kernel(comp_id, record)
+        self._placement.update(comp_id, kernels=self._kernels.count(comp_id))
+        status["state"] = "ready"
+        logger.info("ZMQ Connection with computer %s at %s established in %.1fs."
+                    % (comp_id, client["endpoint"], status["finished"] - status["started"]))
+        self._start_waiting()
+        self._admit_waiting(cfg["max_kernels"])
+
+    def _adopt_computer(self, entry, kernels):
+        """ Takes over the receiver of a computer from the checkpoint of an
+        earlier web server, along with those of its kernels that still run.
+        A computer whose receiver does not answer is started afresh.
+
+        :arg dict entry: the computer's entry in the checkpoint
+        :arg list kernels: records of the computer's kernels in the checkpoint
+        """
+        comp_id, config, endpoint = entry["comp_id"], entry["config"], entry["endpoint"]
+        cfg = dict(self.default_computer_config.items() + config.items())
+        self._bringup[comp_id] = {"host": cfg["host"], "state": "starting",
+                                  "started": time.time()}
+        self._configs[comp_id] = config
+        self._sender.register_computer(cfg["host"], None, comp_id=comp_id, endpoint=endpoint)
+        def cb(reply):
+            if self._closed:
+                return
+            if reply["type"] != "success":
+                # a receiver that does not know list_kernels; have it exit
+                self._sender.send_msg_async({"type": "remove_computer"}, comp_id,
+                                            callback=lambda reply: None,
+                                            timeout=self.msg_timeout, errback=lambda: None)
+                failed()
+                return
+            running = set(reply["content"]["kernels"])
+            self._computer_ready(comp_id, cfg, {"endpoint": endpoint},
+                                 [k for k in kernels if k["kernel_id"] in running])
+            # Kernels started after the checkpoint was written, or being
+            # ended when it was, have no records
+            for kernel_id in running.difference(k["kernel_id"] for k in kernels):
+                self._sender.send_msg_async({"type": "kill_kernel",
+                                             "content": {"kernel_id": kernel_id}},
+                                            comp_id, callback=lambda reply: None,
+                                            timeout=self.msg_timeout, errback=lambda: None)
+            logger.info("Adopted computer %s with %d of its %d kernels",
+                        comp_id[:4], self._kernels.count(comp_id), len(kernels))
+            if entry["draining"]:
+                self.drain_computer(comp_id, entry["remove_when_drained"])
+            else:
+                self._adjust_pool(comp_id)
+        def failed():
+            logger.warning("Computer %s did not answer at %s, starting it afresh",
+                           comp_id[:4], endpoint)
+            del self._bringup[comp_id]
+            del self._configs[comp_id]
+            if not self._closed:
+                self.add_computer_async(config)
+        self._sender.send_msg_async({"type": "list_kernels"}, comp_id, callback=cb,
+                                    timeout=self.msg_timeout, errback=failed)
+
+    def _adopt_kernel(self, comp_id, record):
+        """ Records a kernel from a checkpoint. A kernel in use is ended if
+        its client has not reconnected by its deadline (or within
+        :data:`ADOPTION_GRACE` seconds, if that is later). """
+        connection = record["connection"]
+        kernel = self._kernels.add(record["kernel_id"], comp_id, connection,
+                                   Session(key=connection["key"]), record["state"],
+                                   record["timeout"], record["deadline"])
+        self._kernels.set_client(kernel, record["referer"], record["remote_ip"])
+        if kernel.state == "preforked":
+            self._pool.adopt(kernel.kernel_id, comp_id)
         else:
-            self._sender.register_computer(cfg["host"], port, comp_id=comp_id)
-            self._clients[comp_id] = {"ssh": client}
-            self._comps[comp_id] = cfg
-            logger.info("ZMQ Connection with computer %s at port %d established." %(comp_id, port))
-            retval = comp_id
+            kernel_id = kernel.kernel_id
+            self.timers.schedule(max(kernel.deadline - time.time(), 0) + ADOPTION_GRACE,
+                                 lambda: self._end_unclaimed(kernel_id))
+
+    def _end_unclaimed(self, kernel_id):
+        kernel = self._kernels.get(kernel_id)
+        if kernel is not None and kernel.state == "active" and kernel.kill is None:
+            logger.info("Ending adopted kernel %s, whose client did not reconnect", kernel_id)
+            self.end_session(kernel_id)
+
+    def _checkpoint_state(self):
+        """ What a checkpoint holds, apart from the kernel deadlines. """
+        return (self._kernels.changes,
+                sorted((comp_id, cfg.get("draining"), cfg.get("removing"))
+                       for comp_id, cfg in self._comps.iteritems()))
 
-        return retval
+    def checkpoint(self):
+        """ Writes the computers and the records of their kernels to the
+        ``registry_checkpoint`` file, see :mod:`checkpoint`. """
+        computers = []
+        kernels = []
+        for comp_id, cfg in self._comps.iteritems():
+            if cfg.get("removing"):
+                continue
+            computers.append({"comp_id": comp_id,
+                              "config": self._configs[comp_id],
+                              "endpoint": self._clients[comp_id]["endpoint"],
+                              "draining": bool(cfg.get("draining")),
+                              "remove_when_drained": bool(cfg.get("remove_when_drained"))})
+            kernels.extend(self._kernels.dump(comp_id))
+        state = self._checkpoint_state()
+        checkpoint.save(self.registry_checkpoint, computers, kernels)
+        self._checkpointed = state
+
+    def _checkpoint_if_changed(self):
+        if self._closed or self._checkpoint_state() == self._checkpointed:
+            return
+        try:
+            self.checkpoint()
+        except (IOError, OSError):
+            logger.exception("Could not write checkpoint %s", self.registry_checkpoint)
+
+    def detach(self):
+        """ Stops managing the computers without ending their kernels, for a
+        web server that is being replaced: a last checkpoint, with the
+        current deadlines, is written for the next web server to adopt. """
+        self._closed = True
+        if self.registry_checkpoint:
+            self.checkpoint()
+
+    def _close_client(self, client, grace=0):
+        """ Closes the SSH connection of a receiver, or waits up to
+        ``grace`` seconds (without blocking) for its process to exit
+        before killing it. """
+        if "ssh" in client:
+            client["ssh"].close()
+            return
+        process = client.get("process")
+        if process is None or process.poll() is not None:
+            # adopted receivers are not children of this process
+            return
+        if grace > 0:
+            ioloop.IOLoop.instance().add_timeout(time.time() + 0.5,
+                lambda: self._close_client(client, grace - 0.5))
+        else:
+            process.kill()
+            process.wait()
+
+    def _starting(self):
+        """ Whether some computer is still being brought up. """
+        return any(s["state"] == "starting" for s in self._bringup.itervalues())
+
+    def _start_waiting(self):
+        waiting, self._waiting = self._waiting, []
+        for start in waiting:
+            start()
+
+    def readiness(self):
+        """ The state of every computer that has been added.
+
+        :returns: whether any computer is ready to start kernels, and the
+            host, state (``"starting"``, ``"ready"`` or ``"failed"``) and
+            start time of each computer, with the time it took to start if
+            it is no longer starting
+        :rtype: dict
+        """
+        computers = {}
+        for comp_id, status in self._bringup.iteritems():
+            comp = dict(status)
+            if "finished" in comp:
+                comp["seconds"] = comp.pop("finished") - comp["started"]
+            computers[comp_id] = comp
+        return {"ready": bool(self._comps), "computers": computers}
+
+    def computer_status(self):
+        """ The live state of every computer, for the admin API.
+
+        :returns: for each computer, its entry in :meth:`readiness` (whose
+            state also may be ``"draining"`` or ``"removing"``) and, unless
+            it failed to start, its kernel count, kernel slots, preforked
+            kernels and last load report
+        :rtype: dict
+        """
+        computers = self.readiness()["computers"]
+        for comp_id, comp in computers.iteritems():
+            cfg = self._comps.get(comp_id)
+            if cfg is not None:
+                comp.update(kernels=self._kernels.count(comp_id),
+                            max_kernels=cfg["max_kernels"],
+                            preforked=self._pool.qsize(comp_id),
+                            load=cfg.get("load"))
+        return computers
+
+    def drain_computer(self, comp_id, remove=False):
+        """ Stops placing new kernels on a computer.
+
+        Its preforked kernels are ended and no new ones are started, while
+        the kernels in use run until they end as usual.
+
+        :arg str comp_id: the id of the computer to drain
+        :arg bool remove: remove the computer once its last kernel ended
+        :returns: False if the computer is already being removed
+        :rtype: bool
+        """
+        cfg = self._comps[comp_id]
+        if cfg.get("removing"):
+            return False
+        cfg["draining"] = True
+        cfg["remove_when_drained"] = cfg.get("remove_when_drained") or remove
+        self._bringup[comp_id]["state"] = "draining"
+        self._placement.set_available(comp_id, False)
+        for kernel_id in self._pool.remove_computer(comp_id):
+            self.end_session(kernel_id)
+        logger.info("Draining computer %s (%d kernels)", comp_id[:4], self._kernels.count(comp_id))
+        self._check_drained(comp_id)
+        return True
+
+    def _check_drained(self, comp_id):
+        cfg = self._comps.get(comp_id)
+        if cfg is not None and cfg.get("remove_when_drained") and not self._kernels.count(comp_id):
+            logger.info("Computer %s is drained", comp_id[:4])
+            self.remove_computer_async(comp_id)
 
 
     def purge_kernels(self, comp_id):
@@ -145,72 +548,161 @@ class TrustedMultiKernelManager(object):
 
             :arg str comp_id: the id of the computer whose kernels you want to purge
         """
-        reply = self._sender.send_msg({"type": "purge_kernels"}, comp_id)
+        reply = self._sender.send_msg({"type": "purge_kernels"}, comp_id,
+                                      timeout=self.msg_timeout)
+        self._pool.clear(comp_id)
+        self._placement.update(comp_id, kernels=0)
+        self._forget_computer_kernels(comp_id)
 
-        for i in self._comps[comp_id]["kernels"].keys():
-            del self._kernels[i]
-        self._comps[comp_id]["kernels"] = {}
+    def _forget_computer_kernels(self, comp_id):
+        """ Drops the trusted side records of all kernels on a computer. """
+        for kernel in self._kernels.remove_computer(comp_id):
+            self.limits.kernel_ended(kernel.kernel_id)
 
     def shutdown(self):
         """ Ends all kernel processes on all computers. """
+        # Computers that are still starting are stopped once they have
+        self._closed = True
         for comp_id in self._comps.keys():
             self.remove_computer(comp_id)
+        if self.registry_checkpoint and os.path.exists(self.registry_checkpoint):
+            # there is nothing left to adopt
+            os.remove(self.registry_checkpoint)
 
     def remove_computer(self, comp_id):
         """ Removes a tracked computer. 
 
         :arg str comp_id: the id of the computer that you want to remove
         """
-        ssh_client = self._clients[comp_id]["ssh"]
-        reply = self._sender.send_msg({"type": "remove_computer"}, comp_id)
-        for i in self._comps[comp_id]["kernels"].keys():
-            del self._kernels[i]
-        ssh_client.close()
+        client = self._clients[comp_id]
+        reply = self._sender.send_msg({"type": "remove_computer"}, comp_id,
+                                      timeout=self.msg_timeout)
+        self._pool.remove_computer(comp_id)
+        self._placement.remove_computer(comp_id)
+        self._forget_computer_kernels(comp_id)
+        if comp_id in self._iopub_mux:
+            self._iopub_mux.pop(comp_id).close()
+        process = client.get("process")
+        if reply is not None and process is not None:
+            # The receiver exits after replying
+            deadline = time.time() + 10
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+        # a receiver that did not reply or exit is killed
+        self._close_client(client)
         del self._comps[comp_id]
         del self._clients[comp_id]
+        self._bringup.pop(comp_id, None)
+        self._configs.pop(comp_id, None)
+
+    def remove_computer_async(self, comp_id, callback=None):
+        """ Removes a tracked computer without blocking.
+
+        No new kernels are placed on the computer from now on. Its
+        receiver is asked to end all its kernels and exit; the computer is
+        forgotten when it answers or does not answer in time.
+
+        :arg str comp_id: the id of the computer that you want to remove
+        :arg callable callback: called without arguments once it is removed
+        :returns: False if the computer is already being removed, in which
+            case ``callback`` is not called
+        :rtype: bool
+        """
+        cfg = self._comps[comp_id]
+        if cfg.get("removing"):
+            return False
+        cfg["removing"] = True
+        self._bringup[comp_id]["state"] = "removing"
+        self._placement.set_available(comp_id, False)
+        def removed(reply=None):
+            client = self._clients.pop(comp_id)
+            self._pool.remove_computer(comp_id)
+            self._placement.remove_computer(comp_id)
+            del self._comps[comp_id]
+            self._forget_computer_kernels(comp_id)
+            if comp_id in self._iopub_mux:
+                self._iopub_mux.pop(comp_id).close()
+            self._bringup.pop(comp_id, None)
+            self._configs.pop(comp_id, None)
+            # The receiver exits after replying
+            self._close_client(client, grace=10 if reply is not None else 0)
+            logger.info("Removed computer %s", comp_id[:4])
+            if callback is not None:
+                callback()
+        self._sender.send_msg_async({"type": "remove_computer"}, comp_id,
+                                    callback=removed, timeout=self.msg_timeout,
+                                    errback=removed)
+        return True
 
     def restart_kernel(self, kernel_id):
         """ Restarts a given kernel.
 
         :arg str kernel_id: the id of the kernel you want restarted
         """
-        comp_id = self._kernels[kernel_id]["comp_id"]
+        comp_id = self._kernels[kernel_id].comp_id
         reply = self._sender.send_msg({"type": "restart_kernel",
                                        "content": {"kernel_id": kernel_id}},
-                                      comp_id)
+                                      comp_id, timeout=self.msg_timeout)
 
     def interrupt_kernel(self, kernel_id):
         """ Interrupts a given kernel. 
 
         :arg str kernel_id: the id of the kernel you want interrupted
         """
-        comp_id = self._kernels[kernel_id]["comp_id"]
+        comp_id = self._kernels[kernel_id].comp_id
         reply = self._sender.send_msg({"type": "interrupt_kernel",
                                        "content": {"kernel_id": kernel_id}},
-                                      comp_id)
+                                      comp_id, timeout=self.msg_timeout)
 
-        if reply["type"] == "success":
+        if reply is not None and reply["type"] == "success":
             logger.info("Kernel %s interrupted."%kernel_id)
         else:
             logger.info("Kernel %s not interrupted!"%kernel_id)
         return reply
 
-    def _setup_session(self, reply, comp_id, timeout=None):
+    def _record_load(self, comp_id, reply):
+        """
+        Keep the load snapshot that the untrusted side attaches to every
+        reply and feed it to the placement engine.
+        """
+        load = reply.get("load")
+        if load is not None and comp_id in self._comps:
+            self._comps[comp_id]["load"] = load
+            self._comps[comp_id]["load_time"] = time.time()
+            self._placement.update(comp_id, load=load)
+            self._admit_waiting()
+
+    def _request_stats(self):
+        """
+        Ask computers that have been quiet for a while for a fresh load
+        snapshot, which arrives through :meth:`_record_load`.
+        """
+        now = time.time()
+        interval = self._stats_callback.callback_time / 1000.0
+        for comp_id, cfg in self._comps.items():
+            if now - cfg.get("load_time", 0) >= interval:
+                self._sender.send_msg_async({"type": "stats"}, comp_id,
+                                            callback=lambda reply: None,
+                                            timeout=self.msg_timeout,
+                                            errback=lambda: None)
+
+    def _setup_session(self, reply, comp_id, timeout=None, state="active"):
         """
         Set up the kernel information contained in the untrusted reply message `reply` from computer `comp_id`.
+
+        :returns: the record of the kernel
+        :rtype: kernel_registry.Kernel
         """
         reply_content = reply["content"]
         kernel_id = reply_content["kernel_id"]
         kernel_connection = reply_content["connection"]
         if timeout is None :
             timeout = self.max_kernel_timeout
-        self._kernels[kernel_id] = {"comp_id": comp_id,
-                                    "connection": kernel_connection,
-                                    "executing": 0, # number of active execute_requests
-                                    "deadline": time.time()+timeout,
-                                    "timeout": timeout}
-        self._comps[comp_id]["kernels"][kernel_id] = None
-        self._sessions[kernel_id] = Session(key=kernel_connection["key"])
+        kernel = self._kernels.add(kernel_id, comp_id, kernel_connection,
+                                   Session(key=kernel_connection["key"]), state,
+                                   timeout, time.time()+timeout)
+        self._placement.update(comp_id, kernels=self._kernels.count(comp_id))
+        return kernel
 
     def new_session(self, comp_id=None, limited=True):
         """ Starts a new kernel on an open or provided computer.
@@ -227,79 +719,447 @@ class TrustedMultiKernelManager(object):
         if comp_id is None:
             comp_id = self._find_open_computer()
 
-        resource_limits = self._comps[comp_id].get("resource_limits") if limited else None
-        reply = self._sender.send_msg({"type":"start_kernel", "content": {"resource_limits": resource_limits}}, comp_id)
-        if reply["type"] == "success":
+        reply = self._sender.send_msg(self._start_kernel_msg(comp_id, limited), comp_id,
+                                      timeout=self.msg_timeout)
+        if reply is not None and reply["type"] == "success":
             self._setup_session(reply, comp_id)
             return reply["content"]["kernel_id"]
         else:
             return False
 
+    def _start_kernel_msg(self, comp_id, limited=True):
+        """
+        The start_kernel message for a computer, with its resource limits
+        (if ``limited``) and workspace quota.
+        """
+        cfg = self._comps[comp_id]
+        return {"type": "start_kernel",
+                "content": {"resource_limits": cfg.get("resource_limits") if limited else None,
+                            "workspace_quota": cfg.get("workspace_quota")}}
+
     def new_session_prefork(self, comp_id):
         """
         Start up a new kernel asynchronously on a specific computer and put it in the prefork queue
         """
-        resource_limits = self._comps[comp_id].get("resource_limits")
+        started = time.time()
+        self._pool.spawning(comp_id)
         def cb(reply):
+            if comp_id not in self._comps:
+                # removed meanwhile, along with its kernels
+                return
             if reply["type"] == "success":
                 kernel_id = reply["content"]["kernel_id"]
-                self._setup_session(reply, comp_id, timeout=float('inf'))
-                self._kernel_queue.put((kernel_id, comp_id))
-                logger.info("Started preforked kernel on %s: %s", comp_id[:4], kernel_id)
+                self._setup_session(reply, comp_id, timeout=float('inf'), state="preforked")
+                if self._pool.add(kernel_id, comp_id, time.time() - started):
+                    self._placement.update(comp_id, spawn_latency=self._pool.spawn_latency(comp_id))
+                    logger.info("Started preforked kernel on %s: %s", comp_id[:4], kernel_id)
+                else:
+                    self.end_session(kernel_id)
             else:
+                self._pool.spawn_failed(comp_id)
                 logger.error("Error starting prefork kernel on computer %s: %s", comp_id, reply)
+        def failed():
+            self._pool.spawn_failed(comp_id)
+            logger.error("Computer %s did not answer a prefork request", comp_id)
         logger.info("Trying to start kernel on %s", comp_id[:4])
-        self._sender.send_msg_async({"type":"start_kernel", "content": {"resource_limits": resource_limits}}, comp_id, callback=cb)
+        self._sender.send_msg_async(self._start_kernel_msg(comp_id), comp_id, callback=cb,
+                                    timeout=self.msg_timeout, errback=failed)
+
+    def _adjust_pool(self, comp_id):
+        """
+        Recycle stale preforked kernels on a computer, retire one surplus
+        kernel and start kernels until the pool reaches its target size.
+        """
+        cfg = self._comps[comp_id]
+        if cfg.get("draining") or cfg.get("removing"):
+            return
+        for kernel_id in self._pool.stale(comp_id) + self._pool.surplus(comp_id):
+            logger.info("Retiring preforked kernel %s on %s", kernel_id, comp_id[:4])
+            self.end_session(kernel_id)
+        room = cfg["max_kernels"] - self._kernels.count(comp_id)
+        count = min(self._pool.wanted(comp_id), room)
+        self._pool.grow(comp_id, count)
+        for i in range(count):
+            self.new_session_prefork(comp_id)
+
+    def _adjust_pools(self):
+        """ Periodically resize the preforked kernel pools to follow demand. """
+        self._pool.update_targets()
+        for comp_id in self._comps.keys():
+            self._adjust_pool(comp_id)
 
     def new_session_async(self, referer='', remote_ip='', timeout = None, callback=None):
         """ Starts a new kernel on an open computer.
 
         We try to get a kernel off a queue of preforked kernels to minimize
         startup time. If we can, we return the preforked kernel id via a
-        callback and then start up a new kernel on the preforked queue. If
+        callback and then top up the preforked pool of that computer. If
         the prefork queue is empty (e.g. in the case of a large number of
         requests), then we start up a kernel asynchronously and return that
-        kernel id via a callback without starting a new kernel on the
-        preforked queue. The preforked queue will repopulate when the number
-        of requests goes down.
+        kernel id via a callback. The size of the preforked pools follows
+        the rate of requests (see :class:`prefork_pool.PreforkPool`).
+
+        If every computer is full, the request waits for room in the
+        admission queue (see :class:`admission.AdmissionQueue`), which may
+        also reject it right away; the callback is then called with False.
 
         :returns: kernel id assigned to the newly created kernel
         :rtype: string
         """
+        self._pool.record_request()
+        if len(self.admission):
+            # earlier requests are waiting for room and go first
+            self._enqueue(lambda: self._activate(referer, remote_ip, timeout, callback),
+                          callback)
+        else:
+            self._activate(referer, remote_ip, timeout, callback)
+
+    def _activate(self, referer, remote_ip, timeout, callback):
+        """ Hands out a preforked kernel or starts a new one. """
+        kernel_id = self._activate_preforked(referer, remote_ip, timeout)
+        if kernel_id is None:
+            self._start_session_async(referer, remote_ip, callback)
+        else:
+            callback(kernel_id)
+
+    def _activate_preforked(self, referer, remote_ip, timeout):
+        """ Hands out a preforked kernel.
+
+        :returns: its id, or None if there is no preforked kernel to use
+        """
+        comp_id = self._pick_preforked()
+        if comp_id is None:
+            return None
+        preforked_kernel_id, comp_id = self._pool.pop(comp_id)
+        logger.info("Using kernel on %s.  Queue: %s kernels"%(comp_id[:4], self._pool.qsize()))
+        self._activate_kernel(self._kernels[preforked_kernel_id], referer, remote_ip, timeout)
+        self._adjust_pool(comp_id)
+        return preforked_kernel_id
+
+    def _activate_kernel(self, kernel, referer, remote_ip, timeout):
+        """ Hands out a preforked kernel that was taken out of the pool. """
+        if timeout is None:
+            timeout = float(0)
+        else:
+            timeout = float(timeout)
+        if math.isnan(timeout) or timeout > self.max_kernel_timeout:
+            timeout = self.max_kernel_timeout
+        kernel.deadline = time.time() + timeout
+        kernel.timeout = timeout
+        self._kernels.set_state(kernel, "active")
+        self._kernels.set_client(kernel, referer, remote_ip)
+        logger.info("Activated kernel %s on computer %s (preforked)", kernel.kernel_id, kernel.comp_id)
+
+    def lease(self, remote_ip):
+        """ Reserves a preforked kernel for a page that is being rendered
+        (see :mod:`lease`). The kernel goes back to the pool if the lease
+        is not claimed in time.
+
+        :arg str remote_ip: IP address of the client of the page
+        :returns: a token for :meth:`claim_lease`, or None if leases are
+            off, the client or the server holds as many leases as it may
+            or there is no preforked kernel
+        :rtype: str
+        """
+        if self.leases is None or not self.leases.available(remote_ip):
+            return None
+        comp_id = self._pick_preforked()
+        if comp_id is None:
+            return None
+        kernel_id, comp_id = self._pool.pop(comp_id)
+        timer = self.timers.schedule(self.leases.duration, lambda: self._lease_expired(kernel_id))
+        token = self.leases.grant(kernel_id, comp_id, remote_ip, timer)
+        self._adjust_pool(comp_id)
+        logger.debug("Leased kernel %s on computer %s to %s", kernel_id, comp_id[:4], remote_ip)
+        return token
+
+    def _lease_expired(self, kernel_id):
+        comp_id = self.leases.expire(kernel_id)
+        if comp_id is None:
+            return
+        kernel = self._kernels.get(kernel_id)
+        if kernel is None or kernel.state != "preforked":
+            return
+        if self._pool.adopt(kernel_id, comp_id):
+            # the pool gets back to its target size in its next rounds
+            logger.debug("Returned unclaimed kernel %s to the pool", kernel_id)
+        else:
+            self.end_session(kernel_id)
+
+    def claim_lease(self, token, referer='', remote_ip='', timeout=None):
+        """ Hands out the kernel reserved by :meth:`lease`, without waiting.
+
+        :arg str token: the token of the lease
+        :returns: the id of the kernel, or None if the token is not valid
+            for the client, the lease expired or its kernel ended
+        :rtype: str
+        """
+        if self.leases is None or not token:
+            return None
+        lease = self.leases.claim(token, remote_ip)
+        if lease is None:
+            return None
+        kernel_id, comp_id, timer = lease
+        self.timers.cancel(timer)
+        kernel = self._kernels.get(kernel_id)
+        if kernel is None or kernel.state != "preforked":
+            return None
+        self._pool.record_request()
+        self._activate_kernel(kernel, referer, remote_ip, timeout)
+        return kernel_id
+
+    def new_sessions_async(self, count, referer='', remote_ip='', timeout=None, callback=None):
+        """ Starts up to ``count`` kernels at once, for a page with many cells.
+
+        Preforked kernels are handed out first. The other kernels are
+        started with one ``start_kernels`` message per computer, on as
+        many computers as it takes; a computer that fails to start its
+        share is replaced by another one up to ``start_retries`` times.
+        Kernels that fit on no computer right now are not started, rather
+        than waiting in the admission queue.
+
+        :arg int count: number of kernels wanted
+        :arg callable callback: called with the list of the ids of the
+            kernels that were started, which may be shorter than
+            ``count`` or empty
+        """
+        kernel_ids = []
+        for i in range(count):
+            self._pool.record_request()
+        while len(kernel_ids) < count:
+            kernel_id = self._activate_preforked(referer, remote_ip, timeout)
+            if kernel_id is None:
+                break
+            kernel_ids.append(kernel_id)
+        self._start_batches(count - len(kernel_ids), referer, remote_ip,
+                            kernel_ids, callback)
+
+    def _start_batches(self, count, referer, remote_ip, kernel_ids, callback, failed_comps=()):
+        """ Starts ``count`` kernels in batches, at most as many on each
+        computer as it has free kernel slots, appends their ids to
+        ``kernel_ids`` and calls ``callback(kernel_ids)`` once every batch
+        is done. """
+        batches = []
+        exclude = list(failed_comps)
+        while count > 0:
+            try:
+                comp_id = self._find_open_computer(exclude=exclude)
+            except IOError:
+                break
+            exclude.append(comp_id)
+            size = min(count, self._free_slots(comp_id))
+            if size > 0:
+                batches.append((comp_id, size))
+                count -= size
+        if not batches:
+            callback(kernel_ids)
+            return
+        pending = [len(batches)]
+        def batch_done():
+            pending[0] -= 1
+            if not pending[0]:
+                callback(kernel_ids)
+        for comp_id, size in batches:
+            self._start_batch(comp_id, size, referer, remote_ip, kernel_ids,
+                              failed_comps, batch_done)
+
+    def _free_slots(self, comp_id):
+        """ The number of kernels that may still be started on a computer,
+        not counting those that are being started. """
+        return (self._comps[comp_id]["max_kernels"] - self._kernels.count(comp_id)
+                - self._pool.pending(comp_id) - self._batches.get(comp_id, 0))
+
+    def _start_batch(self, comp_id, count, referer, remote_ip, kernel_ids, failed_comps, done):
+        """ Starts ``count`` kernels on a computer with one ``start_kernels``
+        message and calls ``done()`` once they have started. The kernels
+        that did not start are retried on computers other than this one
+        and those in ``failed_comps``. """
+        self._batches[comp_id] = self._batches.get(comp_id, 0) + count
+        def unreserve():
+            left = self._batches.pop(comp_id, 0) - count
+            if left > 0:
+                self._batches[comp_id] = left
+
+        def started(reply):
+            unreserve()
+            content = reply["content"]
+            kernels = content.get("kernels", []) if isinstance(content, dict) else []
+            if comp_id not in self._comps:
+                logger.warning("Computer %s was removed while starting kernels", comp_id[:4])
+                kernels = []
+            for kernel_content in kernels:
+                kernel = self._setup_session({"content": kernel_content}, comp_id)
+                self._kernels.set_client(kernel, referer, remote_ip)
+                kernel_ids.append(kernel.kernel_id)
+            logger.info("Started %d of %d kernels on computer %s", len(kernels), count, comp_id[:4])
+            if len(kernels) < count:
+                if reply["type"] == "error":
+                    logger.error("Error starting kernels on computer %s: %s", comp_id, content)
+                retry(count - len(kernels))
+            else:
+                done()
+
+        def failed():
+            unreserve()
+            retry(count)
+
+        def retry(missing):
+            tried = failed_comps + (comp_id,)
+            if len(tried) > self.start_retries:
+                logger.error("Gave up starting %d kernels after trying computers %s",
+                             missing, [c[:4] for c in tried])
+                done()
+            else:
+                self._start_batches(missing, referer, remote_ip, kernel_ids,
+                                    lambda kernel_ids: done(), tried)
+
+        msg = self._start_kernel_msg(comp_id)
+        msg["type"] = "start_kernels"
+        msg["content"]["count"] = count
+        self._sender.send_msg_async(msg, comp_id, callback=started,
+                                    timeout=self.msg_timeout, errback=failed)
+
+    def _service_computers(self):
+        return [comp_id for comp_id, cfg in self._comps.iteritems()
+                if cfg.get("service_kernels") and not cfg.get("draining")
+                and not cfg.get("removing")]
+
+    def has_service_kernels(self):
+        """ :returns: whether a computer runs service requests in its
+            service kernels (see :mod:`service_kernels`)
+        :rtype: bool """
+        return bool(self._service_computers())
+
+    def execute_forked_async(self, code, user_variables=(), timeout=30.0, callback=None):
+        """ Runs code in a forked child of a service kernel, on the computer
+        whose service kernels are least busy, instead of in a kernel of
+        its own. The code runs under the computer's resource limits and
+        workspace quota.
+
+        :arg list user_variables: names of variables whose ``repr`` is
+            returned
+        :arg float timeout: seconds after which the code is stopped
+        :arg callable callback: called with the ``stdout``, ``stderr`` and
+            ``execute_reply`` of the code, or with None if no computer
+            could run it
+        """
+        comps = self._service_computers()
+        if not comps:
+            callback(None)
+            return
+        comp_id = min(comps, key=lambda c: self._service_busy.get(c, 0)
+                      / float(self._comps[c]["service_kernels"]))
+        self._service_busy[comp_id] = self._service_busy.get(comp_id, 0) + 1
+        cfg = self._comps[comp_id]
+        def finished():
+            left = self._service_busy.pop(comp_id, 0) - 1
+            if left > 0:
+                self._service_busy[comp_id] = left
+
+        def done(reply):
+            finished()
+            if reply["type"] == "success":
+                callback(reply["content"])
+            else:
+                logger.error("Computer %s could not run service request: %s",
+                             comp_id[:4], reply["content"])
+                callback(None)
+
+        def failed():
+            finished()
+            callback(None)
+
+        self._sender.send_msg_async({"type": "execute_forked",
+                                     "content": {"code": code,
+                                                 "user_variables": list(user_variables),
+                                                 "timeout": timeout,
+                                                 "resource_limits": cfg.get("resource_limits"),
+                                                 "workspace_quota": cfg.get("workspace_quota")}},
+                                    comp_id, callback=done, errback=failed,
+                                    timeout=self.msg_timeout + timeout)
+
+    def _start_session_async(self, referer, remote_ip, callback, failed_comps=(), limited=True):
+        """ Starts a new kernel on an open computer, trying other computers
+        if the chosen one answers with an error or does not answer in time.
+
+        The callback is called with the new kernel id, or with False if no
+        computer could start a kernel after ``start_retries`` retries.
+        If no computer is ready yet but some are still starting, the
+        request waits for the first of them.
+        """
+        if not self._comps and self._starting():
+            self._waiting.append(lambda: self._start_session_async(
+                referer, remote_ip, callback, failed_comps, limited))
+            return
         try:
-            preforked_kernel_id, comp_id = self._kernel_queue.get_nowait()
-            logger.info("Using kernel on %s.  Queue: %s kernels on %s computers"%(comp_id[:4], self._kernel_queue.qsize(), [i[1][:4] for i in self._kernel_queue.queue]))
-            kernel_info = self._kernels[preforked_kernel_id]
-            if timeout is None:
-                timeout = float(0)
+            comp_id = self._find_open_computer(exclude=failed_comps)
+        except IOError as e:
+            if not failed_comps and self._comps:
+                # every computer is full; wait for a kernel to end
+                self._enqueue(lambda: self._start_session_async(
+                    referer, remote_ip, callback, limited=limited), callback)
+                return
+            logger.error("Could not start kernel: %s", e)
+            callback(False)
+            return
+
+        def failed():
+            tried = failed_comps + (comp_id,)
+            if len(tried) > self.start_retries:
+                logger.error("Giving up starting kernel after trying computers %s",
+                             [c[:4] for c in tried])
+                callback(False)
             else:
-                timeout = float(timeout)
-            import math
-            if math.isnan(timeout) or timeout > self.max_kernel_timeout:
-                timeout = self.max_kernel_timeout
-            kernel_info["deadline"] = time.time() + timeout
-            kernel_info["timeout"] = timeout
-            kernel_info["referer"] = referer
-            kernel_info["remote_ip"] = remote_ip
-            self.new_session_prefork(comp_id)
-            logger.info("Activated kernel %s on computer %s (preforked)", preforked_kernel_id, comp_id)
-            callback(preforked_kernel_id)
-        except Empty:
-            comp_id = self._find_open_computer()
-            def cb(reply):
-                if reply["type"] == "success":
-                    kernel_id = reply["content"]["kernel_id"]
-                    self._setup_session(reply, comp_id)
-                    kernel_info = self._kernels[kernel_id]
-                    kernel_info["referer"] = referer
-                    kernel_info["remote_ip"] = remote_ip
-                    logger.info("Activated kernel %s on computer %s", kernel_id, comp_id)
-                    callback(kernel_id)
-                else:
-                    callback(False)
+                logger.warning("Retrying kernel start; computer %s failed", comp_id[:4])
+                self._start_session_async(referer, remote_ip, callback, tried, limited)
 
-            resource_limits = self._comps[comp_id].get("resource_limits")
-            self._sender.send_msg_async({"type":"start_kernel", "content": {"resource_limits": resource_limits}}, comp_id, callback=cb)
+        def cb(reply):
+            if comp_id not in self._comps:
+                logger.warning("Computer %s was removed while starting a kernel", comp_id[:4])
+                failed()
+            elif reply["type"] == "success":
+                kernel_id = reply["content"]["kernel_id"]
+                kernel = self._setup_session(reply, comp_id)
+                self._kernels.set_client(kernel, referer, remote_ip)
+                logger.info("Activated kernel %s on computer %s", kernel_id, comp_id)
+                callback(kernel_id)
+            else:
+                logger.error("Error starting kernel on computer %s: %s", comp_id, reply)
+                failed()
+
+        self._sender.send_msg_async(self._start_kernel_msg(comp_id, limited), comp_id,
+                                    callback=cb, timeout=self.msg_timeout, errback=failed)
+
+    def _enqueue(self, start, callback):
+        """ Queues a kernel request until there is room for it.
+
+        :arg callable start: called to retry the request
+        :arg callable callback: the callback of the request, which is
+            called with False if the request is rejected or times out
+        """
+        entry = self.admission.offer(start, lambda: callback(False))
+        if entry is None:
+            logger.warning("Rejected kernel request: %d requests waiting, expected wait %s",
+                           len(self.admission), self.admission.expected_wait())
+            callback(False)
+            return
+        self.timers.schedule(self.admission.max_wait, lambda: self.admission.expire(entry))
+
+    def _has_room(self):
+        """ Whether a kernel can be started or handed out right now. """
+        try:
+            self._find_open_computer()
+            return True
+        except IOError:
+            return self._pick_preforked() is not None
+
+    def _admit_waiting(self, count=1):
+        """ Starts up to ``count`` queued kernel requests that there is
+        room for. Kernels are only counted once they have started, so
+        every kernel that ends admits one request. """
+        while count > 0 and len(self.admission) and self._has_room():
+            self.admission.pop()()
+            count -= 1
 
     def end_session(self, kernel_id):
         """ Kills an existing kernel on a given computer.
@@ -308,57 +1168,158 @@ class TrustedMultiKernelManager(object):
 
         :arg str kernel_id: the id of the kernel you want to kill
         """
-        if kernel_id not in self._kernels:
+        kernel = self._kernels.get(kernel_id)
+        if kernel is None or kernel.state == "dying":
+            return
+        if kernel.exited:
+            self._forget_kernel(kernel_id)
             return
-        comp_id = self._kernels[kernel_id]["comp_id"]
+        comp_id = kernel.comp_id
+        self._kernels.set_state(kernel, "dying")
         def cb(reply):
             if (reply["type"] == "error"):
-                pass
+                # the computer does not know the kernel (any more)
+                logger.warning("Computer %s could not end kernel %s: %s",
+                               comp_id[:4], kernel_id, reply["content"])
             else:
                 logger.info("Ended kernel %s", kernel_id)
-                del self._kernels[kernel_id]
-                del self._comps[comp_id]["kernels"][kernel_id]
+            self._forget_kernel(kernel_id)
+
+        def failed():
+            # The computer is unresponsive, so the kernel is as good as gone
+            logger.warning("Computer %s did not confirm ending kernel %s", comp_id[:4], kernel_id)
+            self._forget_kernel(kernel_id)
 
         self._sender.send_msg_async({"type":"kill_kernel",
                                        "content": {"kernel_id": kernel_id}},
-                                      comp_id, callback=cb)
+                                      comp_id, callback=cb,
+                                      timeout=self.msg_timeout, errback=failed)
+
+    def _forget_kernel(self, kernel_id):
+        """ Drops the trusted side records of a kernel. """
+        kernel = self._kernels.remove(kernel_id)
+        self.limits.kernel_ended(kernel_id)
+        if self.leases is not None and kernel_id in self.leases:
+            self.timers.cancel(self.leases.end(kernel_id)[3])
+        if kernel is not None and kernel.comp_id in self._comps:
+            comp_id = kernel.comp_id
+            self._pool.discard(kernel_id, comp_id)
+            self._placement.update(comp_id, kernels=self._kernels.count(comp_id))
+            self._check_drained(comp_id)
+            self.admission.record_release()
+            self._admit_waiting()
+
+    def _on_event(self, comp_id, event):
+        """ Handles an event pushed by an untrusted computer.
+
+        ``kernel_exit`` events report that a kernel exited on its own or
+        was killed by its computer (e.g. for exceeding its workspace
+        quota). A kernel with an open connection is ended through the
+        ``kill`` callback of the connection, which tells the client;
+        other kernels are just forgotten.
+        """
+        if event["type"] == "kernel_exit":
+            kernel_id = event["content"]["kernel_id"]
+            kernel = self._kernels.get(kernel_id)
+            if kernel is None or kernel.comp_id != comp_id:
+                return
+            logger.info("Kernel %s on %s %s", kernel_id, comp_id[:4],
+                        event["content"]["reason"])
+            kernel.exited = True
+            if kernel.kill is not None:
+                kernel.kill()
+            else:
+                self._forget_kernel(kernel_id)
+
+    def uses_heartbeat(self, kernel_id):
+        """ Whether the web server should ping a kernel over the network to
+        check that it is alive, in addition to the kernel exit events sent by
+        its computer.
+
+        :rtype: bool
+        """
+        return self._comps[self._kernels[kernel_id].comp_id].get("heartbeat", True)
+
+    def _late_reply(self, comp_id, msg, reply):
+        """ Handles a reply that arrived after its request timed out.
+
+        A kernel whose start was given up on is still running, so kill it.
+        """
+        if msg["type"] == "start_kernel" and reply["type"] == "success":
+            kernels = [reply["content"]]
+        elif msg["type"] == "start_kernels" and isinstance(reply["content"], dict):
+            kernels = reply["content"].get("kernels", [])
+        else:
+            return
+        for kernel in kernels:
+            kernel_id = kernel["kernel_id"]
+            logger.warning("Killing kernel %s which started too late on %s", kernel_id, comp_id[:4])
+            self._sender.send_msg_async({"type": "kill_kernel",
+                                         "content": {"kernel_id": kernel_id}},
+                                        comp_id, callback=lambda reply: None,
+                                        timeout=self.msg_timeout, errback=lambda: None)
         
-    def _find_open_computer(self):
-        """ Randomly searches through computers in _comps to find one that can start a new kernel.
+    def _find_open_computer(self, exclude=()):
+        """ Chooses a computer that can start a new kernel, using the placement policy.
 
+        :arg exclude: ids of computers that should not be used
         :returns: the comp_id of a computer with room to start a new kernel
         :rtype: string
-        """ 
-        
-        ids = self._comps.keys()
-        random.shuffle(ids)
-        found_id = None
-        done = False
-        index = 0        
-
-        while (index < len(ids) and not done):
-            found_id = ids[index]
-            if len(self._comps[found_id]["kernels"].keys()) < self._comps[found_id]["max_kernels"]:
-                done = True
-            else:
-                index += 1
-        if done:
-            return found_id
-        else:
-            raise IOError("Could not find open computer. There are %d computers available."%len(ids))
+        :raises IOError: if no computer can start a new kernel
+        """
+        return self._placement.pick(exclude=exclude)
+
+    def _pick_preforked(self):
+        """ Chooses the computer whose preforked kernel should be used next.
+
+        Computers with too much load are avoided, but a computer whose kernel
+        slots are all taken may still hand out its preforked kernels.
+
+        :returns: the comp_id of a computer with a preforked kernel, or None
+            if there is none
+        """
+        has_preforked = lambda c: self._pool.qsize(c) > 0
+        try:
+            return self._placement.pick(accept=has_preforked)
+        except IOError:
+            comps = [c for c in self._comps if has_preforked(c)
+                     and not self._placement.is_hot(c, count=False)]
+            if comps:
+                return min(comps, key=self._placement.score)
+        return None
 
-    def _create_connected_stream(self, host, port, socket_type):
+    def _create_connected_stream(self, host, port, socket_type, transport="tcp"):
         sock = self.context.socket(socket_type)
-        addr = "tcp://%s:%i" % (host, port)
+        if transport == "tcp":
+            addr = "tcp://%s:%i" % (host, port)
+        else:
+            # ipc kernels bind to files named after their "ip" and ports
+            addr = "ipc://%s-%i" % (host, port)
         sock.connect(addr)
         return ZMQStream(sock)
+
+    def _create_kernel_stream(self, kernel_id, channel, socket_type):
+        connection = self._kernels[kernel_id].connection
+        return self._create_connected_stream(connection["ip"], connection[channel + "_port"],
+                                             socket_type, connection.get("transport", "tcp"))
     
     def create_iopub_stream(self, kernel_id):
-        """ Create iopub 0MQ stream between given kernel and the server."""
-        comp_id = self._kernels[kernel_id]["comp_id"]
-        cfg = self._comps[comp_id]
-        connection = self._kernels[kernel_id]["connection"]
-        iopub_stream = self._create_connected_stream(connection["ip"], connection["iopub_port"], zmq.SUB)
+        """ Create iopub 0MQ stream between given kernel and the server.
+
+        If the kernel's computer forwards the iopub messages of its kernels,
+        this is a :class:`iopub_mux.KernelStream` from the one connection to
+        the computer's forwarder.
+        """
+        comp_id = self._kernels[kernel_id].comp_id
+        connection = self._kernels[kernel_id].connection
+        if "forward_endpoint" in connection:
+            mux = self._iopub_mux.get(comp_id)
+            if mux is None:
+                sock = self.context.socket(zmq.SUB)
+                sock.connect(connection["forward_endpoint"])
+                mux = self._iopub_mux[comp_id] = Demultiplexer(ZMQStream(sock))
+            return mux.subscribe(kernel_id)
+        iopub_stream = self._create_kernel_stream(kernel_id, "iopub", zmq.SUB)
         iopub_stream.socket.setsockopt(zmq.SUBSCRIBE, b"")
         return iopub_stream
 
@@ -367,25 +1328,82 @@ class TrustedMultiKernelManager(object):
 
         
         """
-        comp_id = self._kernels[kernel_id]["comp_id"]
-        cfg = self._comps[comp_id]
-        connection = self._kernels[kernel_id]["connection"]
-        shell_stream = self._create_connected_stream(connection["ip"], connection["shell_port"], zmq.DEALER)
-        return shell_stream
+        return self._create_kernel_stream(kernel_id, "shell", zmq.DEALER)
 
     def create_hb_stream(self, kernel_id):
         """ Create heartbeat 0MQ stream between given kernel and the server.
 
         
         """
-        comp_id = self._kernels[kernel_id]["comp_id"]
-        cfg = self._comps[comp_id]
-        connection = self._kernels[kernel_id]["connection"]
-        hb_stream = self._create_connected_stream(connection["ip"], connection["hb_port"], zmq.REQ)
-        return hb_stream
+        return self._create_kernel_stream(kernel_id, "hb", zmq.REQ)
     def kernel_info(self, kernel_id):
+        """
+        :returns: the record of a kernel
+        :rtype: kernel_registry.Kernel
+        :raises KeyError: if the kernel is not known
+        """
         return self._kernels[kernel_id]
 
+    def stats(self):
+        """ Returns the state of the kernel manager for monitoring.
+
+        :rtype: dict
+        """
+        return {"computers": dict((comp_id, {"host": cfg["host"],
+                                             "kernels": self._kernels.count(comp_id),
+                                             "max_kernels": cfg["max_kernels"],
+                                             "load": cfg.get("load")})
+                                  for comp_id, cfg in self._comps.iteritems()),
+                "kernels": len(self._kernels),
+                "registry": self._kernels.memory(),
+                "readiness": self.readiness(),
+                "admission": self.admission.status(),
+                "rate_limits": self.limits.status(),
+                "leases": self.leases.status() if self.leases is not None else None,
+                "prefork": self._pool.status(),
+                "placement": self._placement.status(),
+                "memory": self.memory_stats(),
+                "timers": self.timers.status(),
+                "iopub_mux": dict((comp_id, len(mux)) for comp_id, mux in self._iopub_mux.iteritems()),
+                "messages": dict(self._sender.stats, rtt=self._sender.rtt)}
+
+    def memory_stats(self):
+        """ Aggregates the memory use reported by the computers.
+
+        For every computer this gives the memory use of the receiver
+        (``parent``) and the totals over its kernels, the average
+        proportional (``pss``) and unique (``uss``) set size of a kernel,
+        the fraction of the kernels' resident memory that is shared
+        copy-on-write and an estimate of how many kernels fit on the
+        computer: its current kernels plus the available memory divided
+        by the average unique set size. ``total`` sums the memory use of
+        the receivers and kernels on all computers.
+
+        :rtype: dict
+        """
+        computers = {}
+        total = dict.fromkeys(("rss", "pss", "uss", "shared", "count"), 0)
+        for comp_id, cfg in self._comps.iteritems():
+            memory = (cfg.get("load") or {}).get("memory")
+            if memory is None:
+                continue
+            kernels = memory["kernels"]
+            comp = {"parent": memory["parent"], "kernels": kernels,
+                    "time": memory["time"]}
+            if kernels["count"]:
+                comp["kernel_pss"] = kernels["pss"] // kernels["count"]
+                comp["kernel_uss"] = kernels["uss"] // kernels["count"]
+                comp["shared_fraction"] = float(kernels["shared"]) / (kernels["rss"] or 1)
+                free_memory = cfg["load"].get("free_memory")
+                if free_memory is not None and comp["kernel_uss"]:
+                    comp["kernel_capacity"] = kernels["count"] + free_memory // comp["kernel_uss"]
+            computers[comp_id] = comp
+            for k in total:
+                total[k] += kernels[k]
+            for k in ("rss", "pss", "uss", "shared"):
+                total[k] += (memory["parent"] or {}).get(k, 0)
+        return {"computers": computers, "total": total}
+
 
 if __name__ == "__main__":
     import misc
@@ -394,13 +1412,17 @@ if __name__ == "__main__":
     initial_comps = config.get_config("computers")
     default_config = config.get_default_config("_default_config")
 
-    t = TrustedMultiKernelManager(computers = initial_comps, default_computer_config = default_config)
+    # The constructor starts computers in the background; start them here
+    # and wait for them instead, so that kernels can be started right away
+    t = TrustedMultiKernelManager(default_computer_config = default_config)
+    for comp in initial_comps:
+        t.add_computer(comp)
     for i in xrange(5):
         t.new_session()
         
-    vals = t._comps.values()
-    for i in xrange(len(vals)):
-        print "\nComputer #%d has kernels ::: "%i, vals[i]["kernels"].keys()
+    comps = t._comps.keys()
+    for i in xrange(len(comps)):
+        print "\nComputer #%d has kernels ::: "%i, t.get_kernel_ids(comps[i])
 
     print "\nList of all kernel ids ::: " + str(t.get_kernel_ids())
         
@@ -409,10 +1431,10 @@ if __name__ == "__main__":
 
     t.remove_computer(x[0])
             
-    vals = t._comps.values()
-    print vals
-    for i in xrange(len(vals)):
-        print "\nComputer #%d has kernels ::: "%i, vals[i]["kernels"].keys()
+    comps = t._comps.keys()
+    print t._comps.values()
+    for i in xrange(len(comps)):
+        print "\nComputer #%d has kernels ::: "%i, t.get_kernel_ids(comps[i])
 
     print "\nList of all kernel ids ::: " + str(t.get_kernel_ids())
 
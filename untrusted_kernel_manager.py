@@ -1,16 +1,28 @@
-from forking_kernel_manager import ForkingKernelManager, KernelError
+from forking_kernel_manager import ForkingKernelManager, KernelError, KernelKilled
 from log import kernel_logger
 
 class UntrustedMultiKernelManager(object):
-    def __init__(self, ip, update_function=None, tmp_dir=None):
-        self.fkm = ForkingKernelManager(ip, update_function, tmp_dir=tmp_dir)
+    def __init__(self, ip, update_function=None, tmp_dir=None, loop=None,
+                 transport="tcp"):
+        self.fkm = ForkingKernelManager(ip, update_function, tmp_dir=tmp_dir,
+                                        loop=loop, transport=transport)
         self._kernels = set()
+        # Called as exit_callback(kernel_id, exitcode, reason) when a kernel
+        # exits without being killed through this manager
+        self.exit_callback = None
+        self.fkm.exit_callback = self._kernel_exited
+
+    def _kernel_exited(self, kernel_id, exitcode, reason):
+        self._kernels.discard(kernel_id)
+        if self.exit_callback is not None:
+            self.exit_callback(kernel_id, exitcode, reason)
     
-    def start_kernel(self, resource_limits=None):
+    def start_kernel(self, resource_limits=None, workspace_quota=None):
         retry=3
         while retry:
             try:
-                x = self.fkm.start_kernel(resource_limits=resource_limits)
+                x = self.fkm.start_kernel(resource_limits=resource_limits,
+                                          workspace_quota=workspace_quota)
                 break
             except KernelError as e:
                 retry -=1
@@ -22,21 +34,51 @@ class UntrustedMultiKernelManager(object):
         self._kernels.add(x["kernel_id"])
         return x
 
-    def kill_kernel(self, kernel_id):
-        success = self.fkm.kill_kernel(kernel_id)
-        if success:
-            self._kernels.remove(kernel_id)
+    def start_kernel_async(self, callback, errback, resource_limits=None,
+                           workspace_quota=None, retry=3):
+        """
+        Start a kernel without blocking, trying again up to ``retry`` times
+        in total if it fails to start. ``callback`` gets the kernel id and
+        connection information, ``errback`` the last error.
+        """
+        def started(x):
+            self._kernels.add(x["kernel_id"])
+            callback(x)
+
+        def failed(e):
+            if retry > 1 and not isinstance(e, KernelKilled):
+                kernel_logger.debug("kernel error--trying again %s"%(retry-1))
+                self.start_kernel_async(callback, errback, resource_limits,
+                                        workspace_quota, retry-1)
+            else:
+                kernel_logger.error("kernel error--giving up: %s", e)
+                errback(e)
+
+        self.fkm.start_kernel_async(started, failed, resource_limits=resource_limits,
+                                    workspace_quota=workspace_quota)
+
+    def kill_kernel(self, kernel_id, callback=None):
+        success = self.fkm.kill_kernel(kernel_id, callback)
+        # The kernel may already have been killed for exceeding its quota
+        if success or kernel_id not in self.fkm.kernels:
+            self._kernels.discard(kernel_id)
         return success
 
     def interrupt_kernel(self, kernel_id):
         return self.fkm.interrupt_kernel(kernel_id)
 
+    def kernel_ids(self):
+        """ The ids of the kernels that have started and not ended. """
+        return list(self._kernels)
+
     def restart_kernel(self, kernel_id, *args, **kwargs):
         return self.fkm.restart_kernel(kernel_id)
 
     def purge_kernels(self):        
         failures = []
         
+        for kernel_id in list(self.fkm.starting):
+            self.fkm.kill_kernel(kernel_id)
         for kernel_id in list(self._kernels):
             success = self.kill_kernel(kernel_id)
             if not success:
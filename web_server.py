@@ -18,6 +18,7 @@ ioloop.install()
 # Globals
 # This matches a kernel id (uuid4 format) from a url
 _kernel_id_regex = r"(?P<kernel_id>\w+-\w+-\w+-\w+-\w+)"
+_comp_id_regex = r"(?P<comp_id>\w+-\w+-\w+-\w+-\w+)"
 
 # Tornado Web Server
 import handlers
@@ -40,6 +41,12 @@ class SageCellServer(tornado.web.Application):
             (r"/kernel/%s/files/(?P<file_path>.*)" % _kernel_id_regex, handlers.FileHandler, {"path": tmp_dir}),
             (r"/permalink", permalink.PermalinkHandler),
             (r"/service", handlers.ServiceHandler),
+            (r"/stats", handlers.StatsHandler),
+            (r"/ready", handlers.ReadyHandler),
+            (r"/admin/computers", handlers.AdminComputersHandler),
+            (r"/admin/usage", handlers.AdminUsageHandler),
+            (r"/admin/computers/%s" % _comp_id_regex, handlers.AdminComputerHandler),
+            (r"/admin/computers/%s/drain" % _comp_id_regex, handlers.AdminDrainHandler),
             ] + handlers.KernelRouter.urls
         handlers_list = [[baseurl+i[0]]+list(i[1:]) for i in handlers_list]
         settings = dict(
@@ -53,7 +60,18 @@ class SageCellServer(tornado.web.Application):
         default_comp = self.config.get_default_config("_default_config")
         max_kernel_timeout = self.config.get_config("max_kernel_timeout")
         self.km = TMKM(computers=initial_comps, default_computer_config=default_comp,
-                       max_kernel_timeout=max_kernel_timeout, tmp_dir = tmp_dir)
+                       max_kernel_timeout=max_kernel_timeout, tmp_dir = tmp_dir,
+                       msg_timeout=self.config.get_config("control_msg_timeout"),
+                       start_retries=self.config.get_config("kernel_start_retries"),
+                       placement_policy=self.config.get_config("placement_policy"),
+                       stats_interval=self.config.get_config("computer_stats_interval"),
+                       admission_queue_size=self.config.get_config("admission_queue_size"),
+                       admission_max_wait=self.config.get_config("admission_max_wait"),
+                       admission_shed_wait=self.config.get_config("admission_shed_wait"),
+                       rate_limits=self.config.get_config("rate_limits"),
+                       api_keys=self.config.get_config("api_keys"),
+                       registry_checkpoint=self.config.get_config("registry_checkpoint"),
+                       kernel_leases=self.config.get_config("kernel_leases"))
         db = __import__('db_'+self.config.get_config('db'))
         self.db = db.DB(self.config.get_config('db_config')['uri'])
         self.ioloop = ioloop.IOLoop.instance()
@@ -61,6 +79,7 @@ class SageCellServer(tornado.web.Application):
         # to check for blocking when debugging, uncomment the following
         # and set the argument to the blocking timeout in seconds
         self.ioloop.set_blocking_log_threshold(.5)
+        # The completion kernel is started with the first completion request
         self.completer = handlers.Completer(self.km)
         super(SageCellServer, self).__init__(handlers_list, **settings)
 
@@ -129,6 +148,16 @@ if __name__ == "__main__":
         pidlock.acquire(timeout=10)
         # TODO: clean out the router-ipc directory
         application = SageCellServer(baseurl = args.baseurl)
+        if application.km.registry_checkpoint:
+            # A new instance terminates this one; it adopts the kernels
+            import signal
+            def detach():
+                application.km.detach()
+                application.ioloop.stop()
+            def on_sigterm(signum, frame):
+                logger.info("Received SIGTERM, so I'm leaving the kernels to the next instance.")
+                application.ioloop.add_callback_from_signal(detach)
+            signal.signal(signal.SIGTERM, on_sigterm)
         listen = {'port': args.port, 'xheaders': True}
         if args.interface is not None:
             listen['address']=get_ip_address(args.interface)
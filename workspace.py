@@ -0,0 +1,287 @@
+"""
+Working directories of the kernels on the untrusted side.
+
+Every kernel runs in its own directory under the receiver's ``tmp_dir``,
+which should be on a tmpfs mount so that plot files never touch a disk.
+The directories are checked periodically against a byte and file count
+quota. When a kernel ends, its directory is kept for :data:`RETENTION`
+seconds, because the web server serves the files in it to the browser
+(plots and download links) after the kernel is gone. Then it is renamed
+into a trash directory, which takes constant time, and is deleted a
+bounded number of files at a time from the receiver's event loop.
+"""
+import errno
+import os
+import uuid
+from collections import deque
+
+from log import kernel_logger
+
+# Files and directories removed per event loop iteration
+DELETE_BATCH = 500
+# Times an entry in the trash is tried again (e.g. because the kernel was
+# still writing to it) before it is left for good
+DELETE_RETRIES = 10
+# Seconds the working directory of an ended kernel is kept before it is
+# deleted
+RETENTION = 60 * 60
+
+
+def filesystem_type(path):
+    """
+    :returns: the type of the filesystem ``path`` is on, according to
+        ``/proc/mounts``, or None if it cannot be determined
+    :rtype: str
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                mount = fields[1].decode("string_escape")
+                if (path == mount or path.startswith(mount.rstrip("/") + "/")) \
+                        and len(mount) > len(best):
+                    best, fstype = mount, fields[2]
+    except IOError:
+        pass
+    return fstype
+
+
+class Workspaces(object):
+    """
+    Creates, polices and deletes the working directories of kernels.
+
+    :arg str root: directory in which the working directories are created
+    :arg poll_loop.PollLoop loop: event loop for quota checks and
+        deletion; without one, directories are deleted immediately and
+        quotas are not checked
+    :arg callable exceeded: called with the kernel id and its usage (see
+        :meth:`usage`) when a kernel exceeds its quota
+    :arg float scan_interval: seconds between quota checks
+    :arg float retention: seconds the directory of an ended kernel is
+        kept; without a loop, directories are not kept
+    """
+    def __init__(self, root, loop=None, exceeded=None, scan_interval=10.0,
+                 retention=RETENTION):
+        self.root = root
+        self.loop = loop
+        self.exceeded = exceeded
+        self.scan_interval = scan_interval
+        self.retention = retention
+        self.trash = os.path.join(root, ".trash")
+        if not os.path.isdir(self.trash):
+            os.makedirs(self.trash)
+        self.fstype = filesystem_type(root)
+        if self.fstype != "tmpfs":
+            kernel_logger.warning("Kernel workspaces in %s are on %s, not tmpfs",
+                                  root, self.fstype)
+        self._quotas = {} # kernel_id: {"bytes": int or None, "files": int or None}
+        self._retained = {} # kernel_id: timer that deletes the directory of an ended kernel
+        self._queue = deque() # [path, retries] in the trash waiting to be deleted
+        self._walk = None # os.walk generator of the entry being deleted
+        self._deleting = False
+        self.stats = {"created": 0, "released": 0, "quota_exceeded": 0,
+                      "reclaimed_bytes": 0, "reclaimed_files": 0, "abandoned": 0}
+        self._usage = (0, 0) # bytes and files in live workspaces at the last scan
+        if loop is not None:
+            loop.call_later(scan_interval, self._scan_periodically)
+
+    def path(self, kernel_id):
+        return os.path.join(self.root, kernel_id)
+
+    def create(self, kernel_id, quota=None):
+        """
+        Create an empty working directory for a kernel.
+
+        :arg str kernel_id: id of the kernel
+        :arg dict quota: limits on the ``bytes`` and number of ``files``
+            in the directory; either may be missing or None
+        :returns: path of the directory
+        :rtype: str
+        """
+        path = self.path(kernel_id)
+        timer = self._retained.pop(kernel_id, None)
+        if timer is not None:
+            self.loop.cancel(timer)
+        if os.path.lexists(path):
+            # left behind by an earlier kernel with the same id
+            self._discard(path)
+        os.mkdir(path)
+        self._quotas[kernel_id] = quota or {}
+        self.stats["created"] += 1
+        return path
+
+    def release(self, kernel_id, retain=True):
+        """
+        Stop policing the working directory of a kernel that ended and
+        schedule its deletion.
+
+        :arg bool retain: whether to keep the directory for
+            :attr:`retention` seconds first, so that its files can still
+            be served; otherwise it is moved to the trash at once
+        """
+        self._quotas.pop(kernel_id, None)
+        path = self.path(kernel_id)
+        timer = self._retained.pop(kernel_id, None)
+        if timer is not None:
+            self.loop.cancel(timer)
+        elif os.path.lexists(path):
+            self.stats["released"] += 1
+        else:
+            return
+        if retain and self.loop is not None and self.retention > 0:
+            self._retained[kernel_id] = self.loop.call_later(
+                self.retention, lambda: self._expire(kernel_id))
+        else:
+            self._discard(path)
+
+    def _expire(self, kernel_id):
+        del self._retained[kernel_id]
+        path = self.path(kernel_id)
+        if os.path.lexists(path):
+            self._discard(path)
+
+    def _discard(self, path):
+        trashed = os.path.join(self.trash, "%s-%s" % (os.path.basename(path), uuid.uuid4().hex[:8]))
+        try:
+            os.rename(path, trashed)
+        except OSError as e:
+            kernel_logger.error("Could not move %s to the trash: %s", path, e)
+            return
+        self._queue.append([trashed, 0])
+        if self.loop is None:
+            while self._queue:
+                self._delete_some(float("inf"))
+        elif not self._deleting:
+            self._deleting = True
+            self.loop.call_later(0, self._delete_slice)
+
+    def _delete_slice(self):
+        progress = self._delete_some(DELETE_BATCH)
+        if self._queue:
+            # back off while only entries that could not be deleted remain
+            self.loop.call_later(0 if progress else 1.0, self._delete_slice)
+        else:
+            self._deleting = False
+
+    def _remove(self, remove, path, size=0):
+        try:
+            remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                return False
+        self.stats["reclaimed_bytes"] += size
+        self.stats["reclaimed_files"] += 1
+        return True
+
+    def _delete_some(self, budget):
+        """
+        Delete up to ``budget`` files and directories from the trash.
+
+        :returns: whether anything was deleted
+        """
+        done = 0
+        while self._queue and done < budget:
+            entry = self._queue[0]
+            if self._walk is None:
+                self._walk = os.walk(entry[0], topdown=False,
+                                     onerror=lambda e: _make_writable(e.filename))
+            for dirpath, dirnames, filenames in self._walk:
+                _make_writable(dirpath)
+                for name in filenames:
+                    p = os.path.join(dirpath, name)
+                    try:
+                        size = os.lstat(p).st_size
+                    except OSError:
+                        size = 0
+                    done += self._remove(os.unlink, p, size)
+                for name in dirnames:
+                    p = os.path.join(dirpath, name)
+                    # os.walk lists symbolic links to directories here
+                    done += self._remove(os.unlink if os.path.islink(p) else os.rmdir, p)
+                if done >= budget:
+                    break
+            else:
+                self._walk = None
+                self._queue.popleft()
+                if self._remove(os.rmdir, entry[0]):
+                    done += 1
+                elif entry[1] < DELETE_RETRIES:
+                    # something was still being written into it
+                    entry[1] += 1
+                    self._queue.append(entry)
+                else:
+                    kernel_logger.error("Could not delete %s", entry[0])
+                    self.stats["abandoned"] += 1
+        return done > 0
+
+    def usage(self, kernel_id, limit=None):
+        """
+        Measure the working directory of a kernel.
+
+        :arg dict limit: stop counting once the ``bytes`` or ``files`` in
+            it are exceeded
+        :returns: bytes and number of files in the directory
+        :rtype: dict
+        """
+        limit = limit or {}
+        max_bytes = limit.get("bytes") or float("inf")
+        max_files = limit.get("files") or float("inf")
+        size = files = 0
+        for dirpath, dirnames, filenames in os.walk(self.path(kernel_id)):
+            files += len(filenames) + len(dirnames)
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+            if size > max_bytes or files > max_files:
+                break
+        return {"bytes": size, "files": files}
+
+    def _scan_periodically(self):
+        self.scan()
+        self.loop.call_later(self.scan_interval, self._scan_periodically)
+
+    def scan(self):
+        """
+        Check every working directory against its quota and report the
+        kernels that exceed it to ``exceeded``.
+        """
+        total_bytes = total_files = 0
+        for kernel_id, quota in self._quotas.items():
+            usage = self.usage(kernel_id, quota)
+            total_bytes += usage["bytes"]
+            total_files += usage["files"]
+            if (quota.get("bytes") and usage["bytes"] > quota["bytes"]) or \
+                    (quota.get("files") and usage["files"] > quota["files"]):
+                kernel_logger.info("Kernel %s exceeded its workspace quota: %s",
+                                   kernel_id[:4], usage)
+                self.stats["quota_exceeded"] += 1
+                if self.exceeded is not None:
+                    self.exceeded(kernel_id, usage)
+        self._usage = (total_bytes, total_files)
+
+    def status(self):
+        """
+        :returns: the filesystem type, the size of the live workspaces at
+            the last scan, the number of directories of ended kernels
+            that are kept, the length of the deletion queue and the
+            counters in :attr:`stats`
+        :rtype: dict
+        """
+        return dict(self.stats,
+                    fstype=self.fstype,
+                    workspaces=len(self._quotas),
+                    bytes=self._usage[0],
+                    files=self._usage[1],
+                    retained=len(self._retained),
+                    deleting=len(self._queue))
+
+
+def _make_writable(path):
+    try:
+        os.chmod(path, 0700)
+    except OSError:
+        pass